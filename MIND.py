@@ -2,51 +2,387 @@ import sys
 import os
 import numpy as np
 import pandas as pd
-from MIND_helpers import calculate_mind_network, is_outlier
-from get_vertex_df import get_vertex_df
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from MIND_helpers import calculate_mind_network, calculate_mind_array, format_mind_output
+from MIND_qc import run_vertex_qc, format_qc_report
+from MIND_store import create_MIND_store, append_to_MIND_store, get_stored_subjects, read_MIND_store_header
+from MIND_aggregate import update_MIND_aggregate
+from MIND_profiler import profile_subject, profile_stage, add_profile_count, set_profile_regions, set_profile_entry, log_detail, get_profile_settings, set_verbosity
 
-def compute_MIND(surf_dir, features, parcellation, filter_vertices=False, resample=False, n_samples = 4000):
+def get_zero_filter_columns(features, features_used, filter_vertices):
+
+	#The filter_vertices parameter determines you want to filter out all the non-biologically feasible vertices (i.e. any of volume, surface area or cortical thickness equalling zero)
+	feature_conv_dict = dict(zip(list(features), list(features_used)))
+	return [features_used.index(feature_conv_dict[x]) for x in ['CT','Vol','SA'] if (filter_vertices == True) and (x in features)]
+
+def record_qc_report(report):
+
+	#The QC report goes into the subject's profiling report (see MIND_profiler.set_verbosity), and is logged with verbosity='detailed'.
+	set_profile_entry('qc', report)
+	add_profile_count('vertices_removed', report['removed']['total'])
+	log_detail(format_qc_report(report))
+
+def filter_and_standardize(vertex_data, features, features_used, filter_vertices=False, regions=None, mad_threshold=None, mad_mode='per_feature', max_duplicate_rate=None):
 
-	vertex_data, regions, features_used = get_vertex_df(surf_dir, features, parcellation)
-	
 	'''
-	Filter the data, do some QC checks here.
-	To double check everything, please look at histograms of individual features to make sure everything looks ok.
+	Filtering and standardization step of compute_MIND, on the output of get_vertex_df.
 
+	The QC rules (zero filters if filter_vertices is True, MAD outliers if mad_threshold is set, and the repeated values check if
+	max_duplicate_rate is set) are run together by MIND_qc.run_vertex_qc, and the kept vertices are copied out once. regions (as returned
+	by get_vertex_df) is used for the per-region counts of removed vertices in the QC report, and for the repeated values check.
+
+	Note the order: QC runs on the raw values and the features are standardized afterwards, over the kept vertices only. The zero filters
+	always ran first, but the (previously commented out) MAD step was written to run after standardization. Per-feature MAD scores don't
+	change under standardization, and the multivariate mode scales the features itself, so the same vertices are flagged either way, but
+	the means and standard deviations used for standardization no longer include the MAD outliers.
 	'''
 
-	columns = ['Label'] + features_used
-	
-	feature_conv_dict = dict(zip(list(features), list(features_used)))
-	#The filter_vertices parameter determines you want to filter out all the non-biologically feasible vertices (i.e. any of volume, surface area or cortical thickness equalling zero)	
-	if filter_vertices == True:
+	label_cols = [x for x in vertex_data.columns if x.startswith('Label')]
+	values = vertex_data[features_used].to_numpy(dtype=float)
+
+	#Region index of every vertex for the QC report, or -1 for vertices outside the regions (e.g. unknown / medial wall).
+	if type(regions) is dict:
+		codes = {x: pd.Index(regions[x]).get_indexer(vertex_data['Label_' + x]) for x in regions}
+	elif regions is not None:
+		codes = pd.Index(regions).get_indexer(vertex_data['Label'])
+	else:
+		codes = None
+
+	keep, report = run_vertex_qc(values, codes=codes, regions=regions, zero_columns=get_zero_filter_columns(features, features_used, filter_vertices), \
+								column_names=list(features), mad_threshold=mad_threshold, mad_mode=mad_mode, max_duplicate_rate=max_duplicate_rate)
+	record_qc_report(report)
+
+	#standardize across the brain for each feature to get each dimension to roughly the same scale.
+	values = values[keep]
+	values -= values.mean(axis=0)
+	values /= values.std(axis=0, ddof=1)
+
+	vertex_data = vertex_data.loc[keep, label_cols].copy()
+	vertex_data[features_used] = values
+
+	return vertex_data
+
+def compute_MIND(surf_dir, features, parcellation, filter_vertices=False, resample=False, n_samples = 4000, query_mode='pairwise', n_jobs=1, random_state=None, cache_dir=None, max_cache_bytes=None, dtype=None, max_vertices_per_region=None, \
+				mad_threshold=None, mad_mode='per_feature', max_duplicate_rate=0.2):
+
+	#max_vertices_per_region caps the number of vertices per region by seeded random subsampling (see calculate_mind_network), which is
+	#reproducible even without a random_state (a fixed default seed is used then).
+	#When it is set, (MIND, diagnostics) is returned, with diagnostics estimating the error introduced by the subsampling.
+
+	#parcellation can also be a list of parcellation names. The features are then loaded, filtered and standardized only once,
+	#and a dict of MIND networks keyed by parcellation name is returned.
 
-		if 'CT' in features:
-			vertex_data = vertex_data.drop(vertex_data[vertex_data[feature_conv_dict['CT']] == 0].index)
+	#dtype (e.g. np.float32) switches to the low-memory path, which loads the data with get_vertex_array and keeps it in that dtype throughout.
+	#Progress, timings and memory use are reported according to MIND_profiler.set_verbosity.
 
-		if 'Vol' in features:
-			vertex_data = vertex_data.drop(vertex_data[vertex_data[feature_conv_dict['Vol']] == 0].index)
+	#mad_threshold removes vertices with a modified z-score (median absolute deviation) above it, in any feature (mad_mode='per_feature')
+	#or in their distance to the median over all features (mad_mode='multivariate'), e.g. 7. An exception is raised if more than
+	#max_duplicate_rate of the vertices have repeated values. These rules run together with filter_vertices in one QC pass (see MIND_qc.py),
+	#whose report, with the number of vertices removed from each region, is added to the profiling report as 'qc'.
 
-		if 'SA' in features:
-			vertex_data = vertex_data.drop(vertex_data[vertex_data[feature_conv_dict['SA']] == 0].index)
+	#The repeated values check runs in the QC pass, except with resample=True, where it has to look at the resampled values, and for several
+	#parcellations, where it is done for each parcellation.
+	qc_duplicate_rate = max_duplicate_rate if (resample == False) and (type(parcellation) is not list) else None
+	mind_duplicate_rate = max_duplicate_rate if qc_duplicate_rate is None else None
+
+	with profile_subject(surf_dir):
+		if dtype is not None:
+			if type(parcellation) is list:
+				raise Exception('Computing several parcellations at once is not supported together with dtype.')
+
+			return _compute_MIND_array(surf_dir, features, parcellation, dtype, filter_vertices=filter_vertices, resample=resample, n_samples=n_samples, \
+									query_mode=query_mode, n_jobs=n_jobs, random_state=random_state, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, \
+									max_vertices_per_region=max_vertices_per_region, mad_threshold=mad_threshold, mad_mode=mad_mode, \
+									qc_duplicate_rate=qc_duplicate_rate, mind_duplicate_rate=mind_duplicate_rate)
+
+		from get_vertex_df import get_vertex_df
+
+		with profile_stage('get_vertex_df'):
+			vertex_data, regions, features_used = get_vertex_df(surf_dir, features, parcellation, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
 	
-	vertex_data = vertex_data[columns]
+		'''
+		Filter the data, do some QC checks here.
+		To double check everything, please look at histograms of individual features to make sure everything looks ok.
 
-	#standardize across the brain for each feature to get each dimension to roughly the same scale.
-	for x in features_used:
-		vertex_data[x] = (vertex_data[x] - vertex_data[x].mean())/vertex_data[x].std()
+		'''
+
+		with profile_stage('filter_and_standardize'):
+			vertex_data = filter_and_standardize(vertex_data, features, features_used, filter_vertices=filter_vertices, regions=regions, \
+												mad_threshold=mad_threshold, mad_mode=mad_mode, max_duplicate_rate=qc_duplicate_rate)
+
+		add_profile_count('vertices', len(vertex_data))
+
+		log_detail('Computing MIND...')
+		if type(parcellation) is list:
+			#One network per parcellation, all computed from the same filtered and standardized vertex array.
+			values = vertex_data[features_used].to_numpy(dtype=float)
+			MIND = {}
+
+			for x in parcellation:
+				labels = vertex_data['Label_' + x].fillna('').to_numpy()
+				MIND[x] = format_mind_output(calculate_mind_array(values, labels, regions[x], resample=resample, n_samples = n_samples, query_mode=query_mode, \
+											n_jobs=n_jobs, random_state=random_state, max_vertices_per_region=max_vertices_per_region, max_duplicate_rate=mind_duplicate_rate), regions[x])
+
+			log_detail('Done!')
+			return MIND
+
+		#calculate MIND network
+		MIND = calculate_mind_network(vertex_data, features_used, regions, resample=resample, n_samples = n_samples, query_mode=query_mode, n_jobs=n_jobs, random_state=random_state, \
+										max_vertices_per_region=max_vertices_per_region, max_duplicate_rate=mind_duplicate_rate)
+
+		log_detail('Done!')
+		return MIND
+
+def _compute_MIND_array(surf_dir, features, parcellation, dtype, filter_vertices=False, resample=False, n_samples = 4000, query_mode='pairwise', n_jobs=1, random_state=None, cache_dir=None, max_cache_bytes=None, max_vertices_per_region=None, \
+						mad_threshold=None, mad_mode='per_feature', qc_duplicate_rate=0.2, mind_duplicate_rate=None):
+
+	#Same steps as compute_MIND, on the single label-sorted array returned by get_vertex_array.
+	from get_vertex_df import get_vertex_array
+
+	with profile_stage('get_vertex_array'):
+		values, codes, vertex_regions, regions, features_used = get_vertex_array(surf_dir, features, parcellation, dtype=dtype, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+
+	#Index of every vertex's region in regions for the QC report, or -1 for unknown regions.
+	region_index = dict(zip(regions, range(len(regions))))
+	qc_codes = np.array([region_index.get(x, -1) for x in vertex_regions], dtype=int)[codes]
+
+	with profile_stage('filter_and_standardize'):
+		keep, report = run_vertex_qc(values, codes=qc_codes, regions=regions, zero_columns=get_zero_filter_columns(features, features_used, filter_vertices), \
+									column_names=list(features), mad_threshold=mad_threshold, mad_mode=mad_mode, max_duplicate_rate=qc_duplicate_rate)
+		record_qc_report(report)
+
+		if report['removed']['total'] > 0:
+			values, codes = values[keep], codes[keep]
+
+		#standardize across the brain for each feature, in place. A single-feature MIND network doesn't change under rescaling, so
+		#this is skipped for one feature: rounding the standardized values to float32 would perturb the smallest nearest neighbour distances.
+		if len(features_used) > 1:
+			values -= values.mean(axis=0)
+			values /= values.std(axis=0, ddof=1)
+
+	add_profile_count('vertices', len(values))
+
+	region_codes = dict(zip(vertex_regions, range(len(vertex_regions))))
+	set_profile_regions(regions)
+
+	log_detail('Computing MIND...')
+	MIND = calculate_mind_array(values, codes, [region_codes[x] for x in regions], resample=resample, n_samples = n_samples, \
+							query_mode=query_mode, n_jobs=n_jobs, random_state=random_state, max_vertices_per_region=max_vertices_per_region, \
+							max_duplicate_rate=mind_duplicate_rate)
+
+	log_detail('Done!')
+	return format_mind_output(MIND, regions)
+
+
+def _compute_MIND_subject(surf_dir, features, parcellation, filter_vertices, resample, n_samples, query_mode, mad_threshold, mad_mode, verbosity='summary', collect_reports=False):
+
+	#Worker used by compute_MIND_batch. Errors are caught and returned so that one bad subject does not take down the whole batch.
+	#Worker processes don't share the parent's profiler settings, so the verbosity is passed in, and profiling reports are returned
+	#for the parent to pass on to its callback.
+	reports = []
+	previous_settings = get_profile_settings()
+	set_verbosity(verbosity, callback=reports.append if collect_reports else None, n_slowest_pairs=previous_settings['n_slowest_pairs'])
+
+	try:
+		MIND = compute_MIND(surf_dir, features, parcellation, filter_vertices=filter_vertices, resample=resample, n_samples=n_samples, query_mode=query_mode, \
+							mad_threshold=mad_threshold, mad_mode=mad_mode)
+		return MIND, None, reports
+	except Exception:
+		return None, traceback.format_exc(), reports
+	finally:
+		set_verbosity(**previous_settings)
+
+def compute_MIND_batch(surf_dirs, features, parcellation, subject_ids=None, regions=None, n_workers=None, filter_vertices=False, resample=False, n_samples = 4000, query_mode='pairwise', out_store=None, aggregate=None, groups=None, \
+						mad_threshold=None, mad_mode='per_feature'):
+
+	'''
+	Compute MIND networks for a whole cohort, distributing subjects across a pool of worker processes.
+
+	• surf_dirs (list or str): Either a list of FreeSurfer directories (as passed to compute_MIND), or the path to a manifest text file listing one directory per line.
+	• features, parcellation, filter_vertices, resample, n_samples, query_mode, mad_threshold, mad_mode: Shared settings, passed on to compute_MIND for every subject.
+	• subject_ids (list): Optional names for each subject. Defaults to the basename of each surf_dir.
+	• regions (list): Optional region order for the output. By default the region list of the first successfully processed subject is used for everyone.
+	• n_workers (int): Number of worker processes. Defaults to the number of CPUs; n_workers=1 runs everything serially in the current process.
+	• out_store (str): Optional directory of a MIND store (see MIND_store.py). Every subject is written to the store as soon as it finishes,
+	instead of being kept in memory. If the store already exists, subjects already in it are skipped, so an interrupted batch can simply be rerun.
+	• aggregate (dict): Optional aggregate created with MIND_aggregate.create_MIND_aggregate. Every subject is added to it as soon as it finishes,
+	instead of being kept in memory, giving group-level summaries without holding the whole cohort.
+	• groups (list): Optional group (e.g. site or sex) of each subject, used to keep separate summaries per group in aggregate.
+
+	Failures are isolated per subject: a subject that raises an error gets an all-NaN matrix and its traceback is recorded in the status table.
+	Regions missing from an individual subject are also left as NaN.
+
+	Returns:
+	• MIND_stack (np.ndarray): subjects X regions X regions array of MIND networks. None if out_store or aggregate is used.
+	• regions (np.ndarray): The region order shared by every matrix in MIND_stack.
+	• status (pd.DataFrame): One row per subject with columns subject_id, surf_dir, status ('ok', 'failed', or 'skipped' if already in out_store) and error.
+	'''
+
+	if type(parcellation) is list:
+		raise Exception('compute_MIND_batch only supports a single parcellation. Run it once per parcellation instead.')
+
+	if type(surf_dirs) is str:
+		with open(surf_dirs) as f:
+			surf_dirs = [line.strip() for line in f if line.strip() != '']
+	else:
+		surf_dirs = list(surf_dirs)
+
+	if subject_ids is None:
+		subject_ids = [os.path.basename(os.path.normpath(x)) for x in surf_dirs]
+
+	if len(subject_ids) != len(surf_dirs):
+		raise Exception('subject_ids must have the same length as surf_dirs.')
+
+	results = [None] * len(surf_dirs)
+	errors = [None] * len(surf_dirs)
+	status = ['ok'] * len(surf_dirs)
+
+	#Resume from an existing store, skipping the subjects it already contains.
+	store_exists = (out_store is not None) and os.path.exists(os.path.join(out_store, 'header.json'))
+	if store_exists:
+		regions = read_MIND_store_header(out_store)['regions']
+		stored_subjects = set(get_stored_subjects(out_store))
+		for i, subject_id in enumerate(subject_ids):
+			if str(subject_id) in stored_subjects:
+				status[i] = 'skipped'
+
+	profile_settings = get_profile_settings()
+	subject_args = (filter_vertices, resample, n_samples, query_mode, mad_threshold, mad_mode, profile_settings['verbosity'], profile_settings['callback'] is not None)
+
+	def add_result(i, MIND, error, reports):
+		nonlocal regions, store_exists
+
+		for report in reports:
+			profile_settings['callback'](report)
+
+		if error is not None:
+			errors[i], status[i] = error, 'failed'
+
+		else:
+			if out_store is not None:
+				if not store_exists:
+					create_MIND_store(out_store, regions if regions is not None else MIND.index.values)
+					regions = read_MIND_store_header(out_store)['regions']
+					store_exists = True
+				append_to_MIND_store(out_store, subject_ids[i], MIND)
+
+			if aggregate is not None:
+				update_MIND_aggregate(aggregate, MIND, group=groups[i] if groups is not None else None)
+
+			if (out_store is None) and (aggregate is None):
+				results[i] = MIND
+
+	to_compute = [i for i in range(len(surf_dirs)) if status[i] != 'skipped']
+
+	if n_workers == 1:
+		for i in to_compute:
+			add_result(i, *_compute_MIND_subject(surf_dirs[i], features, parcellation, *subject_args))
+
+	else:
+		with ProcessPoolExecutor(max_workers=n_workers) as pool:
+			futures = {pool.submit(_compute_MIND_subject, surf_dirs[i], features, parcellation, *subject_args): i for i in to_compute}
+
+			for future in as_completed(futures):
+				i = futures[future]
+				try:
+					MIND, error, reports = future.result()
+				except Exception:
+					#Raised if the worker process itself died (e.g. it ran out of memory).
+					MIND, error, reports = None, traceback.format_exc(), []
+				add_result(i, MIND, error, reports)
+
+	status = pd.DataFrame({'subject_id': subject_ids, 'surf_dir': surf_dirs, 'status': status, 'error': errors})
+
+	if out_store is not None:
+		return None, np.asarray(regions if regions is not None else []), status
+
+	if aggregate is not None:
+		return None, np.asarray(aggregate['regions']), status
+
+	if regions is None:
+		successful = [x for x in results if x is not None]
+		regions = successful[0].index.values if len(successful) > 0 else np.array([])
+
+	regions = np.asarray(regions)
+	MIND_stack = np.full((len(surf_dirs), len(regions), len(regions)), np.nan)
+
+	for i, MIND in enumerate(results):
+		if MIND is not None:
+			MIND_stack[i] = MIND.reindex(index=regions, columns=regions).values
+
+	return MIND_stack, regions, status
+
+def compute_MIND_sweep(surf_dir, feature_subsets, parcellation, n_workers=None, filter_vertices=False, resample=False, n_samples = 4000, query_mode='pairwise', random_state=None):
+
+	'''
+	Computes MIND networks for many combinations of features of one subject, e.g. for ablation studies.
+
+	• feature_subsets (list): A list of feature lists, each in any of the forms accepted by compute_MIND, e.g. [['CT','MC'], ['CT','SD','SA'], ['CT']].
+	• n_workers (int): Number of threads used to compute the subsets in parallel. Defaults to the number of CPUs.
+	• The other inputs are as for compute_MIND, and apply to every subset.
+
+	The union of all features is loaded only once, and each feature column is standardized only once (once per distinct set of zero-filtered
+	vertices if filter_vertices=True, so every subset gets exactly the vertices and standardization compute_MIND would give it). The subsets are
+	then computed in threads that all share the same standardized vertex matrix, so it is never pickled between workers. Each subset only
+	copies its own feature columns, when they are gathered into per-region blocks for the trees (see get_region_blocks).
+
+	Returns a dict of MIND networks keyed by the tuple of features in each subset.
+	'''
+
+	all_features = []
+	for subset in feature_subsets:
+		for x in subset:
+			if x not in all_features:
+				all_features.append(x)
+
+	from get_vertex_df import get_vertex_df
+
+	vertex_data, regions, features_used = get_vertex_df(surf_dir, all_features, parcellation)
+	feature_conv_dict = dict(zip(all_features, features_used))
+
+	#Fortran order keeps each feature column contiguous in memory, so gathering a subset's columns into region blocks reads only those columns.
+	raw_values = np.asfortranarray(vertex_data[features_used].to_numpy(dtype=float))
+	raw_labels = vertex_data['Label'].to_numpy()
+	del vertex_data
+
+	standardized = {}
+
+	def get_standardized(filter_features):
+
+		#Vertices kept for this set of zero-filtered features, standardized over exactly those vertices.
+		if filter_features not in standardized:
+			keep = np.ones(len(raw_values), dtype=bool)
+			for x in filter_features:
+				keep &= raw_values[:, features_used.index(feature_conv_dict[x])] != 0
+
+			values = np.asfortranarray(raw_values[keep]) if len(filter_features) > 0 else raw_values.copy(order='F')
+			values -= values.mean(axis=0)
+			values /= values.std(axis=0, ddof=1)
+
+			standardized[filter_features] = (values, raw_labels[keep])
+
+		return standardized[filter_features]
+
+	def compute_subset(subset):
 
-	#Drop outliers. This drops vertices with an MAD score in ANY of the used features. Can be customized.
-	# z_score_threshhold = 7
-	# outliers_per_features = np.array([is_outlier(vertex_data[x].values, z_score_threshhold) for x in features_used]).T
-	# vertex_data = vertex_data.loc[np.sum(outliers_per_features, axis = 1) == 0]
+		filter_features = tuple(x for x in ['CT','Vol','SA'] if (filter_vertices == True) and (x in subset))
+		values, labels = get_standardized(filter_features)
+		columns = [features_used.index(feature_conv_dict[x]) for x in subset]
 
-	print('Computing MIND...')
-	#calculate MIND network
-	MIND = calculate_mind_network(vertex_data, features_used, regions, resample=resample, n_samples = n_samples)
+		#The columns are selected while grouping the vertices into region blocks, rather than with values[:, columns], which would copy them first.
+		MIND = calculate_mind_array(values, labels, regions, resample=resample, n_samples = n_samples, query_mode=query_mode, random_state=random_state, \
+									columns=columns)
 
-	print('Done!')
-	return MIND
+		return pd.DataFrame(MIND, index = regions, columns = regions)
 
+	#Standardize up front, so the worker threads only read shared data.
+	for subset in feature_subsets:
+		get_standardized(tuple(x for x in ['CT','Vol','SA'] if (filter_vertices == True) and (x in subset)))
 
+	log_detail('Computing MIND for ' + str(len(feature_subsets)) + ' feature subsets...')
+	with ThreadPoolExecutor(max_workers=n_workers) as pool:
+		results = list(pool.map(compute_subset, feature_subsets))
 
+	log_detail('Done!')
+	return dict(zip([tuple(x) for x in feature_subsets], results))
@@ -0,0 +1,160 @@
+'''
+Online group-level summaries of MIND networks.
+
+An aggregate accumulates the per-edge mean and variance (with Welford's algorithm) and approximate per-edge quantiles of MIND networks
+as they are produced, without keeping the individual networks. Quantiles come from a fixed-bin histogram per edge: MIND values lie
+between 0 and 1, so with n_bins bins every quantile is accurate to roughly 1/n_bins.
+
+Memory use does not depend on the cohort size, but it is O(R^2 * n_bins) per group rather than O(R^2): every edge keeps a count, mean and
+sum of squares (24 bytes) plus n_bins uint32 histogram counts. With the default 200 bins that is about 800 bytes per edge per group, or
+roughly 400 MB per group for a 1000 region parcellation (500,000 edges). Lower n_bins to trade quantile resolution for memory.
+
+Subjects can optionally be assigned to groups (e.g. site or sex), in which case a separate summary is kept for every group as well as
+for everyone. Aggregates built separately (e.g. on different workers or nodes) can be combined with merge_MIND_aggregates.
+'''
+
+import pickle
+import numpy as np
+import pandas as pd
+
+def _create_group_state(n_edges, n_bins):
+    return {'n': np.zeros(n_edges, dtype=np.int64), 'mean': np.zeros(n_edges), 'M2': np.zeros(n_edges), \
+            'histogram': np.zeros((n_edges, n_bins), dtype=np.uint32)}
+
+def create_MIND_aggregate(regions, n_bins = 200, value_range = (0, 1)):
+
+    '''
+    Creates an empty aggregate for MIND networks over the given regions (in this order).
+    n_bins and value_range set the resolution of the histograms used for quantiles. Values outside value_range are counted in the first or last bin.
+    Each group takes about (24 + 4 * n_bins) bytes per edge (see above).
+    '''
+
+    return {'regions': [str(x) for x in regions], 'n_bins': n_bins, 'value_range': tuple(value_range), 'groups': {}}
+
+def update_MIND_aggregate(aggregate, MIND, group=None):
+
+    '''
+    Adds one MIND network to the aggregate, both to the overall summary and, if group is given, to that group's summary.
+
+    MIND can be a DataFrame (as returned by compute_MIND), which is reordered to the aggregate's region order, or a square array already in that order.
+    NaN values (e.g. regions missing from a subject) are skipped, so each edge keeps its own count.
+    '''
+
+    regions = aggregate['regions']
+    n_regions = len(regions)
+
+    if type(MIND) is pd.DataFrame:
+        MIND = MIND.reindex(index=regions, columns=regions).values
+
+    values = np.asarray(MIND, dtype=float)[np.triu_indices(n_regions, 1)]
+    valid = np.isfinite(values)
+
+    low, high = aggregate['value_range']
+    bins = np.floor((np.where(valid, values, low) - low) / (high - low) * aggregate['n_bins'])
+    bins = np.clip(bins, 0, aggregate['n_bins'] - 1).astype(int)
+    edges = np.flatnonzero(valid)
+
+    for key in [None] if group is None else [None, group]:
+        if key not in aggregate['groups']:
+            aggregate['groups'][key] = _create_group_state(len(values), aggregate['n_bins'])
+
+        state = aggregate['groups'][key]
+
+        #Welford's update, only for the edges with a value.
+        state['n'][valid] += 1
+        delta = values[valid] - state['mean'][valid]
+        state['mean'][valid] += delta / state['n'][valid]
+        state['M2'][valid] += delta * (values[valid] - state['mean'][valid])
+
+        state['histogram'][edges, bins[valid]] += 1
+
+    return aggregate
+
+def merge_MIND_aggregates(aggregates):
+
+    '''
+    Combines a list of aggregates (with the same regions and histogram settings) into a new one, as if all their networks had been added to it.
+    '''
+
+    merged = create_MIND_aggregate(aggregates[0]['regions'], n_bins=aggregates[0]['n_bins'], value_range=aggregates[0]['value_range'])
+
+    for aggregate in aggregates:
+        if (aggregate['regions'] != merged['regions']) or (aggregate['n_bins'] != merged['n_bins']) or (tuple(aggregate['value_range']) != merged['value_range']):
+            raise Exception('Only aggregates with the same regions, n_bins and value_range can be merged.')
+
+        for key, state in aggregate['groups'].items():
+            if key not in merged['groups']:
+                merged['groups'][key] = _create_group_state(len(state['n']), merged['n_bins'])
+
+            total = merged['groups'][key]
+
+            #Chan et al.'s parallel combination of means and sums of squares.
+            n = total['n'] + state['n']
+            delta = state['mean'] - total['mean']
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.where(n > 0, state['n'] / n, 0)
+
+            total['M2'] += state['M2'] + delta**2 * total['n'] * weight
+            total['mean'] += delta * weight
+            total['n'] = n
+            total['histogram'] += state['histogram']
+
+    return merged
+
+def get_MIND_aggregate_summary(aggregate, group=None, quantiles = (0.05, 0.5, 0.95)):
+
+    '''
+    Summarizes the networks added to the aggregate, for everyone (group=None) or for one group.
+
+    Returns a dict of regions X regions DataFrames: 'n' (number of networks with a value for each edge), 'mean', 'variance' (with ddof=1),
+    'std', and one entry per quantile, keyed by the quantile (e.g. 0.5), estimated by linear interpolation within the histogram bins.
+    '''
+
+    if group not in aggregate['groups']:
+        raise Exception('No networks have been added for group ' + str(group) + '.')
+
+    regions = aggregate['regions']
+    n_regions = len(regions)
+    triu = np.triu_indices(n_regions, 1)
+    state = aggregate['groups'][group]
+
+    def to_matrix(values, diagonal=0):
+        matrix = np.full((n_regions, n_regions), diagonal, dtype=float)
+        matrix[triu] = values
+        matrix[triu[1], triu[0]] = values
+        return pd.DataFrame(matrix, index=regions, columns=regions)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = np.where(state['n'] > 1, state['M2'] / (state['n'] - 1), np.nan)
+
+    summary = {'n': to_matrix(state['n']), 'mean': to_matrix(np.where(state['n'] > 0, state['mean'], np.nan)), \
+                'variance': to_matrix(variance), 'std': to_matrix(np.sqrt(variance))}
+
+    low, high = aggregate['value_range']
+    bin_width = (high - low) / aggregate['n_bins']
+    cumulative = np.cumsum(state['histogram'], axis=1)
+
+    for q in quantiles:
+        #Find the bin containing the q-th value of each edge, then interpolate linearly within it.
+        target = q * state['n']
+        bin_idx = np.minimum((cumulative < target[:,None]).sum(axis=1), aggregate['n_bins'] - 1)
+        below = np.where(bin_idx > 0, cumulative[np.arange(len(bin_idx)), np.maximum(bin_idx - 1, 0)], 0)
+        in_bin = state['histogram'][np.arange(len(bin_idx)), bin_idx]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip(np.where(in_bin > 0, (target - below) / in_bin, 0), 0, 1)
+
+        summary[q] = to_matrix(np.where(state['n'] > 0, low + (bin_idx + fraction) * bin_width, np.nan))
+
+    return summary
+
+def save_MIND_aggregate(aggregate, path):
+
+    #Aggregates are plain dicts of arrays, so they can be saved to combine them later (e.g. from different nodes).
+    with open(path, 'wb') as f:
+        pickle.dump(aggregate, f)
+
+def load_MIND_aggregate(path):
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -1,8 +1,8 @@
 from scipy.spatial import cKDTree as KDTree
+import time
+import hashlib
 import numpy as np
-import pandas as pd
-from scipy import stats
-from collections import defaultdict
+from MIND_profiler import profile_stage, add_profile_count, set_profile_regions, record_pair_time, is_profiling
 
 def is_outlier(points, thresh=7): #taken from https://stackoverflow.com/questions/22354094/pythonic-way-of-detecting-outliers-in-one-dimensional-observation-data
 
@@ -38,6 +38,54 @@ def is_outlier(points, thresh=7): #taken from https://stackoverflow.com/question
 
     return modified_z_score > thresh
 
+def _mix_hashes(x):
+
+    #splitmix64 finalizer: a bijection of 64-bit words that spreads every input bit over the whole output.
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+def get_unique_fraction(values):
+
+    '''
+    Fraction of the rows of values that are distinct, i.e. len(np.unique(values, axis=0)) / len(values), without sorting whole rows:
+    each row is reduced to a 64-bit hash of its values and only the hashes are sorted. With one feature this is exact. With several,
+    two different rows could in principle share a hash (with a chance of about 1e-9 for a whole brain), making the fraction very slightly low.
+    '''
+
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:,None]
+
+    if values.dtype.itemsize not in [4, 8]:
+        return len(np.unique(values, axis=0))/len(values)
+
+    word_type = np.uint64 if values.dtype.itemsize == 8 else np.uint32
+    hashes = np.zeros(len(values), dtype=np.uint64)
+
+    for i in range(values.shape[1]):
+        #Adding 0.0 turns -0.0 into 0.0, which np.unique counts as the same value.
+        column = np.ascontiguousarray(values[:,i] + values.dtype.type(0))
+        hashes ^= column.view(word_type).astype(np.uint64, copy=False)
+        hashes = _mix_hashes(hashes)
+
+    #Count the distinct hashes by sorting them in place, which is faster than np.unique.
+    hashes.sort()
+    return (1 + np.count_nonzero(hashes[1:] != hashes[:-1]))/len(values)
+
+def check_repeated_values(values, max_duplicate_rate=0.2):
+
+    #Raises an exception if more than max_duplicate_rate of the rows of values repeat another row. Returns the fraction of distinct rows.
+    unique_fraction = get_unique_fraction(values)
+
+    if unique_fraction < 1 - max_duplicate_rate:
+        raise Exception("There are many repeated values in the data, which compromises the validity of MIND calculation. Please minimize the number of repeated values in the data and try again. If you are using only one feature, try rerunning with resample=True.")
+
+    return unique_fraction
+
 def get_KDTree(x): #Inspired by https://gist.github.com/atabakd/ed0f7581f8510c8587bc2f41a094b518
 
     # Check the dimensions are consistent
@@ -48,26 +96,18 @@ def get_KDTree(x): #Inspired by https://gist.github.com/atabakd/ed0f7581f8510c85
     
     return xtree
 
-def get_KL(x, y, xtree, ytree): #Inspired by https://gist.github.com/atabakd/ed0f7581f8510c8587bc2f41a094b518
+def get_self_distances(x, xtree):
 
-    
-    x = np.atleast_2d(x)
-    y = np.atleast_2d(y)
-    
+    #Distance from each sample to its nearest neighbour within its own sample (the closest point, k=1, is the sample itself).
+    #This only depends on the region itself, so it can be computed once per region and reused for every partner region.
     x = np.atleast_2d(x)
-    y = np.atleast_2d(y)
 
-    n,d = x.shape
-    m,dy = y.shape
-    
-    #Check dimensions
-    assert(d == dy)
+    return xtree.query(x, k=2, eps=.01, p=2)[0][:,1]
+
+def get_KL_from_distances(r, s, d, m): #Inspired by https://gist.github.com/atabakd/ed0f7581f8510c8587bc2f41a094b518
+
+    n = len(r)
 
-    # Get the first two nearest neighbours for x, since the closest one is the
-    # sample itself.
-    r = xtree.query(x, k=2, eps=.01, p=2)[0][:,1]
-    s = ytree.query(x, k=1, eps=.01, p=2)[0]
-    
     rs_ratio = r/s
 
     #Remove points with zero, nan, or infinity. This happens when two regions have a vertex with the exact same value – an occurence that basically onnly happens for the single feature MSNs
@@ -83,67 +123,530 @@ def get_KL(x, y, xtree, ytree): #Inspired by https://gist.github.com/atabakd/ed0
     
     return kl
 
+def get_KL(x, y, xtree, ytree): #Inspired by https://gist.github.com/atabakd/ed0f7581f8510c8587bc2f41a094b518
 
-def calculate_mind_network(data_df, feature_cols, region_list, resample=False, n_samples = 4000):
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
 
-    MIND = pd.DataFrame(np.zeros((len(region_list), len(region_list))), \
-                        index = region_list, columns = region_list)
+    n,d = x.shape
+    m,dy = y.shape
+    
+    #Check dimensions
+    assert(d == dy)
 
-    #Get only desired regions
-    data_df = data_df.loc[data_df['Label'].isin(region_list)]
+    # Get the first two nearest neighbours for x, since the closest one is the
+    # sample itself.
+    r = get_self_distances(x, xtree)
+    s = ytree.query(x, k=1, eps=.01, p=2)[0]
     
-    #Resample dataset if resample has been set to True and if it is UNIVARIATE ONLY. This should only be done if you are using a single feature which contains repeated values.
-    if (len(feature_cols) == 1) and resample==True:   
-        n_samples = n_samples
-        resampled_dataset = pd.DataFrame(np.zeros((n_samples, len(region_list))), columns = region_list)
+    return get_KL_from_distances(r, s, d, m)
+
+def get_region_blocks(values, labels, region_list, columns=None):
+
+    '''
+    Groups vertices into contiguous blocks, one per region, in the order given by region_list.
+
+    values: n_vertices X n_features array.
+    labels: n_vertices array of region labels (strings or integer codes). Vertices whose label is not in region_list are dropped.
+    region_list: the regions to keep, in output order.
+    columns: optional indices of the feature columns to keep. Only these columns are gathered into the blocks, so a few features of a
+    large shared array can be used without copying the whole array first.
+
+    Returns the sorted values array and an offsets array of length len(region_list) + 1, such that the vertices of region_list[i]
+    are values[offsets[i]:offsets[i+1]]. Within a region, vertices keep their original order.
+    '''
+
+    if len(region_list) == 0:
+        raise Exception('No regions given: region_list is empty, so there is nothing to compute MIND between.')
+
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:,None]
+
+    labels = np.asarray(labels)
+    region_list = np.asarray(region_list)
+
+    #Map each label to its position in region_list.
+    region_order = np.argsort(region_list, kind='stable')
+    sorted_regions = region_list[region_order]
+    positions = np.clip(np.searchsorted(sorted_regions, labels), 0, len(region_list) - 1)
+    keep = sorted_regions[positions] == labels
+    codes = region_order[positions[keep]]
+
+    order = np.flatnonzero(keep)[np.argsort(codes, kind='stable')]
+    counts = np.bincount(codes, minlength=len(region_list))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    if columns is not None:
+        return values[np.ix_(order, columns)], offsets
+
+    return values[order], offsets
+
+def sort_region_blocks_1d(values, offsets):
+
+    #Sorts a single feature column within each region block, keeping the blocks in place.
+    codes = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    order = np.lexsort((values[:,0], codes))
+
+    return values[order]
+
+def get_self_distances_1d(x, offsets):
+
+    #Exact nearest neighbour distance within each region for a single feature, where x is sorted within each block (see sort_region_blocks_1d).
+    #The nearest neighbour of a sorted value is always one of its two neighbours in the sorted order.
+    gaps = np.diff(x)
+
+    boundaries = offsets[1:-1]
+    boundaries = boundaries[(boundaries > 0) & (boundaries < len(x))]
+    gaps[boundaries - 1] = np.inf
+
+    left = np.concatenate(([np.inf], gaps))
+    right = np.concatenate((gaps, [np.inf]))
+
+    return np.minimum(left, right)
+
+def get_nearest_distances_1d(x, y):
+
+    #Exact distance from every value in x to its nearest neighbour in the sorted array y.
+    idx = np.searchsorted(y, x)
+
+    left = np.where(idx > 0, x - y[np.maximum(idx - 1, 0)], np.inf)
+    right = np.where(idx < len(y), y[np.minimum(idx, len(y) - 1)] - x, np.inf)
+
+    return np.minimum(left, right)
+
+def get_KL_matrix(values, offsets, n_jobs=1):
+
+    '''
+    Directed KL divergence estimates between every pair of regions, computed in one batched pass.
+
+    Instead of querying each region against each other region separately, all vertices are queried against each region's KD-tree
+    in a single call (using n_jobs cores), and the log(r/s) terms are summed per source region with a segmented reduction over the
+    label-sorted vertex array. This gives R large tree queries instead of R^2 small ones.
+
+    With a single feature, no trees are built at all: nearest neighbour distances are computed exactly from sorted arrays with np.searchsorted.
+
+    Accuracy: with several features, the result equals the pairwise get_KL up to floating point summation order (about 1e-16), as both run the
+    same approximate KD-tree queries (eps=.01, i.e. neighbours within 1% of the true nearest distance). The single feature engine is exact, so
+    it can differ slightly from the tree-based estimate (around 1e-5 on real data), and is the more accurate of the two.
+
+    Returns a square ndarray with entry [i,j] equal to get_KL(region i, region j). Rows and columns of empty regions, and the diagonal, are zero.
+    '''
+
+    n_regions = len(offsets) - 1
+    d = values.shape[1]
+    counts = np.diff(offsets)
+
+    present = np.flatnonzero(counts > 0)
+    n = counts[present].astype(float)
+
+    with profile_stage('tree_building'):
+        if d == 1:
+            x = sort_region_blocks_1d(values, offsets)[:,0].astype(float)
+            r = get_self_distances_1d(x, offsets)
+            get_distances = lambda j: get_nearest_distances_1d(x, x[offsets[j]:offsets[j+1]])
+
+        else:
+            #cKDTree works in float64, so convert once here rather than on every query.
+            values = np.asarray(values, dtype=float)
+            KDtrees = {i: get_KDTree(values[offsets[i]:offsets[i+1]]) for i in present}
+            r = np.concatenate([get_self_distances(values[offsets[i]:offsets[i+1]], KDtrees[i]) for i in present])
+            get_distances = lambda j: KDtrees[j].query(values, k=1, eps=.01, p=2, workers=n_jobs)[0]
+
+    #One self-distance query and one batched query per region.
+    add_profile_count('tree_queries', 2 * len(present))
+
+    KL = np.zeros((n_regions, n_regions))
+
+    with profile_stage('batched_KL'):
+        for j in present:
+            s = get_distances(j)
+
+            #Same filtering of zero, nan and infinite ratios as in get_KL_from_distances.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rs_ratio = r/s
+                valid = np.isfinite(rs_ratio) & (rs_ratio != 0.0)
+                log_ratio = np.log(np.where(valid, rs_ratio, 1.0))
+
+            log_sums = np.add.reduceat(log_ratio, offsets[present])
+
+            with np.errstate(divide='ignore'):
+                KL[present, j] = -log_sums * d / n + np.log(counts[j] / (n - 1.))
+
+    KL[present, present] = 0
+    KL = np.maximum(KL, 0)
+
+    return KL
+
+def resample_region_blocks(values, offsets, n_samples = 4000, random_state=None):
+
+    '''
+    Draws n_samples values per region from a Gaussian kernel density estimate of that region's (single feature) distribution.
+
+    This is the same estimate as stats.gaussian_kde(region_values).resample(n_samples) with the default Scott bandwidth,
+    but done for all regions at once: pick a random vertex from the region and add Gaussian noise with the region's bandwidth.
+    Returns the resampled values and offsets, with empty regions left empty.
+    '''
+
+    rng = np.random.default_rng(random_state)
+
+    x = values[:,0]
+    counts = np.diff(offsets)
+    present = np.flatnonzero(counts > 0)
+    n = counts[present]
+
+    means = np.add.reduceat(x, offsets[present]) / n
+    squares = np.add.reduceat((x - np.repeat(means, n))**2, offsets[present])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bandwidth = np.sqrt(squares / (n - 1)) * n**(-1/5)
+    bandwidth = np.nan_to_num(bandwidth)
+
+    idx = offsets[present][:,None] + np.floor(rng.random((len(present), n_samples)) * n[:,None]).astype(int)
+    resampled = x[idx] + rng.standard_normal((len(present), n_samples)) * bandwidth[:,None]
+
+    new_counts = np.zeros(len(counts), dtype=int)
+    new_counts[present] = n_samples
+    new_offsets = np.concatenate(([0], np.cumsum(new_counts)))
+
+    return resampled.reshape(-1, 1), new_offsets
 
-        for name, data in data_df.groupby('Label'):
-            resampled_dataset[name] = stats.gaussian_kde(data[feature_cols[0]]).resample(n_samples)[0]
+def build_region_trees(values, offsets, regions, cache=None):
 
-        resampled_dataset = resampled_dataset.melt(var_name = 'Label', value_name = feature_cols[0])
-        data_df = resampled_dataset
+    '''
+    Builds the KD-tree (or, for a single feature, the sorted block) and self-neighbour distances of each region in regions that is not in cache yet,
+    on vertices grouped with get_region_blocks. Returns the cache dict, with 'trees' and 'self_distances' keyed by region index.
+    '''
 
-    if (len(feature_cols) > 1) and resample==True:   
+    if cache is None:
+        cache = {}
+    trees = cache.setdefault('trees', {})
+    self_distances = cache.setdefault('self_distances', {})
+
+    new_regions = [i for i in regions if i not in self_distances]
+
+    with profile_stage('tree_building'):
+        for i in new_regions:
+            block = values[offsets[i]:offsets[i+1]]
+
+            if values.shape[1] == 1:
+                #Exact univariate engine: keep the block sorted instead of building a tree.
+                trees[i] = np.sort(np.asarray(block[:,0], dtype=float))
+                self_distances[i] = get_self_distances_1d(trees[i], np.array([0, len(trees[i])]))
+            else:
+                trees[i] = get_KDTree(block)
+                self_distances[i] = get_self_distances(block, trees[i])
+
+    add_profile_count('tree_queries', len(new_regions))
+
+    return cache
+
+def calculate_mind_pairs(values, offsets, pairs, n_jobs=1, cache=None):
+
+    '''
+    MIND values for a given list of (i, j) region index pairs only, on vertices grouped with get_region_blocks.
+    Returns an array with one value per pair.
+
+    KD-trees (or, for a single feature, sorted blocks) and self-neighbour distances are only built for regions that appear in pairs,
+    once per region (see build_region_trees). If a cache dict is given, they are stored in it and reused on later calls with the same regions.
+    '''
+
+    d = values.shape[1]
+
+    cache = build_region_trees(values, offsets, np.unique(np.asarray(pairs, dtype=int)), cache=cache)
+    trees = cache['trees']
+    self_distances = cache['self_distances']
+
+    def get_nearest_distances(i, j):
+        if d == 1:
+            return get_nearest_distances_1d(trees[i], trees[j])
+        return trees[j].query(values[offsets[i]:offsets[i+1]], k=1, eps=.01, p=2, workers=n_jobs)[0]
+
+    MIND = np.zeros(len(pairs))
+
+    #Only time individual pairs when profiling, to find the slowest ones.
+    profiling = is_profiling()
+
+    with profile_stage('pairwise_KL'):
+        for k, (i, j) in enumerate(pairs):
+            if profiling:
+                start = time.perf_counter()
+
+            KLa = get_KL_from_distances(self_distances[i], get_nearest_distances(i, j), d, offsets[j+1] - offsets[j])
+            KLb = get_KL_from_distances(self_distances[j], get_nearest_distances(j, i), d, offsets[i+1] - offsets[i])
+
+            kl = KLa + KLb
+
+            MIND[k] = 1/(1+kl)
+
+            if profiling:
+                record_pair_time(i, j, time.perf_counter() - start)
+
+    add_profile_count('tree_queries', 2 * len(pairs))
+
+    return MIND
+
+def calculate_mind_from_blocks(values, offsets, query_mode='pairwise', n_jobs=1):
+
+    '''
+    Core MIND computation on vertices already grouped with get_region_blocks.
+    Returns a len(offsets) - 1 square ndarray. Regions without any vertices are left as zero, as is the diagonal.
+
+    query_mode: 'pairwise' queries each pair of regions separately. 'batched' uses get_KL_matrix, which queries all vertices
+    against each region's tree at once and can use several cores (n_jobs). Both give the same result up to floating point summation order.
+    With a single feature, the exact univariate engine in get_KL_matrix is always used (see there for how it compares to the approximate trees).
+    '''
+
+    n_regions = len(offsets) - 1
+    d = values.shape[1]
+
+    if (query_mode == 'batched') or (d == 1):
+        KL = get_KL_matrix(values, offsets, n_jobs=n_jobs)
+        present = np.flatnonzero(np.diff(offsets) > 0)
+
+        MIND = np.zeros((n_regions, n_regions))
+        MIND[np.ix_(present, present)] = 1/(1 + (KL + KL.T)[np.ix_(present, present)])
+        MIND[np.diag_indices(n_regions)] = 0
+
+        return MIND
+
+    elif query_mode != 'pairwise':
+        raise Exception('Unrecognized query_mode: ' + str(query_mode) + ". Must be either 'pairwise' or 'batched'.")
+
+    MIND = np.zeros((n_regions, n_regions))
+
+    #Only the upper triangle of pairs between regions that have vertices.
+    present = [i for i in range(n_regions) if offsets[i+1] > offsets[i]]
+    pairs = [(i, j) for a, i in enumerate(present) for j in present[a+1:]]
+
+    if len(pairs) > 0:
+        rows, cols = np.array(pairs).T
+        MIND[rows, cols] = MIND[cols, rows] = calculate_mind_pairs(values, offsets, pairs, n_jobs=n_jobs)
+
+    return MIND
+
+
+def get_block_fingerprints(values, offsets):
+
+    #Content hash of each region's block of vertices, used to tell which regions changed since a previous run.
+    return [hashlib.sha1(np.ascontiguousarray(values[offsets[i]:offsets[i+1]], dtype=float).tobytes()).hexdigest() for i in range(len(offsets) - 1)]
+
+def calculate_mind_incremental(values, offsets, region_list, previous=None, n_jobs=1):
+
+    '''
+    MIND on vertices grouped with get_region_blocks, reusing a previous result where possible.
+
+    previous is the state returned by an earlier call (or None). Regions whose block of vertices has the same content hash as before keep
+    their previous MIND values with each other, and their KD-trees and self-neighbour distances are reused. Only the rows and columns of
+    regions that changed (or are new) are recomputed, pairwise, so the result is the same as a full pairwise recomputation.
+
+    Returns (MIND, state), where state can be passed as previous to the next call. It holds the region order, fingerprints, MIND network
+    and the cached trees, so it takes about as much memory as the vertex data.
+    '''
+
+    n_regions = len(offsets) - 1
+    d = values.shape[1]
+
+    fingerprints = get_block_fingerprints(values, offsets)
+    present = [i for i in range(n_regions) if offsets[i+1] > offsets[i]]
+
+    MIND = np.zeros((n_regions, n_regions))
+    cache = {'trees': {}, 'self_distances': {}}
+    unchanged = []
+
+    if (previous is not None) and (previous['n_features'] == d):
+        previous_idx = dict(zip(previous['regions'], range(len(previous['regions']))))
+        unchanged = [i for i in present if (region_list[i] in previous_idx) and (previous['fingerprints'][previous_idx[region_list[i]]] == fingerprints[i])]
+        old = [previous_idx[region_list[i]] for i in unchanged]
+
+        unchanged_idx = np.array(unchanged, dtype=int)
+
+        MIND[np.ix_(unchanged_idx, unchanged_idx)] = previous['MIND'][np.ix_(np.array(old, dtype=int), np.array(old, dtype=int))]
+
+        #Carry over the trees of unchanged regions, under their index in the new region_list.
+        for i, j in zip(unchanged, old):
+            if j in previous['cache']['self_distances']:
+                cache['trees'][i] = previous['cache']['trees'][j]
+                cache['self_distances'][i] = previous['cache']['self_distances'][j]
+
+    changed = set(present) - set(unchanged)
+    pairs = [(i, j) for a, i in enumerate(present) for j in present[a+1:] if (i in changed) or (j in changed)]
+
+    if len(pairs) > 0:
+        rows, cols = np.array(pairs).T
+        MIND[rows, cols] = MIND[cols, rows] = calculate_mind_pairs(values, offsets, pairs, n_jobs=n_jobs, cache=cache)
+
+    state = {'regions': list(region_list), 'fingerprints': fingerprints, 'n_features': d, 'MIND': MIND.copy(), 'cache': cache}
+
+    return MIND, state
+
+def subsample_region_blocks(values, offsets, max_vertices_per_region, random_state=None):
+
+    '''
+    Randomly keeps at most max_vertices_per_region vertices from each region block (without replacement, keeping their original order).
+    Returns the subsampled values and offsets. Because get_KL uses the sizes of the samples it is given, the log(m/(n-1)) term
+    automatically uses the subsampled sizes.
+    '''
+
+    rng = np.random.default_rng(random_state)
+
+    keep = []
+    for i in range(len(offsets) - 1):
+        idx = np.arange(offsets[i], offsets[i+1])
+        if len(idx) > max_vertices_per_region:
+            idx = np.sort(rng.choice(idx, max_vertices_per_region, replace=False))
+        keep.append(idx)
+
+    counts = np.array([len(x) for x in keep])
+    new_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    return values[np.concatenate(keep)], new_offsets
+
+def estimate_subsampling_error(values, offsets, MIND, max_vertices_per_region, n_check_pairs=10, query_mode='pairwise', random_state=None):
+
+    '''
+    Estimates the error introduced by subsampling, by recomputing up to n_check_pairs randomly chosen region pairs on all of their vertices and
+    comparing them with the corresponding entries of the subsampled MIND network. Only pairs involving at least one subsampled region are checked,
+    since all other pairs are exact.
+
+    Returns a dict with the checked pairs (as indices), their exact and subsampled values, and the mean and max absolute error.
+    '''
+
+    rng = np.random.default_rng(random_state)
+
+    counts = np.diff(offsets)
+    present = np.flatnonzero(counts > 0)
+    subsampled = counts > max_vertices_per_region
+
+    candidate_pairs = [(i, j) for a, i in enumerate(present) for j in present[a+1:] if subsampled[i] or subsampled[j]]
+    if len(candidate_pairs) > n_check_pairs:
+        candidate_pairs = [candidate_pairs[k] for k in np.sort(rng.choice(len(candidate_pairs), n_check_pairs, replace=False))]
+
+    exact = []
+    for i, j in candidate_pairs:
+        pair_values = np.concatenate((values[offsets[i]:offsets[i+1]], values[offsets[j]:offsets[j+1]]))
+        pair_offsets = np.array([0, counts[i], counts[i] + counts[j]])
+        exact.append(calculate_mind_from_blocks(pair_values, pair_offsets, query_mode=query_mode)[0,1])
+
+    exact = np.array(exact)
+    approximate = np.array([MIND[i,j] for i, j in candidate_pairs])
+    errors = np.abs(approximate - exact)
+
+    return {'pairs': candidate_pairs, 'exact': exact, 'subsampled': approximate, \
+            'mean_abs_error': errors.mean() if len(errors) > 0 else 0.0, \
+            'max_abs_error': errors.max() if len(errors) > 0 else 0.0}
+
+#Seed of the max_vertices_per_region subsampling when no random_state is given, so subsampled networks are always reproducible.
+DEFAULT_SUBSAMPLE_SEED = 0
+
+def calculate_mind_array(values, labels, region_list, resample=False, n_samples = 4000, query_mode='pairwise', n_jobs=1, random_state=None, max_vertices_per_region=None, n_check_pairs=10, \
+                            previous=None, return_state=False, max_duplicate_rate=0.2, columns=None):
+
+    '''
+    Array version of calculate_mind_network. values is an n_vertices X n_features array (any float dtype), labels gives the region of each vertex
+    (names or integer codes) and region_list the regions to use, in the same form as labels. Returns a square ndarray in the order of region_list.
+    columns optionally selects the features (column indices of values) to use, see get_region_blocks.
+
+    If max_vertices_per_region is set, (MIND, diagnostics) is returned instead, where diagnostics is the output of estimate_subsampling_error.
+    If previous is given or return_state is True, the network is computed with calculate_mind_incremental and (MIND, state) is returned.
+    An exception is raised if more than max_duplicate_rate of the vertices repeat another vertex's values (None skips the check, e.g. if
+    MIND_qc.run_vertex_qc has already done it).
+    '''
+
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:,None]
+
+    n_features = values.shape[1] if columns is None else len(columns)
+
+    if (n_features > 1) and resample==True:   
         raise Exception("Resampling the data is only supported if you are using a single feature -- this is because higher order density estimation can be unreliable and very computationally expensive.")
 
+    #One generator shared by the resampling and subsampling steps below.
+    rng = np.random.default_rng(random_state)
+
+    #Group the vertices once into contiguous per-region blocks (dropping vertices outside region_list), then compute every region pair on plain arrays.
+    with profile_stage('region_blocks'):
+        values, offsets = get_region_blocks(values, labels, region_list, columns=columns)
+
+    #Integer region codes don't make useful names for the profiling report; callers using codes can set the names themselves.
+    if not np.issubdtype(np.asarray(region_list).dtype, np.integer):
+        set_profile_regions(region_list)
+    add_profile_count('regions', np.count_nonzero(np.diff(offsets)))
+
+    #Resample dataset if resample has been set to True and if it is UNIVARIATE ONLY. This should only be done if you are using a single feature which contains repeated values.
+    if (values.shape[1] == 1) and resample==True:
+        values, offsets = resample_region_blocks(values, offsets, n_samples = n_samples, random_state=rng)
+
     #Check that there aren't many repeated values
-    percent_unique_vals = len(data_df[feature_cols].drop_duplicates())/len(data_df[feature_cols])
-    
-    if percent_unique_vals < 0.8:
-        raise Exception("There are many repeated values in the data, which compromises the validity of MIND calculation. Please minimize the number of repeated values in the data and try again. If you are using only one feature, try rerunning with resample=True.")
+    if max_duplicate_rate is not None:
+        check_repeated_values(values, max_duplicate_rate)
 
-    grouped_data = data_df.groupby('Label')
+    if (previous is not None) or return_state:
+        if max_vertices_per_region is not None:
+            raise Exception('Incremental recomputation (previous, return_state) cannot be combined with max_vertices_per_region.')
+        return calculate_mind_incremental(values, offsets, region_list, previous=previous, n_jobs=n_jobs)
 
-    KDtrees = defaultdict(object)
+    if max_vertices_per_region is None:
+        return calculate_mind_from_blocks(values, offsets, query_mode=query_mode, n_jobs=n_jobs)
 
-    for i, (name_x, dat_x) in enumerate(grouped_data):
-        tree = get_KDTree(dat_x[feature_cols])
-        KDtrees[name_x] = tree
-    
-    used_pairs = []
-    
-    for i, (name_x, dat_x) in enumerate(grouped_data):
-        
-        for name_y, dat_y in grouped_data:
-            if name_x == name_y:
-                continue
+    #Cap the number of vertices per region before building any trees, using a seeded RNG so the subsample is reproducible.
+    #Without a random_state, a fixed seed is used, so the same data always gives the same network.
+    if random_state is None:
+        rng = np.random.default_rng(DEFAULT_SUBSAMPLE_SEED)
 
-            if set([name_x,name_y]) in used_pairs:
-                continue
+    sub_values, sub_offsets = subsample_region_blocks(values, offsets, max_vertices_per_region, random_state=rng)
+    MIND = calculate_mind_from_blocks(sub_values, sub_offsets, query_mode=query_mode, n_jobs=n_jobs)
 
-            dat_x = dat_x[feature_cols]
-            dat_y = dat_y[feature_cols]
+    diagnostics = estimate_subsampling_error(values, offsets, MIND, max_vertices_per_region, n_check_pairs=n_check_pairs, query_mode=query_mode, random_state=rng)
 
-            KLa = get_KL(dat_x, dat_y, KDtrees[name_x], KDtrees[name_y])
-            KLb = get_KL(dat_y, dat_x, KDtrees[name_y], KDtrees[name_x])
+    return MIND, diagnostics
 
-            kl = KLa + KLb
+def format_mind_output(MIND, region_list):
 
-            MIND.at[name_x,name_y] = 1/(1+kl)
-            MIND.at[name_y,name_x] = 1/(1+kl)
+    #Wraps the output of calculate_mind_array in a regions X regions DataFrame, naming the checked pairs if it came with subsampling diagnostics.
+    import pandas as pd
 
-            used_pairs.append(set([name_x,name_y]))
+    if type(MIND) is tuple:
+        MIND, diagnostics = MIND
+        diagnostics['pairs'] = [(str(region_list[i]), str(region_list[j])) for i, j in diagnostics['pairs']]
+        return pd.DataFrame(MIND, index = region_list, columns = region_list), diagnostics
 
-    MIND = MIND[region_list].T[region_list].T
-    
-    return MIND
\ No newline at end of file
+    return pd.DataFrame(MIND, index = region_list, columns = region_list)
+
+def calculate_mind_network(data_df, feature_cols, region_list, resample=False, n_samples = 4000, query_mode='pairwise', n_jobs=1, random_state=None, max_vertices_per_region=None, n_check_pairs=10, \
+                            previous=None, return_state=False, max_duplicate_rate=0.2):
+
+    '''
+    Computes the MIND network between the regions in region_list from the vertex-level data in data_df (a 'Label' column plus the feature_cols).
+
+    query_mode and n_jobs control how the nearest neighbour queries are run (see calculate_mind_from_blocks).
+    query_mode='batched' issues one query of all vertices per region, using n_jobs cores, which is much faster for parcellations with many regions.
+    With a single feature, an exact sorted-array engine is used automatically instead of KD-trees.
+
+    random_state seeds the resampling used when resample=True, and the subsampling below. The subsampling is always seeded: without a
+    random_state it uses DEFAULT_SUBSAMPLE_SEED, so repeated calls on the same data give identical networks.
+
+    max_vertices_per_region: if set, regions with more vertices than this are randomly subsampled down to it before building the trees,
+    which makes high resolution surfaces much cheaper. In that case (MIND, diagnostics) is returned, where diagnostics estimates the
+    approximation error by recomputing n_check_pairs random region pairs on all of their vertices (see estimate_subsampling_error).
+
+    previous / return_state: for re-running after only some regions changed (e.g. after FreeSurfer edits or a patched parcellation).
+    With return_state=True, (MIND, state) is returned. Passing that state as previous on a later call only recomputes the rows and columns
+    of regions whose vertex values changed, and gives the same network as a full (pairwise) recomputation. Regions are compared on the
+    values in data_df, so if the features were standardized across the whole brain, any change to the global mean or SD counts as every
+    region changing.
+
+    max_duplicate_rate: maximum fraction of vertices whose values repeat another vertex's (see calculate_mind_array).
+    '''
+
+    MIND = calculate_mind_array(data_df[feature_cols].to_numpy(dtype=float), data_df['Label'].to_numpy(), region_list, \
+                        resample=resample, n_samples=n_samples, query_mode=query_mode, n_jobs=n_jobs, random_state=random_state, \
+                        max_vertices_per_region=max_vertices_per_region, n_check_pairs=n_check_pairs, previous=previous, return_state=return_state, \
+                        max_duplicate_rate=max_duplicate_rate)
+
+    if (previous is not None) or return_state:
+        MIND, state = MIND
+        return format_mind_output(MIND, region_list), state
+
+    return format_mind_output(MIND, region_list)
@@ -0,0 +1,209 @@
+'''
+Null models for testing the significance of MIND edges.
+
+Surrogate networks are computed by reassigning vertices to regions, either by randomly permuting the region labels across vertices
+(which keeps the size of every region) or by randomly rotating the parcellation on the FreeSurfer sphere ("spin test", which also keeps
+its spatial contiguity). The standardized vertex data is loaded once and reused for every surrogate. Per-edge statistics are accumulated
+as surrogates are computed, so memory does not grow with the number of surrogates.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from scipy.spatial import cKDTree as KDTree
+from MIND_helpers import calculate_mind_array, calculate_mind_from_blocks, get_region_blocks
+
+#Shared data for the worker processes, set once per worker by _init_null_worker.
+_null_data = None
+
+def _init_null_worker(data):
+    global _null_data
+    _null_data = data
+
+def get_random_rotation(rng):
+
+    #Uniformly distributed random 3D rotation matrix, from the QR decomposition of a Gaussian matrix.
+    q, r = np.linalg.qr(rng.standard_normal((3, 3)))
+    q = q * np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:,0] = -q[:,0]
+
+    return q
+
+def get_spun_codes(codes, sphere_coords, rng):
+
+    '''
+    Rotates the region codes of each hemisphere on its sphere. The right hemisphere uses the mirror image of the left rotation, so both
+    hemispheres are spun symmetrically. Each vertex gets the code of the vertex that is rotated closest to it.
+    '''
+
+    rotation = get_random_rotation(rng)
+    mirror = np.diag([-1, 1, 1])
+
+    spun_codes = []
+    start = 0
+    for hemi_rotation, coords in zip([rotation, mirror @ rotation @ mirror], sphere_coords):
+        hemi_codes = codes[start:start + len(coords)]
+        nearest = KDTree(coords @ hemi_rotation.T).query(coords, k=1)[1]
+        spun_codes.append(hemi_codes[nearest])
+        start += len(coords)
+
+    return np.concatenate(spun_codes)
+
+def get_surrogate_codes(data, rng):
+
+    #Region code of every (valid) vertex for one surrogate network.
+    if data['method'] == 'permute':
+        return rng.permutation(data['codes'][data['valid']])
+
+    elif data['method'] == 'spin':
+        return get_spun_codes(data['codes'], data['sphere_coords'], rng)[data['valid']]
+
+def _compute_null_chunk(seeds, observed, store_nulls):
+
+    #Computes the surrogates for a chunk of seeds, returning the per-edge summaries (and, if store_nulls, the upper triangles of the surrogates).
+    data = _null_data
+    n_regions = len(observed)
+    triu = np.triu_indices(n_regions, 1)
+
+    summary = {'n': 0, 'n_greater': np.zeros((n_regions, n_regions), dtype=np.int64), 'n_less': np.zeros((n_regions, n_regions), dtype=np.int64), \
+                'sum': np.zeros((n_regions, n_regions)), 'sum_squares': np.zeros((n_regions, n_regions))}
+    nulls = []
+
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        codes = get_surrogate_codes(data, rng)
+
+        values, offsets = get_region_blocks(data['values'], codes, np.arange(n_regions))
+        MIND = calculate_mind_from_blocks(values, offsets, query_mode=data['query_mode'])
+
+        summary['n'] += 1
+        summary['n_greater'] += MIND >= observed
+        summary['n_less'] += MIND <= observed
+        summary['sum'] += MIND
+        summary['sum_squares'] += MIND**2
+
+        if store_nulls:
+            nulls.append(MIND[triu].astype(np.float32))
+
+    return seeds, summary, nulls
+
+def load_null_data(surf_dir, features, parcellation, method='permute', filter_vertices=False, query_mode='pairwise', max_duplicate_rate=0.2):
+
+    '''
+    Loads the vertex data for compute_MIND_nulls with get_surface_vertex_data, keeping every vertex (in surface order) so that labels can be spun.
+    '''
+
+    from nibabel.freesurfer.io import read_geometry
+    from get_vertex_df import get_surface_vertex_data
+
+    data = get_surface_vertex_data(surf_dir, features, parcellation, filter_vertices=filter_vertices, max_duplicate_rate=max_duplicate_rate)
+
+    data['sphere_coords'] = []
+    if method == 'spin':
+        data['sphere_coords'] = [read_geometry(surf_dir + '/surf/' + hemi + '.sphere')[0] for hemi in ['lh','rh']]
+
+        #get_spun_codes splits the codes by the sphere sizes, so a sphere from another surface would silently misalign the hemispheres.
+        for hemi, coords, size in zip(['lh','rh'], data['sphere_coords'], data['hemi_sizes']):
+            if len(coords) != size:
+                raise Exception('The ' + hemi + '.sphere surface has ' + str(len(coords)) + ' vertices, but the ' + hemi + ' surface features have ' \
+                                + str(size) + '. It must be the sphere of the same surface as the features.')
+
+    data['method'] = method
+    data['query_mode'] = query_mode
+
+    return data
+
+def compute_MIND_nulls(surf_dir, features, parcellation, n_surrogates = 1000, method='permute', n_workers=None, chunk_size=10, filter_vertices=False, \
+                        query_mode='pairwise', random_state=None, null_file=None, callback=None, max_duplicate_rate=0.2):
+
+    '''
+    Tests the significance of every edge of a subject's MIND network against surrogate networks.
+
+    • surf_dir, features, parcellation, filter_vertices, query_mode, max_duplicate_rate: as for compute_MIND.
+    • n_surrogates (int): number of surrogate networks.
+    • method (str): 'permute' randomly permutes the region labels across vertices. 'spin' randomly rotates the parcellation on the sphere
+    (the surf_dir/surf/?h.sphere files must exist, for the same surface as the features), which keeps the spatial structure of the regions.
+    • n_workers (int): number of worker processes. n_workers=1 runs everything in the current process.
+    • chunk_size (int): number of surrogates per task sent to a worker.
+    • random_state: seed. Every surrogate gets its own seed derived from it, so results don't depend on n_workers or chunk_size.
+    • null_file (str): optional path of a .npy file to write the full null distribution to, as an n_surrogates X n_edges float32 array of
+    upper triangles (in np.triu_indices order). It is written as surrogates finish, so it never has to fit in memory.
+    • callback (function): optional function called as callback(n_done, partial_results) every time a chunk of surrogates finishes, where
+    partial_results has the same form as the output below, computed from the surrogates so far.
+
+    Returns a dict with:
+    • 'MIND': the observed MIND network.
+    • 'p_greater', 'p_less': one-sided permutation p-values per edge, (1 + number of surrogates at least as extreme) / (1 + n_surrogates).
+    • 'null_mean', 'null_std': mean and standard deviation of the surrogate networks.
+    • 'n_surrogates': number of surrogates used.
+    '''
+
+    data = load_null_data(surf_dir, features, parcellation, method=method, filter_vertices=filter_vertices, query_mode=query_mode, \
+                            max_duplicate_rate=max_duplicate_rate)
+    regions = data['regions']
+    n_regions = len(regions)
+
+    observed = calculate_mind_array(data['values'], data['codes'][data['valid']], np.arange(n_regions), query_mode=query_mode)
+
+    seeds = np.random.SeedSequence(random_state).spawn(n_surrogates)
+    chunks = [seeds[i:i + chunk_size] for i in range(0, n_surrogates, chunk_size)]
+    seed_positions = dict(zip([x.spawn_key for x in seeds], range(n_surrogates)))
+
+    if null_file is not None:
+        nulls = np.lib.format.open_memmap(null_file, mode='w+', dtype=np.float32, shape=(n_surrogates, n_regions * (n_regions - 1) // 2))
+
+    total = {'n': 0, 'n_greater': np.zeros((n_regions, n_regions), dtype=np.int64), 'n_less': np.zeros((n_regions, n_regions), dtype=np.int64), \
+            'sum': np.zeros((n_regions, n_regions)), 'sum_squares': np.zeros((n_regions, n_regions))}
+
+    def summarize(total):
+        n = total['n']
+        mean = total['sum'] / max(n, 1)
+        std = np.sqrt(np.maximum(total['sum_squares'] / max(n, 1) - mean**2, 0) * n / max(n - 1, 1))
+        return {'MIND': pd.DataFrame(observed, index = regions, columns = regions), \
+                'p_greater': pd.DataFrame((1 + total['n_greater']) / (1 + n), index = regions, columns = regions), \
+                'p_less': pd.DataFrame((1 + total['n_less']) / (1 + n), index = regions, columns = regions), \
+                'null_mean': pd.DataFrame(mean, index = regions, columns = regions), \
+                'null_std': pd.DataFrame(std, index = regions, columns = regions), \
+                'n_surrogates': n}
+
+    def add_chunk(chunk_seeds, summary, chunk_nulls):
+        for key in total.keys():
+            total[key] = total[key] + summary[key]
+
+        if null_file is not None:
+            for seed, null in zip(chunk_seeds, chunk_nulls):
+                nulls[seed_positions[seed.spawn_key]] = null
+
+        if callback is not None:
+            callback(total['n'], summarize(total))
+
+    if n_workers == 1:
+        _init_null_worker(data)
+        for chunk in chunks:
+            add_chunk(*_compute_null_chunk(chunk, observed, null_file is not None))
+
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_null_worker, initargs=(data,)) as pool:
+
+            #Only keep a few chunks in flight at a time, so finished results don't pile up in memory.
+            max_pending = 2 * (n_workers if n_workers is not None else os.cpu_count())
+            pending = set()
+            chunks = iter(chunks)
+
+            for chunk in chunks:
+                pending.add(pool.submit(_compute_null_chunk, chunk, observed, null_file is not None))
+
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add_chunk(*future.result())
+
+            for future in wait(pending)[0]:
+                add_chunk(*future.result())
+
+    if null_file is not None:
+        nulls.flush()
+
+    return summarize(total)
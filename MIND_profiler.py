@@ -0,0 +1,204 @@
+'''
+Progress reporting and profiling for MIND computations.
+
+Messages go through the 'MIND' logger at level INFO (it writes to stdout if no logging handlers have been configured), at one of three
+verbosities, set with set_verbosity:
+    • 'silent': nothing is reported and nothing is measured.
+    • 'summary': one line per subject, with the total time, time per stage, vertex / region counts, KD-tree queries and peak memory.
+    • 'detailed': progress messages (files loaded, stages finished) as they happen, followed by the summary and the slowest region pairs.
+
+A callback can also be set, which receives the full report (a dict) for every subject, e.g. to collect timings in a job database.
+When the verbosity is 'silent' and no callback is set, all the hooks below return immediately, so they add no measurable overhead.
+
+The 'MIND' logger has its own level (INFO, unless the application set one before importing this module), so the reports still get
+through to the application's handlers when the root logger is set to WARNING. To hide them there, use set_verbosity('silent') or
+logging.getLogger('MIND').setLevel(logging.WARNING).
+
+Subjects are profiled per thread: each thread computing a subject (e.g. an application running compute_MIND in several threads) gets its
+own report, and the hooks only record into the report of the thread calling them, so concurrent subjects and worker threads (such as
+those of compute_MIND_sweep) never mix their timings.
+'''
+
+import sys
+import time
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, where peak memory is not reported.
+    resource = None
+
+logger = logging.getLogger('MIND')
+if logger.level == logging.NOTSET:
+    logger.setLevel(logging.INFO)
+
+_settings = {'verbosity': 'summary', 'callback': None, 'n_slowest_pairs': 10}
+
+#Report of the subject currently being profiled in each thread (_thread.profile), or None.
+_thread = threading.local()
+
+def _get_profile():
+    return getattr(_thread, 'profile', None)
+
+def set_verbosity(verbosity = 'summary', callback = None, n_slowest_pairs = 10):
+
+    '''
+    Sets how MIND computations are reported (see above). verbosity is 'silent', 'summary' or 'detailed'.
+    callback (function): optional function called as callback(report) at the end of every subject, whatever the verbosity.
+    n_slowest_pairs (int): number of slowest region pairs to keep in the report.
+    '''
+
+    if verbosity not in ['silent', 'summary', 'detailed']:
+        raise Exception('Unrecognized verbosity: ' + str(verbosity) + ". Must be 'silent', 'summary' or 'detailed'.")
+
+    _settings['verbosity'] = verbosity
+    _settings['callback'] = callback
+    _settings['n_slowest_pairs'] = n_slowest_pairs
+
+def get_profile_settings():
+
+    #Current settings, as keyword arguments for set_verbosity.
+    return dict(_settings)
+
+def _log(message, level = logging.INFO):
+
+    #Use the application's logging setup if there is one, otherwise print to stdout like the rest of the package.
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    logger.log(level, message)
+
+def log_detail(message):
+
+    #Progress message, only shown with verbosity='detailed'.
+    if _settings['verbosity'] == 'detailed':
+        _log(message)
+
+def log_warning(message):
+
+    #Problems the user needs to know about (e.g. a failed preprocessing command), logged at WARNING whatever the verbosity.
+    _log(message, logging.WARNING)
+
+def is_profiling():
+    return _get_profile() is not None
+
+def get_peak_rss():
+
+    #Peak resident set size of this process so far, in bytes (ru_maxrss is in kilobytes on Linux but in bytes on macOS).
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextmanager
+def profile_subject(subject):
+
+    '''
+    Profiles everything run inside the with block as one subject, then reports it. Nested calls (e.g. compute_MIND called from a batch)
+    are part of the outer subject.
+    '''
+
+    if (_get_profile() is not None) or ((_settings['verbosity'] == 'silent') and (_settings['callback'] is None)):
+        yield
+        return
+
+    _thread.profile = {'subject': str(subject), 'stages': {}, 'counts': {}, 'slowest_pairs': [], 'region_names': None}
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        report = _thread.profile
+        _thread.profile = None
+
+        report['total_seconds'] = time.perf_counter() - start
+        report['peak_rss_bytes'] = get_peak_rss()
+        report['slowest_pairs'] = [{'regions': regions, 'seconds': seconds} for seconds, regions in sorted(report['slowest_pairs'], reverse=True)]
+        del report['region_names']
+
+        _report(report)
+
+@contextmanager
+def profile_stage(name):
+
+    #Adds the time spent in the with block to the named stage of the current subject.
+    profile = _get_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage = profile['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+
+        log_detail(name + ' done in ' + '%.3f' % seconds + 's')
+
+def add_profile_count(name, n = 1):
+
+    #Adds n to a counter (e.g. vertices or KD-tree queries) of the current subject.
+    profile = _get_profile()
+    if profile is not None:
+        profile['counts'][name] = profile['counts'].get(name, 0) + int(n)
+
+def set_profile_entry(name, value):
+
+    #Stores extra information about the current subject (e.g. the QC report) in its report.
+    profile = _get_profile()
+    if profile is not None:
+        profile[name] = value
+
+def set_profile_regions(region_list):
+
+    #Region names used to label the slowest pairs recorded with record_pair_time.
+    profile = _get_profile()
+    if profile is not None:
+        profile['region_names'] = [str(x) for x in region_list]
+
+def record_pair_time(i, j, seconds):
+
+    #Keeps the slowest region pairs of the current subject (as a min-heap of the n_slowest_pairs largest times).
+    profile = _get_profile()
+    if profile is None:
+        return
+
+    names = profile['region_names']
+    regions = (names[i], names[j]) if names is not None else (str(i), str(j))
+
+    if len(profile['slowest_pairs']) < _settings['n_slowest_pairs']:
+        heapq.heappush(profile['slowest_pairs'], (seconds, regions))
+    else:
+        heapq.heappushpop(profile['slowest_pairs'], (seconds, regions))
+
+def format_report(report, detailed = False):
+
+    #Human readable version of a subject's report.
+    stages = ', '.join(name + ' ' + '%.2f' % x['seconds'] + 's' for name, x in report['stages'].items())
+    counts = ', '.join(str(value) + ' ' + name.replace('_', ' ') for name, value in report['counts'].items())
+    memory = '' if report['peak_rss_bytes'] is None else ', peak RSS ' + '%.0f' % (report['peak_rss_bytes'] / 2**20) + ' MB'
+
+    lines = [report['subject'] + ': ' + '%.2f' % report['total_seconds'] + 's (' + stages + '); ' + counts + memory]
+
+    if detailed and (len(report['slowest_pairs']) > 0):
+        lines.append('Slowest region pairs: ' + ', '.join(x['regions'][0] + '-' + x['regions'][1] + ' ' + '%.4f' % x['seconds'] + 's' for x in report['slowest_pairs']))
+
+    return '\n'.join(lines)
+
+def _report(report):
+
+    if _settings['verbosity'] != 'silent':
+        _log(format_report(report, detailed = _settings['verbosity'] == 'detailed'))
+
+    if _settings['callback'] is not None:
+        _settings['callback'](report)
@@ -0,0 +1,167 @@
+'''
+Vertex-level quality control before MIND computation.
+
+run_vertex_qc evaluates every rule on the vertex X feature array in one go, combining them into a single boolean mask of the vertices
+to keep, so the data is only copied once however many rules are used:
+    • zero filters: vertices where any of the given features (by default CT, Vol and SA with filter_vertices=True) equal zero, which
+    are not biologically feasible.
+    • MAD outliers: vertices with a modified z-score (0.6745 * distance to the median / median absolute deviation, see
+    MIND_helpers.is_outlier) above mad_threshold, either in any single feature ('per_feature') or in their Euclidean distance to the
+    median over all features, after scaling every feature by its standard deviation ('multivariate'). These are computed over the
+    vertices that pass the zero filters.
+    • repeated values: an exception is raised if more than max_duplicate_rate of the kept vertices in regions repeat another vertex's
+    values (see MIND_helpers.check_repeated_values), as calculate_mind_array does.
+
+It also reports how many vertices each rule removed, in total and per region, so the filtering can be checked and left on in production.
+Only NumPy is needed.
+'''
+
+import numpy as np
+from MIND_helpers import check_repeated_values
+
+def get_mad_outliers(values, threshold=7, mode='per_feature'):
+
+    '''
+    Boolean mask of the rows of values (n_vertices X n_features) whose modified z-score is above threshold. With mode='per_feature',
+    a vertex is an outlier if it is one in any feature, which is the same as applying is_outlier to every feature separately, but
+    computed for all features at once. With mode='multivariate', the z-score is that of the vertex's distance to the median, with every
+    feature divided by its standard deviation first (as is_outlier on standardized values). Features (or, with mode='multivariate', distances)
+    whose median absolute deviation is zero flag no vertices.
+    '''
+
+    #Floating point values are kept in their dtype, so the low-memory (float32) path doesn't double its memory use here.
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    if values.ndim == 1:
+        values = values[:,None]
+
+    deviation = values - np.median(values, axis=0)
+
+    if mode == 'per_feature':
+        np.abs(deviation, out=deviation)
+
+        #A feature with a median absolute deviation of zero (more than half the vertices at the median) can't be judged, so it flags nothing.
+        mad = np.median(deviation, axis=0)
+        mad[mad == 0] = np.inf
+
+        return np.any(0.6745 * deviation / mad > threshold, axis=1)
+
+    if mode == 'multivariate':
+        #Constant features don't contribute to the distance.
+        std = values.std(axis=0, ddof=1)
+        std[std == 0] = np.inf
+        deviation /= std
+        distance = np.sqrt(np.einsum('ij,ij->i', deviation, deviation))
+
+        #As above, if more than half the vertices are at the median the distances can't be judged, so nothing is flagged.
+        median_distance = np.median(distance)
+        if not median_distance > 0:
+            return np.zeros(len(values), dtype=bool)
+
+        return 0.6745 * distance / median_distance > threshold
+
+    raise Exception("Unrecognized mad_mode: " + str(mode) + ". Must be 'per_feature' or 'multivariate'.")
+
+def run_vertex_qc(values, codes=None, regions=None, zero_columns=(), column_names=None, mad_threshold=None, mad_mode='per_feature', max_duplicate_rate=None):
+
+    '''
+    Runs the QC rules (see above) on a vertex X feature array of unstandardized values.
+
+    • codes (np.ndarray): optional region index (into regions) of every vertex, or -1 for vertices in no region. Needed for the
+    per-region counts and the repeated values check, which only look at vertices in regions. For several parcellations, codes and
+    regions can be dicts keyed by parcellation name, in which case the per-region counts are given for each parcellation and the
+    repeated values check is skipped (calculate_mind_array does it for each parcellation).
+    • regions (list): region names, for the report.
+    • zero_columns (list): indices of the features to apply the zero filter to.
+    • column_names (list): optional names of the features, used to name the zero filter rules (e.g. 'zero_CT'). Defaults to the column indices.
+    • mad_threshold (float): modified z-score above which vertices are removed as outliers. None (the default) keeps them all.
+    • mad_mode (str): 'per_feature' or 'multivariate' (see get_mad_outliers).
+    • max_duplicate_rate (float): raise an exception if more than this fraction of the kept vertices in regions repeat another vertex. None skips the check.
+
+    Returns (keep, report): a boolean mask of the vertices that pass every rule, and a dict with:
+    • 'n_vertices', 'n_kept': number of vertices before and after QC.
+    • 'removed': number of vertices removed by each rule, and in total. A vertex failing several zero filters is counted under each.
+    • 'removed_per_region': for each rule, an array of the number of vertices removed from each region (if codes are given, and a dict of these
+    keyed by parcellation if codes is a dict).
+    • 'regions': region names, in the order of the per-region counts.
+    • 'unique_fraction': fraction of distinct vertices among the kept vertices in regions (if the repeated values check was run).
+    '''
+
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:,None]
+
+    if column_names is None:
+        column_names = [str(x) for x in range(values.shape[1])]
+
+    removed = {}
+    keep = np.ones(len(values), dtype=bool)
+
+    if len(zero_columns) > 0:
+        zeros = values[:, list(zero_columns)] == 0
+        for i, column in enumerate(zero_columns):
+            removed['zero_' + str(column_names[column])] = zeros[:,i]
+        keep &= ~np.any(zeros, axis=1)
+
+    if mad_threshold is not None:
+        #Outliers are only looked for among the vertices that pass the zero filters.
+        outliers = np.zeros(len(values), dtype=bool)
+        outliers[keep] = get_mad_outliers(values[keep], threshold=mad_threshold, mode=mad_mode)
+        removed['mad_outlier'] = outliers
+        keep &= ~outliers
+
+    removed['total'] = ~keep
+
+    report = {'n_vertices': len(values), 'n_kept': int(np.count_nonzero(keep)), \
+                'removed': {rule: int(np.count_nonzero(mask)) for rule, mask in removed.items()}, \
+                'regions': None}
+
+    if type(regions) is dict:
+        report['regions'] = {name: list(x) for name, x in regions.items()}
+    elif regions is not None:
+        report['regions'] = list(regions)
+
+    if type(codes) is dict:
+        report['removed_per_region'] = {name: _count_per_region(removed, codes[name], regions[name] if regions is not None else None) for name in codes}
+
+    elif codes is not None:
+        codes = np.asarray(codes)
+        report['removed_per_region'] = _count_per_region(removed, codes, regions)
+
+        if max_duplicate_rate is not None:
+            report['unique_fraction'] = check_repeated_values(values[keep & (codes >= 0)], max_duplicate_rate)
+
+    elif max_duplicate_rate is not None:
+        report['unique_fraction'] = check_repeated_values(values[keep], max_duplicate_rate)
+
+    return keep, report
+
+def _count_per_region(removed, codes, regions):
+
+    #Number of vertices removed by each rule in each region.
+    codes = np.asarray(codes)
+    n_regions = len(regions) if regions is not None else int(codes.max()) + 1
+    in_regions = codes >= 0
+
+    return {rule: np.bincount(codes[mask & in_regions], minlength=n_regions) for rule, mask in removed.items()}
+
+def format_qc_report(report, n_regions = 5):
+
+    #Human readable summary of a QC report, listing the n_regions regions that lost the most vertices.
+    lines = ['QC kept ' + str(report['n_kept']) + ' of ' + str(report['n_vertices']) + ' vertices (removed: ' + \
+            ', '.join(str(count) + ' ' + rule.replace('_', ' ') for rule, count in report['removed'].items()) + ')']
+
+    if ('removed_per_region' not in report) or (report['regions'] is None) or (report['removed']['total'] == 0):
+        return '\n'.join(lines)
+
+    if type(report['regions']) is dict:
+        per_region = [(name + ': ', report['removed_per_region'][name]['total'], report['regions'][name]) for name in report['regions']]
+    else:
+        per_region = [('', report['removed_per_region']['total'], report['regions'])]
+
+    for name, counts, regions in per_region:
+        worst = np.argsort(counts, kind='stable')[::-1][:n_regions]
+        lines.append(name + 'Most vertices removed from: ' + ', '.join(str(regions[i]) + ' ' + str(counts[i]) for i in worst if counts[i] > 0))
+
+    return '\n'.join(lines)
@@ -0,0 +1,581 @@
+'''
+A long-running local MIND service, for pipelines that submit subjects continuously.
+
+Starting a new Python process for every subject means re-importing everything and re-reading the same parcellation files each time.
+Instead, serve_MIND keeps a pool of worker processes alive and accepts compute_MIND jobs over HTTP, either on a localhost port or on a
+Unix socket. Each worker keeps parsed annotations, parcellation region lists and feature files in memory (see vertex_cache.set_memory_cache),
+so jobs using a shared template parcellation (e.g. fsaverage labels linked into every subject) only read it once per worker. An on-disk
+vertex cache (cache_dir) can be used as well, set when starting the server.
+
+Jobs are queued and handed to the workers as they become free. When more jobs are waiting than there are workers, up to batch_size queued
+jobs with the same features and parcellation are sent to one worker together, which saves a round trip per job.
+
+Endpoints (all JSON):
+    • POST /jobs: submit a job, with body {"surf_dir": ..., "features": [...], "parcellation": ..., "options": {...}}. options are passed on to
+    compute_MIND (see JOB_OPTIONS), plus an optional "out_file" to write the network to as a CSV instead of returning it, if the server was
+    started with an output_dir (out_file is a path inside output_dir). Returns the job_id.
+    • GET /jobs/<job_id>: status of a job ('queued', 'running', 'done' or 'failed'), its timings, and the result or error. Add ?wait=<seconds>
+    to wait for the job to finish first.
+    • GET /metrics: queue depth, running jobs, completed and failed counts, throughput, and the memory cache statistics of every worker.
+    • GET /health: {"status": "ok"}.
+
+Example:
+    python MIND_server.py --socket /tmp/MIND.sock --n-workers 8 --cache-dir /scratch/MIND_cache --output-dir /scratch/MIND_networks
+
+    from MIND_server import request_MIND
+    MIND = request_MIND('/path/to/subject', ['CT','MC','Vol','SD','SA'], 'aparc', socket_path = '/tmp/MIND.sock')
+
+Security: the server has no authentication. It only listens locally, but any user on the machine who can reach the port (or write to the
+socket file) can, as the user running the server:
+    • read any surface and annotation files that user can read, and get the resulting networks back.
+    • write CSV files (overwriting existing ones) anywhere inside output_dir, if it is set. Paths resolving outside it are rejected.
+    • use up the workers' CPU time and memory, e.g. with many jobs or large n_jobs.
+The on-disk cache location and size are fixed by the server and can't be set by jobs. On shared machines, prefer a Unix socket in a
+directory only trusted users can access to a port, and run the server as a user with as few permissions as possible.
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import signal
+import socket
+import argparse
+import threading
+import traceback
+import socketserver
+import multiprocessing
+import numpy as np
+from collections import deque
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from MIND_profiler import log_detail, set_verbosity
+
+#compute_MIND inputs that jobs may set in "options". The on-disk cache (cache_dir, max_cache_bytes) is always the server's.
+JOB_OPTIONS = ['filter_vertices', 'resample', 'n_samples', 'query_mode', 'n_jobs', 'random_state', 'dtype', \
+                'max_vertices_per_region', 'mad_threshold', 'mad_mode', 'max_duplicate_rate', 'out_file']
+
+def _jsonable(x):
+
+    #Converts NumPy values inside diagnostics etc. to plain Python types.
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, dict):
+        return {str(key): _jsonable(value) for key, value in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_jsonable(value) for value in x]
+    return x
+
+def get_output_path(output_dir, out_file):
+
+    '''
+    Resolves the out_file of a job to an absolute path inside the server's output_dir (relative paths are taken relative to it), raising an
+    Exception if output_dir is not set or the path (after resolving symbolic links) is outside it.
+    '''
+
+    if output_dir is None:
+        raise Exception('out_file can only be used if the server was started with an output_dir.')
+
+    output_dir = os.path.realpath(output_dir)
+    path = os.path.realpath(os.path.join(output_dir, str(out_file)))
+
+    if os.path.commonpath([output_dir, path]) != output_dir or path == output_dir:
+        raise Exception('out_file must be a file inside the output_dir of the server (' + output_dir + ').')
+
+    return path
+
+def format_job_result(output, out_file=None):
+
+    '''
+    Converts the output of compute_MIND to JSON: {'regions': [...], 'MIND': [[...]]}, plus 'diagnostics' if max_vertices_per_region was set,
+    or {'parcellations': {name: ...}} for several parcellations. With out_file, the network is written there as a CSV and {'out_file': out_file}
+    is returned instead of the values.
+    '''
+
+    if type(output) is dict:
+        if out_file is not None:
+            raise Exception('out_file can only be used with a single parcellation.')
+        return {'parcellations': {name: format_job_result(x) for name, x in output.items()}}
+
+    diagnostics = None
+    if type(output) is tuple:
+        output, diagnostics = output
+
+    if out_file is not None:
+        output.to_csv(out_file)
+        result = {'out_file': out_file}
+    else:
+        result = {'regions': [str(x) for x in output.index], 'MIND': output.values.tolist()}
+
+    if diagnostics is not None:
+        result['diagnostics'] = _jsonable(diagnostics)
+
+    return result
+
+def parse_job_result(result):
+
+    '''
+    Inverse of format_job_result: returns a regions X regions DataFrame (or (DataFrame, diagnostics), or a dict of them keyed by parcellation),
+    or the path of the CSV if the job wrote one.
+    '''
+
+    import pandas as pd
+
+    if 'parcellations' in result:
+        return {name: parse_job_result(x) for name, x in result['parcellations'].items()}
+
+    if 'out_file' in result:
+        return result['out_file']
+
+    MIND = pd.DataFrame(result['MIND'], index = result['regions'], columns = result['regions'])
+
+    if 'diagnostics' in result:
+        return MIND, result['diagnostics']
+
+    return MIND
+
+def _init_server_worker(memory_cache_bytes):
+
+    #The compute modules are only imported in the workers, so clients importing this module (e.g. for request_MIND) stay lightweight.
+    from vertex_cache import set_memory_cache
+
+    set_memory_cache(memory_cache_bytes)
+    set_verbosity('silent')
+
+def _run_server_jobs(jobs):
+
+    #Runs a batch of jobs in a worker process, one after the other. Returns (job_id, result, error, seconds) for each job,
+    #and the worker's memory cache statistics.
+    from MIND import compute_MIND
+    from vertex_cache import get_memory_cache_stats
+
+    outputs = []
+    for job_id, request in jobs:
+        start = time.perf_counter()
+
+        try:
+            options = dict(request.get('options', {}))
+            out_file = options.pop('out_file', None)
+            if out_file is not None:
+                #Resolved again right before writing, in case a symbolic link was swapped in since the job was submitted.
+                out_file = get_output_path(request['output_dir'], out_file)
+            if options.get('dtype') is not None:
+                options['dtype'] = np.dtype(options['dtype'])
+
+            #JSON has no tuples, so (lh, rh) feature file pairs arrive as lists.
+            features = [tuple(x) if type(x) is list else x for x in request['features']]
+
+            output = compute_MIND(request['surf_dir'], features, request['parcellation'], **options)
+            outputs.append((job_id, format_job_result(output, out_file), None, time.perf_counter() - start))
+
+        except Exception:
+            outputs.append((job_id, None, traceback.format_exc(), time.perf_counter() - start))
+
+    return outputs, os.getpid(), get_memory_cache_stats()
+
+def check_job_request(request):
+
+    #Checks the body of a POST /jobs request before queueing it. Files are only checked when the job runs.
+    if type(request) is not dict:
+        raise Exception('The request must be a JSON object.')
+
+    for key in ['surf_dir', 'features', 'parcellation']:
+        if key not in request:
+            raise Exception('The request is missing ' + key + '.')
+
+    if type(request['features']) is not list:
+        raise Exception('features must be a list.')
+
+    if type(request.get('options', {})) is not dict:
+        raise Exception('options must be a JSON object.')
+
+    unknown = [x for x in request.get('options', {}) if x not in JOB_OPTIONS]
+    if len(unknown) > 0:
+        raise Exception('Unknown options: ' + ', '.join(unknown) + '. Allowed options are ' + ', '.join(JOB_OPTIONS) + '.')
+
+def _create_pool(state):
+    return ProcessPoolExecutor(max_workers=state['n_workers'], mp_context=multiprocessing.get_context('spawn'), \
+                                initializer=_init_server_worker, initargs=(state['memory_cache_bytes'],))
+
+def create_server_state(n_workers = None, batch_size = 4, memory_cache_bytes = 2**30, cache_dir = None, max_cache_bytes = None, output_dir = None, \
+                        max_finished_jobs = 1000):
+
+    '''
+    Creates the job queue and worker pool used by serve_MIND (see serve_MIND for the inputs), and starts the thread handing jobs to the workers.
+    '''
+
+    state = {'n_workers': n_workers if n_workers is not None else os.cpu_count(), 'batch_size': batch_size, 'memory_cache_bytes': memory_cache_bytes, \
+            'defaults': {'cache_dir': cache_dir, 'max_cache_bytes': max_cache_bytes}, 'output_dir': output_dir, 'max_finished_jobs': max_finished_jobs, \
+            'jobs': {}, 'queue': deque(), 'finished': deque(), 'finish_times': deque(maxlen=100000), 'worker_caches': {}, \
+            'condition': threading.Condition(), 'in_flight': 0, 'stop': False, 'start_time': time.time(), \
+            'counts': {'submitted': 0, 'completed': 0, 'failed': 0, 'batches': 0, 'job_seconds': 0.0}}
+
+    state['pool'] = _create_pool(state)
+    state['dispatcher'] = threading.Thread(target=_dispatch_jobs, args=(state,), daemon=True)
+    state['dispatcher'].start()
+
+    return state
+
+def stop_server_state(state):
+
+    #Stops handing out jobs and shuts down the workers, dropping any queued jobs.
+    with state['condition']:
+        state['stop'] = True
+        state['condition'].notify_all()
+
+    state['pool'].shutdown(wait=True, cancel_futures=True)
+
+def submit_job(state, request):
+
+    '''
+    Queues a compute_MIND job (the body of a POST /jobs request) and returns its job_id.
+    '''
+
+    check_job_request(request)
+
+    #Jobs always use the server's on-disk cache, and can only write inside its output_dir.
+    options = dict(request.get('options', {}), **state['defaults'])
+    if options.get('out_file') is not None:
+        get_output_path(state['output_dir'], options['out_file'])
+
+    job_id = uuid.uuid4().hex
+    job = {'job_id': job_id, 'status': 'queued', 'request': dict(request, options=options, output_dir=state['output_dir']), 'submitted': time.time(), 'started': None, \
+            'finished': None, 'seconds': None, 'result': None, 'error': None, \
+            'batch_key': json.dumps([request['features'], request['parcellation']])}
+
+    with state['condition']:
+        if state['stop']:
+            raise Exception('The server is shutting down.')
+
+        state['jobs'][job_id] = job
+        state['queue'].append(job_id)
+        state['counts']['submitted'] += 1
+        state['condition'].notify_all()
+
+    return job_id
+
+def get_job(state, job_id, wait = 0):
+
+    '''
+    Returns the status of a job (without its internal fields), waiting up to wait seconds for it to finish. Returns None for unknown jobs,
+    including finished jobs that were dropped to keep only the last max_finished_jobs.
+    '''
+
+    with state['condition']:
+        if job_id not in state['jobs']:
+            return None
+
+        job = state['jobs'][job_id]
+        state['condition'].wait_for(lambda: job['status'] in ['done', 'failed'], timeout=wait)
+
+        return {key: value for key, value in job.items() if key not in ['request', 'batch_key']}
+
+def get_metrics(state):
+
+    '''
+    Returns the server metrics: queue depth, running jobs and batches, job counts, throughput (jobs finished in the last minute and
+    per second since the start), mean job time, mean batch size and each worker's memory cache statistics (keyed by process id).
+    '''
+
+    now = time.time()
+
+    with state['condition']:
+        counts = dict(state['counts'])
+        n_finished = counts['completed'] + counts['failed']
+
+        return {'uptime_seconds': now - state['start_time'], 'n_workers': state['n_workers'], 'batch_size': state['batch_size'], \
+                'queue_depth': len(state['queue']), 'running': sum(job['status'] == 'running' for job in state['jobs'].values()), \
+                'batches_in_flight': state['in_flight'], 'submitted': counts['submitted'], 'completed': counts['completed'], 'failed': counts['failed'], \
+                'jobs_last_minute': sum(x > now - 60 for x in state['finish_times']), \
+                'jobs_per_second': n_finished / (now - state['start_time']), \
+                'mean_job_seconds': counts['job_seconds'] / n_finished if n_finished > 0 else None, \
+                'mean_batch_size': n_finished / counts['batches'] if counts['batches'] > 0 else None, \
+                'worker_caches': {str(pid): stats for pid, stats in state['worker_caches'].items()}}
+
+def _dispatch_jobs(state):
+
+    #Hands queued jobs to the worker pool, never more batches than there are workers, so jobs wait in the queue (and can be batched)
+    #rather than inside the pool.
+    condition = state['condition']
+
+    while True:
+        with condition:
+            condition.wait_for(lambda: state['stop'] or ((len(state['queue']) > 0) and (state['in_flight'] < state['n_workers'])))
+            if state['stop']:
+                return
+
+            #Spread the waiting jobs over the workers, batching jobs with the same features and parcellation.
+            batch_size = min(state['batch_size'], max(1, math.ceil(len(state['queue']) / state['n_workers'])))
+            key = state['jobs'][state['queue'][0]]['batch_key']
+            batch = [x for x in state['queue'] if state['jobs'][x]['batch_key'] == key][:batch_size]
+
+            for job_id in batch:
+                state['queue'].remove(job_id)
+                state['jobs'][job_id]['status'] = 'running'
+                state['jobs'][job_id]['started'] = time.time()
+
+            state['in_flight'] += 1
+            state['counts']['batches'] += 1
+            jobs = [(job_id, state['jobs'][job_id]['request']) for job_id in batch]
+
+        pool = state['pool']
+        try:
+            future = pool.submit(_run_server_jobs, jobs)
+        except Exception as e:
+            _finish_batch(state, batch, pool, None, e)
+            continue
+
+        future.add_done_callback(lambda future, batch=batch, pool=pool: _finish_batch(state, batch, pool, future))
+
+def _finish_batch(state, batch, pool, future, error = None):
+
+    #Records the results of a batch. If a worker died (e.g. ran out of memory), the pool's jobs fail and the pool is replaced.
+    pid = None
+    try:
+        if error is not None:
+            raise error
+        outputs, pid, cache_stats = future.result()
+    except Exception as e:
+        outputs = [(job_id, None, 'The worker failed: ' + repr(e), None) for job_id in batch]
+
+        with state['condition']:
+            if isinstance(e, BrokenProcessPool) and (state['pool'] is pool) and not state['stop']:
+                log_detail('A MIND worker failed, restarting the worker pool.')
+                pool.shutdown(wait=False)
+                state['pool'] = _create_pool(state)
+
+    now = time.time()
+
+    with state['condition']:
+        for job_id, result, error, seconds in outputs:
+            job = state['jobs'][job_id]
+            job.update({'status': 'done' if error is None else 'failed', 'result': result, 'error': error, 'seconds': seconds, 'finished': now})
+
+            state['counts']['completed' if error is None else 'failed'] += 1
+            state['counts']['job_seconds'] += seconds if seconds is not None else now - job['started']
+            state['finish_times'].append(now)
+            state['finished'].append(job_id)
+
+        #Only keep the last max_finished_jobs finished jobs, so memory doesn't grow with the number of jobs served.
+        while len(state['finished']) > state['max_finished_jobs']:
+            del state['jobs'][state['finished'].popleft()]
+
+        if pid is not None:
+            state['worker_caches'][pid] = cache_stats
+
+        state['in_flight'] -= 1
+        state['condition'].notify_all()
+
+class _MINDRequestHandler(BaseHTTPRequestHandler):
+
+    #Translates the HTTP endpoints (see the module description) to submit_job, get_job and get_metrics.
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/jobs':
+            return self.send_json(404, {'error': 'Unknown endpoint ' + self.path})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job_id = submit_job(self.server.MIND_state, request)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+
+        self.send_json(202, {'job_id': job_id, 'status': 'queued'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        state = self.server.MIND_state
+
+        if url.path == '/health':
+            return self.send_json(200, {'status': 'ok'})
+
+        if url.path == '/metrics':
+            return self.send_json(200, get_metrics(state))
+
+        if url.path.startswith('/jobs/'):
+            try:
+                wait = float(parse_qs(url.query).get('wait', [0])[0])
+            except ValueError:
+                return self.send_json(400, {'error': 'wait must be a number of seconds.'})
+
+            job = get_job(state, url.path[len('/jobs/'):], wait=wait)
+            if job is None:
+                return self.send_json(404, {'error': 'Unknown job ' + url.path[len('/jobs/'):]})
+            return self.send_json(200, job)
+
+        self.send_json(404, {'error': 'Unknown endpoint ' + self.path})
+
+    def log_message(self, format, *args):
+        log_detail(format % args)
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+def create_MIND_server(host = '127.0.0.1', port = 8765, socket_path = None, n_workers = None, batch_size = 4, memory_cache_bytes = 2**30, \
+                        cache_dir = None, max_cache_bytes = None, output_dir = None, max_finished_jobs = 1000):
+
+    '''
+    Creates the HTTP server of serve_MIND without starting to serve requests (call serve_forever on it, and stop_MIND_server when done).
+    '''
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            #Only replace a stale socket file, not one another server is listening on.
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(socket_path)
+                raise Exception('A server is already listening on ' + socket_path + '.')
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(socket_path)
+            finally:
+                probe.close()
+
+        server = _UnixHTTPServer(socket_path, _MINDRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _MINDRequestHandler)
+
+    server.daemon_threads = True
+    server.MIND_state = create_server_state(n_workers=n_workers, batch_size=batch_size, memory_cache_bytes=memory_cache_bytes, \
+                                            cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, output_dir=output_dir, max_finished_jobs=max_finished_jobs)
+
+    return server
+
+def stop_MIND_server(server):
+
+    #Stops a server from create_MIND_server (call server.shutdown first if serve_forever runs in another thread).
+    stop_server_state(server.MIND_state)
+    server.server_close()
+
+    if server.address_family == socket.AF_UNIX and os.path.exists(server.server_address):
+        os.remove(server.server_address)
+
+def serve_MIND(host = '127.0.0.1', port = 8765, socket_path = None, n_workers = None, batch_size = 4, memory_cache_bytes = 2**30, \
+                cache_dir = None, max_cache_bytes = None, output_dir = None, max_finished_jobs = 1000):
+
+    '''
+    Runs the MIND service until interrupted (see the module description).
+
+    • host, port: local address to listen on. Ignored if socket_path is given.
+    • socket_path (str): listen on this Unix socket instead of a port.
+    • n_workers (int): number of worker processes. Defaults to the number of CPUs.
+    • batch_size (int): maximum number of queued jobs sent to a worker at once.
+    • memory_cache_bytes (int): size of each worker's in-memory cache of parsed files (see vertex_cache.set_memory_cache).
+    • cache_dir, max_cache_bytes: on-disk vertex cache used by all jobs (see get_vertex_df).
+    • output_dir (str): directory jobs may write their networks to with out_file. None (the default) doesn't allow out_file.
+    • max_finished_jobs (int): number of finished jobs whose results are kept to be fetched.
+    '''
+
+    server = create_MIND_server(host=host, port=port, socket_path=socket_path, n_workers=n_workers, batch_size=batch_size, \
+                                memory_cache_bytes=memory_cache_bytes, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, \
+                                output_dir=output_dir, max_finished_jobs=max_finished_jobs)
+
+    print('MIND server listening on ' + (socket_path if socket_path is not None else host + ':' + str(server.server_port)), flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_MIND_server(server)
+
+def _request_server(method, path, body = None, host = '127.0.0.1', port = 8765, socket_path = None, timeout = None):
+
+    #Sends one request to the server and returns the decoded JSON response, raising an Exception for error responses.
+    connection = HTTPConnection(host, port, timeout=timeout)
+    if socket_path is not None:
+        connection.sock = socket.socket(socket.AF_UNIX)
+        connection.sock.settimeout(timeout)
+        connection.sock.connect(socket_path)
+
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={'Content-Type': 'application/json'} if data is not None else {})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    finally:
+        connection.close()
+
+    if response.status >= 400:
+        raise Exception('MIND server error (' + str(response.status) + '): ' + result.get('error', ''))
+
+    return result
+
+def submit_MIND_job(surf_dir, features, parcellation, host = '127.0.0.1', port = 8765, socket_path = None, **options):
+
+    '''
+    Submits a compute_MIND job to a running server and returns its job_id. options are any of JOB_OPTIONS.
+    '''
+
+    body = {'surf_dir': surf_dir, 'features': list(features), 'parcellation': parcellation, 'options': options}
+    return _request_server('POST', '/jobs', body, host=host, port=port, socket_path=socket_path)['job_id']
+
+def get_MIND_job(job_id, wait = 0, host = '127.0.0.1', port = 8765, socket_path = None):
+
+    #Status of a submitted job, waiting up to wait seconds for it to finish (see get_job).
+    return _request_server('GET', '/jobs/' + job_id + '?wait=' + str(wait), host=host, port=port, socket_path=socket_path)
+
+def get_MIND_server_metrics(host = '127.0.0.1', port = 8765, socket_path = None):
+    return _request_server('GET', '/metrics', host=host, port=port, socket_path=socket_path)
+
+def request_MIND(surf_dir, features, parcellation, host = '127.0.0.1', port = 8765, socket_path = None, timeout = None, poll_seconds = 30, **options):
+
+    '''
+    Computes MIND on a running server: takes the same inputs as compute_MIND (options being any of JOB_OPTIONS), waits for the job to
+    finish and returns the same output (see parse_job_result). Raises an Exception with the worker's traceback if the job failed, or if it
+    hasn't finished after timeout seconds.
+    '''
+
+    job_id = submit_MIND_job(surf_dir, features, parcellation, host=host, port=port, socket_path=socket_path, **options)
+    start = time.time()
+
+    while True:
+        wait = poll_seconds if timeout is None else min(poll_seconds, max(0, timeout - (time.time() - start)))
+        job = get_MIND_job(job_id, wait=wait, host=host, port=port, socket_path=socket_path)
+
+        if job['status'] == 'done':
+            return parse_job_result(job['result'])
+
+        if job['status'] == 'failed':
+            raise Exception('MIND job ' + job_id + ' failed:\n' + job['error'])
+
+        if (timeout is not None) and (time.time() - start >= timeout):
+            raise Exception('MIND job ' + job_id + ' did not finish within ' + str(timeout) + ' seconds.')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run a local MIND service (see MIND_server.py).')
+    parser.add_argument('--host', default='127.0.0.1', help='local address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on.')
+    parser.add_argument('--socket', default=None, help='Unix socket to listen on instead of a port.')
+    parser.add_argument('--n-workers', type=int, default=None, help='number of worker processes (defaults to the number of CPUs).')
+    parser.add_argument('--batch-size', type=int, default=4, help='maximum number of queued jobs sent to a worker at once.')
+    parser.add_argument('--memory-cache-bytes', type=int, default=2**30, help='size of each worker\'s in-memory cache of parsed files.')
+    parser.add_argument('--cache-dir', default=None, help='on-disk vertex cache used by all jobs.')
+    parser.add_argument('--max-cache-bytes', type=int, default=None, help='size limit of the on-disk vertex cache.')
+    parser.add_argument('--output-dir', default=None, help='directory jobs may write their networks to (with out_file).')
+    args = parser.parse_args()
+
+    #Shut down cleanly (removing the socket file) when stopped by a service manager.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    serve_MIND(host=args.host, port=args.port, socket_path=args.socket, n_workers=args.n_workers, batch_size=args.batch_size, \
+                memory_cache_bytes=args.memory_cache_bytes, cache_dir=args.cache_dir, max_cache_bytes=args.max_cache_bytes, output_dir=args.output_dir)
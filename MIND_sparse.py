@@ -0,0 +1,159 @@
+'''
+Sparse MIND networks for fine parcellations.
+
+With 1000+ regions a full MIND network has hundreds of thousands of edges, most of which are often not needed. compute_MIND_sparse
+only computes the edges in a chosen set of region pairs and returns them as a scipy.sparse matrix, so neither the computation nor the
+output grows with the square of the number of regions. Pairs can be:
+    • 'adjacent': regions that share an edge of the surface mesh (surf_dir/surf/?h.white by default).
+    • 'knn': each region's k nearest regions in feature space, by the distance between the regions' mean feature values.
+    • an explicit list of (region_a, region_b) pairs.
+
+Pairs can optionally be pre-screened with a cheap approximation of MIND that treats every region as a Gaussian with a diagonal covariance.
+This is a heuristic, not a bound: the k-nearest-neighbour estimate used by MIND can be above the approximation (e.g. for skewed or
+multimodal regions), so pairs dropped by the pre-screen are not guaranteed to have MIND below the threshold.
+'''
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree as KDTree
+from MIND_helpers import calculate_mind_pairs, get_region_blocks
+
+def get_adjacent_region_pairs(surf_dir, codes, hemi_sizes, surface='white'):
+
+    '''
+    Pairs of region codes (i < j) that share at least one edge of the surface mesh, from the faces of surf_dir/surf/?h.<surface>.
+    codes holds the region code of every vertex (lh then rh), with -1 for vertices outside any region.
+    '''
+
+    from nibabel.freesurfer.io import read_geometry
+
+    pairs = []
+    start = 0
+
+    for hemi, size in zip(['lh','rh'], hemi_sizes):
+        faces = read_geometry(surf_dir + '/surf/' + hemi + '.' + surface)[1]
+
+        if faces.max() >= size:
+            raise Exception('The ' + hemi + '.' + surface + ' surface does not match the number of vertices in the parcellation.')
+
+        face_codes = codes[start:start + size][faces]
+
+        #Every face has three edges; keep the ones between vertices of two different regions.
+        for a, b in [(0, 1), (1, 2), (2, 0)]:
+            keep = (face_codes[:,a] != face_codes[:,b]) & (face_codes[:,a] >= 0) & (face_codes[:,b] >= 0)
+            pairs.append(np.sort(face_codes[keep][:,[a, b]], axis=1))
+
+        start += size
+
+    return np.unique(np.vstack(pairs), axis=0)
+
+def get_region_moments(values, offsets):
+
+    #Mean and variance of every feature within each region (rows of regions without vertices are NaN).
+    counts = np.diff(offsets)
+    present = np.flatnonzero(counts > 0)
+
+    means = np.full((len(counts), values.shape[1]), np.nan)
+    variances = np.full((len(counts), values.shape[1]), np.nan)
+
+    means[present] = np.add.reduceat(values, offsets[present], axis=0) / counts[present][:,None]
+    variances[present] = np.add.reduceat(values**2, offsets[present], axis=0) / counts[present][:,None] - means[present]**2
+
+    return means, np.maximum(variances, 0)
+
+def get_knn_region_pairs(values, offsets, k=10):
+
+    '''
+    Pairs of region codes (i < j) where either region is among the other's k nearest regions, by the Euclidean distance between the
+    regions' mean (standardized) feature values.
+    '''
+
+    means = get_region_moments(values, offsets)[0]
+    present = np.flatnonzero(np.isfinite(means[:,0]))
+    k = min(k, len(present) - 1)
+
+    if k < 1:
+        return np.zeros((0, 2), dtype=int)
+
+    #The nearest region to each centroid is itself, so query one extra neighbour.
+    neighbours = KDTree(means[present]).query(means[present], k=k+1)[1][:,1:]
+    pairs = np.column_stack([np.repeat(present, k), present[neighbours.ravel()]])
+
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+def get_gaussian_MIND(values, offsets, pairs):
+
+    '''
+    Cheap approximation of MIND for the given pairs, treating each region as a Gaussian with a diagonal covariance:
+    1/(1 + KL(a||b) + KL(b||a)), with closed form KL divergences. Used for pre-screening only, see the module docstring.
+    '''
+
+    means, variances = get_region_moments(values, offsets)
+    variances = np.maximum(variances, 1e-12)
+
+    mean_a, mean_b = means[pairs[:,0]], means[pairs[:,1]]
+    var_a, var_b = variances[pairs[:,0]], variances[pairs[:,1]]
+
+    #The log terms of the two KL divergences cancel out in their sum.
+    kl = 0.5 * np.sum(var_a / var_b + var_b / var_a - 2 + (mean_a - mean_b)**2 * (1 / var_a + 1 / var_b), axis=1)
+
+    return 1 / (1 + kl)
+
+def compute_MIND_sparse(surf_dir, features, parcellation, pairs='adjacent', k=10, surface='white', prescreen_threshold=None, \
+                        filter_vertices=False, n_jobs=1, max_duplicate_rate=0.2):
+
+    '''
+    Computes MIND only for a chosen set of region pairs.
+
+    • surf_dir, features, parcellation, filter_vertices, max_duplicate_rate: as for compute_MIND. Vertices are loaded and standardized in the same way.
+    • pairs: 'adjacent' (regions sharing an edge of the surf_dir/surf/?h.<surface> mesh), 'knn' (each region's k nearest regions by mean
+    feature values), or a list of (region_a, region_b) pairs of region names.
+    • k (int): number of neighbours for pairs='knn'.
+    • surface (str): surface whose mesh defines adjacency for pairs='adjacent'.
+    • prescreen_threshold (float): if given, pairs whose Gaussian approximation of MIND (see get_gaussian_MIND) is below this value are
+    skipped. This is a heuristic, so it is best set well below the smallest MIND value of interest.
+    • n_jobs (int): number of threads for each KD-tree query.
+
+    Returns a tuple of:
+    • a symmetric scipy.sparse.csr_matrix of MIND values, regions X regions, with entries only for the computed pairs.
+    • the region names, in the order of the rows and columns of the matrix.
+    '''
+
+    from get_vertex_df import get_surface_vertex_data
+
+    data = get_surface_vertex_data(surf_dir, features, parcellation, filter_vertices=filter_vertices, max_duplicate_rate=max_duplicate_rate)
+    regions = data['regions']
+    n_regions = len(regions)
+
+    values, offsets = get_region_blocks(data['values'], data['codes'][data['valid']], np.arange(n_regions))
+
+    if type(pairs) is str:
+        if pairs == 'adjacent':
+            pairs = get_adjacent_region_pairs(surf_dir, data['codes'], data['hemi_sizes'], surface=surface)
+        elif pairs == 'knn':
+            pairs = get_knn_region_pairs(values, offsets, k=k)
+        else:
+            raise Exception('Unknown pairs \'' + pairs + '\'. Use \'adjacent\', \'knn\' or a list of region pairs.')
+    else:
+        region_codes = dict(zip(regions, range(n_regions)))
+        missing = [x for pair in pairs for x in pair if x not in region_codes]
+
+        if len(missing) > 0:
+            raise Exception('Regions not found in the parcellation: ' + str(sorted(set(missing))))
+
+        pairs = np.array([sorted([region_codes[a], region_codes[b]]) for a, b in pairs if a != b], dtype=int).reshape(-1, 2)
+        pairs = np.unique(pairs, axis=0)
+
+    #Pairs involving a region without any (used) vertices have no MIND value.
+    counts = np.diff(offsets)
+    pairs = pairs[(counts[pairs[:,0]] > 0) & (counts[pairs[:,1]] > 0)]
+
+    if prescreen_threshold is not None:
+        pairs = pairs[get_gaussian_MIND(values, offsets, pairs) >= prescreen_threshold]
+
+    MIND = calculate_mind_pairs(values, offsets, pairs, n_jobs=n_jobs)
+
+    rows = np.concatenate([pairs[:,0], pairs[:,1]])
+    cols = np.concatenate([pairs[:,1], pairs[:,0]])
+
+    return sparse.csr_matrix((np.concatenate([MIND, MIND]), (rows, cols)), shape=(n_regions, n_regions)), regions
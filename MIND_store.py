@@ -0,0 +1,166 @@
+'''
+On-disk store for the MIND networks of a whole cohort.
+
+Each subject's network is stored as its upper triangle (in np.triu_indices order), one row per subject, in a series of fixed size
+.npy chunk files that are memory mapped, so any subset of subjects or edges can be read without loading the whole cohort.
+The store directory contains:
+    header.json: the region order (taken from the regions of the MIND networks), chunk size and dtype.
+    subjects.txt: the subject ids, one per line, in row order.
+    edges_00000.npy, edges_00001.npy, ...: the chunk files, each holding chunk_size rows.
+
+A subject's row is written and flushed before its id is appended to subjects.txt, so an interrupted batch never leaves a subject
+half written, and can resume from the subjects listed there.
+'''
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+def create_MIND_store(path, regions, chunk_size = 1000, dtype='float32'):
+
+    '''
+    Creates an empty store in the directory path, for MIND networks over the given regions (in this order).
+    '''
+
+    os.makedirs(path, exist_ok=True)
+
+    if os.path.exists(os.path.join(path, 'header.json')):
+        raise Exception('A MIND store already exists at ' + path + '.')
+
+    header = {'regions': [str(x) for x in regions], 'chunk_size': chunk_size, 'dtype': dtype}
+
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    open(os.path.join(path, 'subjects.txt'), 'w', encoding='utf-8').close()
+
+def read_MIND_store_header(path):
+
+    with open(os.path.join(path, 'header.json')) as f:
+        return json.load(f)
+
+def get_stored_subjects(path):
+
+    '''
+    Returns the ids of all subjects in the store, in row order. A trailing line without a newline (from an interrupted write) is ignored.
+    '''
+
+    with open(os.path.join(path, 'subjects.txt'), encoding='utf-8') as f:
+        lines = f.read().split('\n')
+
+    return lines[:-1]
+
+def _get_chunk(path, chunk, header, mode):
+
+    chunk_file = os.path.join(path, 'edges_' + str(chunk).zfill(5) + '.npy')
+    n_regions = len(header['regions'])
+
+    if not os.path.exists(chunk_file):
+        if mode == 'r':
+            return None
+        return np.lib.format.open_memmap(chunk_file, mode='w+', dtype=header['dtype'], shape=(header['chunk_size'], n_regions * (n_regions - 1) // 2))
+
+    return np.load(chunk_file, mmap_mode=mode)
+
+def append_to_MIND_store(path, subject_id, MIND):
+
+    '''
+    Adds one subject's MIND network to the store and checkpoints it.
+
+    MIND can be a DataFrame (as returned by compute_MIND), which is reordered to the store's region order, with any missing regions set to NaN,
+    or a square array already in the store's region order.
+    '''
+
+    header = read_MIND_store_header(path)
+    regions = header['regions']
+
+    if type(MIND) is pd.DataFrame:
+        MIND = MIND.reindex(index=regions, columns=regions).values
+
+    MIND = np.asarray(MIND)
+    if MIND.shape != (len(regions), len(regions)):
+        raise Exception('MIND network for subject ' + str(subject_id) + ' does not match the regions of the store.')
+
+    subject_id = str(subject_id)
+    if '\n' in subject_id:
+        raise Exception('Subject ids cannot contain newlines.')
+
+    subjects = get_stored_subjects(path)
+    row = len(subjects)
+
+    #Trim any partially written id left behind by an interrupted append.
+    with open(os.path.join(path, 'subjects.txt'), 'r+', encoding='utf-8') as f:
+        f.truncate(sum(len(x.encode()) + 1 for x in subjects))
+
+    chunk = _get_chunk(path, row // header['chunk_size'], header, 'r+')
+    chunk[row % header['chunk_size']] = MIND[np.triu_indices(len(regions), 1)]
+    chunk.flush()
+    del chunk
+
+    with open(os.path.join(path, 'subjects.txt'), 'a', encoding='utf-8') as f:
+        f.write(subject_id + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_MIND_store(path, subjects=None, edges=None, as_matrices=False):
+
+    '''
+    Reads part or all of a store, only touching the requested rows and edges.
+
+    • subjects (list): subject ids to read. Defaults to all subjects.
+    • edges (list): (region_a, region_b) pairs to read. Defaults to all edges.
+    • as_matrices (bool): If True, return a subjects X regions X regions array (ignoring edges) instead.
+
+    Returns a DataFrame with one row per subject and one column per edge (as a (region_a, region_b) MultiIndex), or, with as_matrices=True,
+    a tuple of the array of networks and the region order.
+    '''
+
+    header = read_MIND_store_header(path)
+    regions = header['regions']
+    n_regions = len(regions)
+    chunk_size = header['chunk_size']
+
+    stored_subjects = get_stored_subjects(path)
+    rows = dict(zip(stored_subjects, range(len(stored_subjects))))
+
+    if subjects is None:
+        subjects = stored_subjects
+
+    missing = [x for x in subjects if str(x) not in rows]
+    if len(missing) > 0:
+        raise Exception('Subjects not found in the store: ' + str(missing))
+
+    triu = np.triu_indices(n_regions, 1)
+
+    if (edges is None) or as_matrices:
+        edge_idx = np.arange(len(triu[0]))
+    else:
+        region_idx = dict(zip(regions, range(n_regions)))
+        edge_lookup = np.zeros((n_regions, n_regions), dtype=int)
+        edge_lookup[triu] = np.arange(len(triu[0]))
+        edge_lookup = edge_lookup + edge_lookup.T
+
+        if any(a == b for a, b in edges):
+            raise Exception('Edges must be between two different regions.')
+
+        edge_idx = np.array([edge_lookup[region_idx[a], region_idx[b]] for a, b in edges], dtype=int)
+
+    data = np.zeros((len(subjects), len(edge_idx)), dtype=header['dtype'])
+    subject_rows = np.array([rows[str(x)] for x in subjects], dtype=int)
+
+    #Read chunk by chunk, so each chunk file is only opened once.
+    for chunk in np.unique(subject_rows // chunk_size):
+        in_chunk = np.flatnonzero(subject_rows // chunk_size == chunk)
+        chunk_data = _get_chunk(path, chunk, header, 'r')
+        data[in_chunk] = chunk_data[subject_rows[in_chunk] % chunk_size][:, edge_idx]
+
+    if as_matrices:
+        matrices = np.zeros((len(subjects), n_regions, n_regions), dtype=header['dtype'])
+        matrices[:, triu[0], triu[1]] = data
+        matrices[:, triu[1], triu[0]] = data
+        return matrices, np.array(regions)
+
+    columns = pd.MultiIndex.from_arrays([np.array(regions)[triu[0][edge_idx]], np.array(regions)[triu[1][edge_idx]]])
+
+    return pd.DataFrame(data, index=[str(x) for x in subjects], columns=columns)
@@ -0,0 +1,46 @@
+'''
+Compares two result files from run_benchmarks.py, e.g. from before and after a change.
+
+Example:
+    python benchmarks/compare_benchmarks.py old_results.json new_results.json
+
+Prints the median time of every stage in both files and the speedup (old / new) for every configuration that appears in both.
+'''
+
+import sys
+import json
+
+CONFIG_KEYS = ['n_regions', 'n_vertices', 'n_features', 'duplicate_rate']
+
+def compare_benchmarks(old_file, new_file):
+
+    '''
+    Returns a list of (configuration, stage, old median time, new median time, speedup) for every stage timed in both files.
+    '''
+
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    old_results = {tuple(x[key] for key in CONFIG_KEYS): x['stages'] for x in old['results']}
+
+    comparison = []
+    for result in new['results']:
+        config = tuple(result[key] for key in CONFIG_KEYS)
+
+        for stage, timings in result['stages'].items():
+            if stage in old_results.get(config, {}):
+                old_time = old_results[config][stage]['median']
+                comparison.append((dict(zip(CONFIG_KEYS, config)), stage, old_time, timings['median'], old_time / timings['median']))
+
+    return comparison
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python compare_benchmarks.py old_results.json new_results.json')
+
+    for config, stage, old_time, new_time, speedup in compare_benchmarks(sys.argv[1], sys.argv[2]):
+        name = ', '.join(key + '=' + str(value) for key, value in config.items())
+        print(name + ' | ' + stage + ': ' + '%.3fs -> %.3fs (%.2fx)' % (old_time, new_time, speedup))
@@ -0,0 +1,102 @@
+'''
+Measures how long the MIND modules take to import, and checks that they do not load dependencies they only need on first use.
+
+Every import is timed in a fresh Python process (so nothing is already loaded), repeats times, and the median is reported. The numerical
+core (MIND_helpers) should only need NumPy and scipy.spatial: its time is also reported relative to importing just those two, which is
+the part this repository controls. The I/O and preprocessing dependencies (pandas, nibabel, nipype) are loaded by the functions that use them.
+
+Example:
+    python benchmarks/import_time.py --repeats 5 --max-core-overhead 0.05 --output import_times.json
+
+Exits with status 1 if a module loads a dependency it should not, or if the core's overhead is above --max-core-overhead seconds,
+so it can be used to guard against regressions.
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+#Modules that are timed, and the dependencies each of them must not load at import time.
+CHECKS = {
+    'numpy, scipy.spatial': [],
+    'MIND_helpers': ['pandas', 'nibabel', 'nipype', 'scipy.stats'],
+    'MIND_sparse': ['pandas', 'nibabel', 'nipype'],
+    'MIND_qc': ['pandas', 'nibabel', 'nipype'],
+    'MIND': ['nibabel', 'nipype'],
+    'MIND_nulls': ['nibabel', 'nipype'],
+    'step_scheduler': ['pandas', 'nibabel', 'nipype'],
+    'register_and_vol2surf': ['pandas', 'nibabel', 'nipype'],
+    'MIND_server': ['pandas', 'nibabel', 'nipype'],
+}
+
+TRACKED = sorted(set(x for loaded in CHECKS.values() for x in loaded))
+
+def time_import(module):
+
+    #Imports module in a fresh interpreter, returning the time taken and which of the tracked dependencies ended up loaded.
+    code = 'import sys, time, json\n' + \
+            'start = time.perf_counter()\n' + \
+            'import ' + module + '\n' + \
+            'seconds = time.perf_counter() - start\n' + \
+            'print(json.dumps([seconds, [x for x in ' + repr(TRACKED) + ' if x in sys.modules]]))'
+
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception('Importing ' + module + ' failed:\n' + result.stderr[-2000:])
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure_import_times(repeats = 5):
+
+    '''
+    Returns a dict with, for every module in CHECKS, its import times, median, the tracked dependencies it loaded, and the ones it should not have.
+    '''
+
+    results = {}
+    for module, forbidden in CHECKS.items():
+        runs = [time_import(module) for _ in range(repeats)]
+        loaded = runs[-1][1]
+
+        results[module] = {'times': [x[0] for x in runs], 'median': float(np.median([x[0] for x in runs])), 'loaded': loaded, \
+                            'unexpected': [x for x in loaded if x in forbidden]}
+
+    return results
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Time the imports of the MIND modules and check which dependencies they load.')
+    parser.add_argument('--repeats', type=int, default=5, help='number of fresh processes each import is timed in.')
+    parser.add_argument('--max-core-overhead', type=float, default=None, help='fail if MIND_helpers takes this many seconds longer to import than NumPy and scipy.spatial.')
+    parser.add_argument('--output', default=None, help='optional JSON file to write the results to.')
+    args = parser.parse_args(args)
+
+    results = measure_import_times(repeats=args.repeats)
+    core_overhead = results['MIND_helpers']['median'] - results['numpy, scipy.spatial']['median']
+
+    failures = []
+    for module, result in results.items():
+        print('%s: %.3fs, loads %s' % (module, result['median'], ', '.join(result['loaded']) if len(result['loaded']) > 0 else 'none of ' + ', '.join(TRACKED)))
+        if len(result['unexpected']) > 0:
+            failures.append(module + ' loads ' + ', '.join(result['unexpected']) + ' at import time.')
+
+    print('MIND_helpers overhead over NumPy and scipy.spatial: %.3fs' % core_overhead)
+    if (args.max_core_overhead is not None) and (core_overhead > args.max_core_overhead):
+        failures.append('MIND_helpers overhead of %.3fs is above %.3fs.' % (core_overhead, args.max_core_overhead))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'core_overhead': core_overhead}, f, indent=2)
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+
+    return len(failures) == 0
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
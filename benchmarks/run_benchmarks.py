@@ -0,0 +1,142 @@
+'''
+Benchmarks the stages of a MIND computation on synthetic subjects and writes the timings to a JSON file.
+
+For every combination of region count, vertex count, feature count and duplicate rate, a synthetic subject is written with
+synthetic_subject.py and the following stages are timed separately:
+    • get_vertex_df: loading the surface files and parcellation.
+    • filter_and_standardize: the filtering and z-scoring step of compute_MIND.
+    • region_blocks: grouping the vertices into per-region blocks.
+    • tree_building: building the KD-trees and self-neighbour distances of every region.
+    • pairwise_KL: the loop over all region pairs, using the trees built in the previous stage.
+    • calculate_mind_network: the whole network computation (blocks, trees and pairs), in each of the requested query modes.
+
+Example:
+    python benchmarks/run_benchmarks.py --n-regions 68 308 --n-vertices 50000 --output results.json
+
+Two result files can be compared with compare_benchmarks.py.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import scipy
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from MIND import filter_and_standardize
+from MIND_helpers import calculate_mind_network, calculate_mind_pairs, build_region_trees, get_region_blocks
+from get_vertex_df import get_vertex_df
+from synthetic_subject import make_synthetic_subject
+
+def get_environment():
+
+    #Versions and machine details, so results from different runs can be matched up.
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__, \
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def time_stage(function, repeats):
+
+    #Runs function repeats times (silencing its prints), returning its last output and the timings.
+    times = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            output = function()
+            times.append(time.perf_counter() - start)
+
+    return output, {'times': times, 'min': min(times), 'median': float(np.median(times))}
+
+def run_benchmark(surf_dir, features, parcellation, repeats = 1, query_modes = ('pairwise',), n_jobs = 1):
+
+    '''
+    Times every stage of a MIND computation for one subject. Returns a dict of stage name to timings.
+    '''
+
+    stages = {}
+
+    (vertex_data, regions, features_used), stages['get_vertex_df'] = time_stage(lambda: get_vertex_df(surf_dir, features, parcellation), repeats)
+
+    vertex_data, stages['filter_and_standardize'] = time_stage(lambda: filter_and_standardize(vertex_data, features, features_used, filter_vertices=True), repeats)
+
+    values = vertex_data[features_used].to_numpy(dtype=float)
+    labels = vertex_data['Label'].to_numpy()
+
+    (blocks, offsets), stages['region_blocks'] = time_stage(lambda: get_region_blocks(values, labels, regions), repeats)
+
+    present = np.flatnonzero(np.diff(offsets) > 0)
+    pairs = [(i, j) for a, i in enumerate(present) for j in present[a+1:]]
+
+    cache, stages['tree_building'] = time_stage(lambda: build_region_trees(blocks, offsets, present), repeats)
+    _, stages['pairwise_KL'] = time_stage(lambda: calculate_mind_pairs(blocks, offsets, pairs, n_jobs=n_jobs, cache=cache), repeats)
+
+    for query_mode in query_modes:
+        _, stages['calculate_mind_network_' + query_mode] = time_stage(lambda: calculate_mind_network(vertex_data, features_used, regions, \
+                                                                        query_mode=query_mode, n_jobs=n_jobs), repeats)
+
+    return stages
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the stages of a MIND computation on synthetic FreeSurfer subjects.')
+    parser.add_argument('--n-regions', type=int, nargs='+', default=[68, 308, 360, 1000], help='total numbers of regions (both hemispheres).')
+    parser.add_argument('--n-vertices', type=int, nargs='+', default=[150000], help='numbers of vertices per hemisphere.')
+    parser.add_argument('--n-features', type=int, nargs='+', default=[5], help='numbers of features.')
+    parser.add_argument('--duplicate-rates', type=float, nargs='+', default=[0.0], help='fractions of vertices with repeated values.')
+    parser.add_argument('--query-modes', nargs='+', default=['pairwise', 'batched'], help='query modes to time calculate_mind_network with.')
+    parser.add_argument('--repeats', type=int, default=1, help='number of times each stage is timed.')
+    parser.add_argument('--n-jobs', type=int, default=1, help='number of threads for the nearest neighbour queries.')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic subjects.')
+    parser.add_argument('--work-dir', default=None, help='directory to write the synthetic subjects to (defaults to a temporary directory).')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write the results to.')
+    args = parser.parse_args(args)
+
+    results = {'environment': get_environment(), 'results': []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir if args.work_dir is not None else tmp_dir
+
+        for n_regions in args.n_regions:
+            for n_vertices in args.n_vertices:
+                for n_features in args.n_features:
+                    for duplicate_rate in args.duplicate_rates:
+
+                        config = {'n_regions': n_regions, 'n_vertices': n_vertices, 'n_features': n_features, 'duplicate_rate': duplicate_rate}
+                        name = '_'.join(key + '-' + str(value) for key, value in config.items())
+                        print('Running ' + name)
+
+                        surf_dir = os.path.join(work_dir, name)
+                        features = make_synthetic_subject(surf_dir, n_vertices=n_vertices, n_regions=n_regions, n_features=n_features, \
+                                                            duplicate_rate=duplicate_rate, random_state=args.seed)
+
+                        #Record failures (e.g. too many repeated values) rather than stopping the whole run.
+                        try:
+                            config['stages'] = run_benchmark(surf_dir, features, 'synthetic', repeats=args.repeats, query_modes=args.query_modes, n_jobs=args.n_jobs)
+                            config['error'] = None
+                        except Exception as e:
+                            config['stages'] = {}
+                            config['error'] = str(e)
+
+                        results['results'].append(config)
+
+                        #Write after every configuration, so partial results survive an interrupted run.
+                        with open(args.output, 'w') as f:
+                            json.dump(results, f, indent=2)
+
+    return results
+
+if __name__ == '__main__':
+    main()
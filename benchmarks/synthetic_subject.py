@@ -0,0 +1,72 @@
+'''
+Writes synthetic FreeSurfer subjects for benchmarking: surf/?h.<feature> morph data files and label/?h.<parcellation>.annot files,
+laid out like a real FreeSurfer output directory so they can be passed to compute_MIND as surf_dir.
+'''
+
+import os
+import numpy as np
+from nibabel.freesurfer.io import write_morph_data, write_annot
+
+#File names of the compute_MIND shorthand features, in the order they are used. Further features are written as ?h.feature_<i>.
+SHORTHAND_FEATURES = [('CT', 'thickness'), ('Vol', 'volume'), ('SA', 'area'), ('MC', 'curv'), ('SD', 'sulc')]
+
+def make_synthetic_subject(surf_dir, n_vertices = 150000, n_regions = 68, n_features = 5, duplicate_rate = 0.0, \
+                            parcellation = 'synthetic', random_state = None):
+
+    '''
+    Writes a synthetic subject to surf_dir and returns the features argument to pass to compute_MIND for it.
+
+    • n_vertices (int): number of vertices per hemisphere.
+    • n_regions (int): total number of regions, split evenly between the hemispheres (e.g. 68, 308, 360 or 1000).
+    • n_features (int): number of features. The first five are the CT, Vol, SA, MC and SD files, any more are written as ?h.feature_<i>.
+    • duplicate_rate (float): fraction of vertices whose values are copied from another vertex in the same region, as FreeSurfer occasionally
+    outputs. Note that MIND refuses data where more than 20% of the vertices are repeated.
+    • parcellation (str): name of the parcellation, written to label/?h.<parcellation>.annot.
+
+    Region sizes vary (drawn from a Dirichlet distribution), about 5% of the vertices are left unlabelled (the medial wall), and every
+    region has its own mean and spread for each feature so that the MIND networks are not trivial.
+    '''
+
+    rng = np.random.default_rng(random_state)
+
+    os.makedirs(os.path.join(surf_dir, 'surf'), exist_ok=True)
+    os.makedirs(os.path.join(surf_dir, 'label'), exist_ok=True)
+
+    regions_per_hemi = n_regions // 2
+    feature_files = [x[1] for x in SHORTHAND_FEATURES[:n_features]] + ['feature_' + str(i) for i in range(len(SHORTHAND_FEATURES), n_features)]
+
+    for hemi in ['lh', 'rh']:
+
+        #Label 0 is the unlabelled medial wall, regions are 1..regions_per_hemi.
+        region_sizes = rng.dirichlet(np.full(regions_per_hemi, 5.0))
+        labels = rng.choice(np.arange(1, regions_per_hemi + 1), size=n_vertices, p=region_sizes)
+        labels[rng.random(n_vertices) < 0.05] = 0
+
+        names = [b'unknown'] + [(hemi + '_region_' + str(i)).encode() for i in range(1, regions_per_hemi + 1)]
+
+        #Distinct colours, so every region gets its own annotation value.
+        colours = (np.arange(regions_per_hemi + 1) * 7919 + 1) % 2**24
+        ctab = np.column_stack([colours % 2**8, colours // 2**8 % 2**8, colours // 2**16, np.zeros_like(colours)])
+
+        write_annot(os.path.join(surf_dir, 'label', hemi + '.' + parcellation + '.annot'), labels, ctab, names, fill_ctab=True)
+
+        region_means = rng.normal(size=(regions_per_hemi + 1, n_features))
+        region_scales = rng.uniform(0.5, 1.5, size=(regions_per_hemi + 1, n_features))
+        values = region_means[labels] + region_scales[labels] * rng.normal(size=(n_vertices, n_features))
+
+        #Thickness, volume and area are positive.
+        values[:, :min(n_features, 3)] = np.abs(values[:, :min(n_features, 3)]) + 0.1
+
+        if duplicate_rate > 0:
+            copies = np.flatnonzero(rng.random(n_vertices) < duplicate_rate)
+
+            #Pick a random vertex of the same region for every copy, from the vertices sorted by region.
+            order = np.argsort(labels, kind='stable')
+            starts = np.searchsorted(labels[order], labels[copies])
+            sources = order[starts + (rng.random(len(copies)) * np.bincount(labels)[labels[copies]]).astype(int)]
+            values[copies] = values[sources]
+
+        for i, name in enumerate(feature_files):
+            write_morph_data(os.path.join(surf_dir, 'surf', hemi + '.' + name), values[:, i].astype('>f4'))
+
+    return [x[0] for x in SHORTHAND_FEATURES[:n_features]] + feature_files[len(SHORTHAND_FEATURES):]
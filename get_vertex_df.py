@@ -3,53 +3,20 @@ import numpy as np
 import os
 import pandas as pd
 from os.path import exists
-from nibabel.freesurfer.io import read_morph_data, read_annot
-from nibabel.freesurfer.mghformat import load
 from collections import defaultdict
-from MIND_helpers import calculate_mind_network, is_outlier
+import tracemalloc
+from vertex_cache import load_annot, load_feature, map_or_load_feature, memory_cached
+from MIND_profiler import log_detail, add_profile_count
+from MIND_helpers import check_repeated_values
 
-def get_vertex_df(surf_dir, features, parcellation):
+def get_feature_locs(surf_dir, features):
 
     '''
-    INPUT SPECIFICATIONS:
-    • surf_dir (str) : This is a string the location containing all relevant directories output by FreeSurfer (i.e. label, mri, surf).
-
-    • features (list):
-        This function accepts the "features" argument as a list containing items in the following forms:
-            str: 
-
-                • One of ['CT','Vol','SA','MC','SD']. In this form, the function will automatically assume that the requested features are found in the surf_dir/surf directory and correspond to the following files:
-                    CT: ?h.thickness
-                    Vol: ?h.volume
-                    SA: ?h.area
-                    MC: ?h.curv
-                    SD: ?h.sulc 
-
-                • You may also pass a string in the form 'thickness', 'volume', 'sulc', etc, which refer directly to default files already found in the surf_dir/surf directory for both rh and lh.
-                For example, the function will interpret the entry 'thickness' to refer to the files surf_dir/surf/lh.thickness and surf_dir/surf/rh.thickness
-
-                • Finally, you may pass a string in the form of a FULL path as follows: with a question mark '?' indicating the position specifying the hemisphere such as "full/path/to/?h.feature".
-                Using this formulation will cause the command to look for files that exactly match both "full/path/to/lh.feature" and "full/path/to/rh.feature". If the left and right version of the files aren't exactly the same otherwise, this won't work.
-
-
-            tuple: (path/to/lh_surface_feature, path/to/rh_surface_feature)
-                • If you would rather pass other features directly into the function, you must specify the locations (using paths) of both the left and right versions of each desired feature as a tuple.
-                **The files must be readable by nibabel's read_morph_data function, i.e. in FreeSurfer's surface format!***
-                So for example, if you have used the provided register_and_vol2surf function to generate surface maps of fractional anisotropy in a separate folder, you could pass them as an element in the list like:
-                (path/to/lh.FA.mgh, path/to/rh.FA.mgh)
-
-        A valid list of feature values combining these different input types would therefore be: ['CT','SD',(path/to/lh_feature1, path/to/rh_feature1), (path/to/lh_feature2, path/to/rh_feature2)] 
-    
-    • parcellation (str): This is a string the location containing parcellation scheme to be used. The files 'lh.' + parcellation + '.annot' and 'rh.' + parcellation + '.annot' must exist inside the surf_dir/label directory.
+    Resolves the features argument of get_vertex_df (see its description) into lists of left and right hemisphere file locations.
     '''
 
-    #specify data locations
     surfer_location = surf_dir + '/'
 
-    #Check inputs!
-    if (exists(surfer_location + '/label/lh.' + parcellation + '.annot') == False) or (exists(surfer_location + '/label/rh.' + parcellation + '.annot') == False):
-        raise Exception('Parcellation files not found.')
-
     all_shorthand_features = ['CT','Vol','SA','MC','SD']
     all_shorthand_features_dict = dict(zip(all_shorthand_features, ['thickness','volume','area','curv','sulc']))
     
@@ -112,9 +79,50 @@ def get_vertex_df(surf_dir, features, parcellation):
         else:
             raise Exception('Unrecognized format for feature input: ', feature)
 
+    return lh_feature_locs, rh_feature_locs
+
+def check_vertex_counts(hemi, annot_lengths, feature_lengths):
+
+    '''
+    Checks that every parcellation (annot_lengths, {parcellation: number of labels}) and feature file (feature_lengths, {path: number of values})
+    of a hemisphere has the same number of vertices, raising an exception naming the files that don't match otherwise. A parcellation made
+    for another surface (e.g. fsaverage labels on a native subject) would otherwise fail with an unclear error or misalign the labels.
+    '''
+
+    n_vertices = list(feature_lengths.values())[0] if len(feature_lengths) > 0 else list(annot_lengths.values())[0]
+
+    for name, n in annot_lengths.items():
+        if n != n_vertices:
+            raise Exception('Parcellation ' + name + ' has ' + str(n) + ' ' + hemi + ' vertices, but the ' + hemi + ' surface features have ' \
+                            + str(n_vertices) + '. Its .annot file must be for the same surface as the features.')
+
+    for path, n in feature_lengths.items():
+        if n != n_vertices:
+            raise Exception('Feature file ' + path + ' has ' + str(n) + ' vertices, but the other ' + hemi + ' surface features have ' + str(n_vertices) + '.')
+
+def get_parcellation(surf_dir, parcellation, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    Reads the lh and rh .annot files for a parcellation and works out the region names.
+
+    Returns:
+    • annot_dict: the (labels, ctab, names) annotation for each hemisphere.
+    • convert_dicts: for each hemisphere, a dict converting annotation label values to region names (prefixed with lh_ or rh_).
+    • used_labels: for each hemisphere, the annotation label values that are assigned to at least one vertex.
+    • combined_regions: the names of all used regions, excluding unknown / medial wall regions.
+    '''
+
+    #The parsed annotations and region names are kept in memory if vertex_cache.set_memory_cache is on (e.g. in MIND_server.py).
+    annot_locs = [surf_dir + '/label/' + hemi + '.' + parcellation + '.annot' for hemi in ['lh','rh']]
+    return memory_cached('parcellation', annot_locs, lambda: _get_parcellation(surf_dir, parcellation, cache_dir, max_cache_bytes))
+
+def _get_parcellation(surf_dir, parcellation, cache_dir, max_cache_bytes):
+
+    surfer_location = surf_dir + '/'
+
     #Get annotation files
-    lh_annot = read_annot(surfer_location + '/label/lh.' + parcellation + '.annot', orig_ids = True)
-    rh_annot = read_annot(surfer_location + '/label/rh.' + parcellation + '.annot', orig_ids = True)
+    lh_annot = load_annot(surfer_location + '/label/lh.' + parcellation + '.annot', cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+    rh_annot = load_annot(surfer_location + '/label/rh.' + parcellation + '.annot', cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
 
     annot_dict = {'lh':lh_annot, 'rh':rh_annot}
 
@@ -149,55 +157,271 @@ def get_vertex_df(surf_dir, features, parcellation):
     unknown_regions = [x for x in combined_regions if (('?' in x) | ('unknown' in x) | ('Unknown' in x) | ('Medial_Wall' in x) | (len(x) == 3))]
     combined_regions = np.array([x for x in combined_regions if x not in unknown_regions])
 
+    return annot_dict, convert_dicts, used_labels, combined_regions
+
+def get_vertex_df(surf_dir, features, parcellation, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    INPUT SPECIFICATIONS:
+    • surf_dir (str) : This is a string the location containing all relevant directories output by FreeSurfer (i.e. label, mri, surf).
+
+    • features (list):
+        This function accepts the "features" argument as a list containing items in the following forms:
+            str: 
+
+                • One of ['CT','Vol','SA','MC','SD']. In this form, the function will automatically assume that the requested features are found in the surf_dir/surf directory and correspond to the following files:
+                    CT: ?h.thickness
+                    Vol: ?h.volume
+                    SA: ?h.area
+                    MC: ?h.curv
+                    SD: ?h.sulc 
+
+                • You may also pass a string in the form 'thickness', 'volume', 'sulc', etc, which refer directly to default files already found in the surf_dir/surf directory for both rh and lh.
+                For example, the function will interpret the entry 'thickness' to refer to the files surf_dir/surf/lh.thickness and surf_dir/surf/rh.thickness
+
+                • Finally, you may pass a string in the form of a FULL path as follows: with a question mark '?' indicating the position specifying the hemisphere such as "full/path/to/?h.feature".
+                Using this formulation will cause the command to look for files that exactly match both "full/path/to/lh.feature" and "full/path/to/rh.feature". If the left and right version of the files aren't exactly the same otherwise, this won't work.
+
+
+            tuple: (path/to/lh_surface_feature, path/to/rh_surface_feature)
+                • If you would rather pass other features directly into the function, you must specify the locations (using paths) of both the left and right versions of each desired feature as a tuple.
+                **The files must be readable by nibabel's read_morph_data function, i.e. in FreeSurfer's surface format!***
+                So for example, if you have used the provided register_and_vol2surf function to generate surface maps of fractional anisotropy in a separate folder, you could pass them as an element in the list like:
+                (path/to/lh.FA.mgh, path/to/rh.FA.mgh)
+
+        A valid list of feature values combining these different input types would therefore be: ['CT','SD',(path/to/lh_feature1, path/to/rh_feature1), (path/to/lh_feature2, path/to/rh_feature2)] 
+    
+    • parcellation (str): This is a string the location containing parcellation scheme to be used. The files 'lh.' + parcellation + '.annot' and 'rh.' + parcellation + '.annot' must exist inside the surf_dir/label directory.
+    A list of parcellation names can also be given, in which case the features are only loaded once and the output has one label column per parcellation,
+    named 'Label_' + parcellation (vertices outside a parcellation's regions get NaN), and the returned regions are a dict keyed by parcellation name.
+    Every parcellation must have the same number of vertices as the surface features (an exception naming the parcellation is raised otherwise).
+
+    • cache_dir (str): Optional directory for an on-disk cache of the parsed annotation and feature files (see vertex_cache.py). Later calls using
+    any subset of the same, unchanged files load them from the cache through memory mapping instead of re-reading them with nibabel.
+
+    • max_cache_bytes (int): Optional size limit for cache_dir. The least recently used entries are deleted once the cache grows beyond it.
+    '''
+
+    #specify data locations
+    surfer_location = surf_dir + '/'
+
+    #Several parcellations can be loaded at once, sharing the same feature data. Each then gets its own label column.
+    parcellations = parcellation if type(parcellation) is list else [parcellation]
+    label_cols = ['Label_' + x for x in parcellations] if type(parcellation) is list else ['Label']
+
+    #Check inputs!
+    for x in parcellations:
+        if (exists(surfer_location + '/label/lh.' + x + '.annot') == False) or (exists(surfer_location + '/label/rh.' + x + '.annot') == False):
+            raise Exception('Parcellation files not found.')
+
+    lh_feature_locs, rh_feature_locs = get_feature_locs(surf_dir, features)
+
+    parcellation_info = [get_parcellation(surf_dir, x, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes) for x in parcellations]
+
     vertex_data_dict = defaultdict()
 
     #Now load up all the vertex-level data!
     for hemi in ['lh','rh']:
-        print(hemi)
         hemi_data_dict = defaultdict()
 
         if hemi == 'lh':
-            print('Loading left hemisphere data:')
+            log_detail('Loading left hemisphere data:')
 
             for i, lh_feature_loc in enumerate(lh_feature_locs):
-                print(lh_feature_loc)
-                #check for mgh/mgz format vs regular curv files
-                if lh_feature_loc.endswith('mgh') or lh_feature_loc.endswith('mgz'):
-                    hemi_data_dict['Feature_' + str(i)] = load(lh_feature_loc).get_fdata().flatten()
-                else:
-                    hemi_data_dict['Feature_' + str(i)] = read_morph_data(lh_feature_loc)
+                log_detail(lh_feature_loc)
+                hemi_data_dict['Feature_' + str(i)] = load_feature(lh_feature_loc, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
 
         elif hemi == 'rh':
-            print('Loading right hemisphere data:')
+            log_detail('Loading right hemisphere data:')
 
             for i, rh_feature_loc in enumerate(rh_feature_locs):
+                log_detail(rh_feature_loc)
+                hemi_data_dict['Feature_' + str(i)] = load_feature(rh_feature_loc, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
 
-                if rh_feature_loc.endswith('mgh') or rh_feature_loc.endswith('mgz'):
-                    hemi_data_dict['Feature_' + str(i)] = load(rh_feature_loc).get_fdata().flatten()
-                else:
-                    hemi_data_dict['Feature_' + str(i)] = read_morph_data(rh_feature_loc)
+        feature_locs = lh_feature_locs if hemi == 'lh' else rh_feature_locs
+        check_vertex_counts(hemi, {x: len(info[0][hemi][0]) for x, info in zip(parcellations, parcellation_info)}, \
+                            {loc: len(hemi_data_dict['Feature_' + str(i)]) for i, loc in enumerate(feature_locs)})
 
         used_features = list(hemi_data_dict.keys())
-        print(used_features)
-        hemi_data = np.zeros((len(used_features) + 1, len(annot_dict[hemi][0])))
+        hemi_data = np.zeros((len(used_features) + len(label_cols), len(parcellation_info[0][0][hemi][0])))
+
+        for k, (annot_dict, convert_dicts, used_labels, combined_regions) in enumerate(parcellation_info):
+            hemi_data[k] = annot_dict[hemi][0]
 
-        hemi_data[0] = annot_dict[hemi][0]
         for i, feature in enumerate(used_features):
-            print(i, feature)
-            hemi_data[i + 1] = hemi_data_dict[feature]
+            hemi_data[i + len(label_cols)] = hemi_data_dict[feature]
         
-        col_names = ['Label'] + used_features
+        col_names = label_cols + used_features
         hemi_data = pd.DataFrame(hemi_data.T, columns = col_names)
         
-        #Select only the vertices that map to regions.
-        hemi_data = hemi_data.loc[hemi_data['Label'].isin(used_labels[hemi])]
+        #Select only the vertices that map to regions (in at least one of the parcellations).
+        in_regions = np.zeros(len(hemi_data), dtype=bool)
+        for label_col, (annot_dict, convert_dicts, used_labels, combined_regions) in zip(label_cols, parcellation_info):
+            in_regions |= hemi_data[label_col].isin(used_labels[hemi]).values
+
+        hemi_data = hemi_data.loc[in_regions]
         
-        hemi_data["Label"] = hemi_data["Label"].map(convert_dicts[hemi])
+        for label_col, (annot_dict, convert_dicts, used_labels, combined_regions) in zip(label_cols, parcellation_info):
+            hemi_data[label_col] = hemi_data[label_col].map(convert_dicts[hemi])
         vertex_data_dict[hemi] = hemi_data
 
     vertex_data = pd.concat([vertex_data_dict['lh'], vertex_data_dict['rh']], ignore_index = True)
 
+    if type(parcellation) is list:
+        combined_regions = dict(zip(parcellations, [x[3] for x in parcellation_info]))
+    else:
+        combined_regions = parcellation_info[0][3]
+
+    add_profile_count('vertices_loaded', len(vertex_data))
+
     #Output data
-    print("features used: ")
-    print(used_features)
+    log_detail('Features used: ' + ', '.join(used_features))
     return vertex_data, combined_regions, used_features
+
+
+def get_vertex_array(surf_dir, features, parcellation, dtype=np.float32, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    Low-memory alternative to get_vertex_df, taking the same surf_dir, features, parcellation, cache_dir and max_cache_bytes inputs.
+
+    Instead of building per-hemisphere DataFrames with a string label per vertex, the feature files are memory mapped where possible
+    (uncompressed .mgh and FreeSurfer morph files) and copied directly into a single preallocated array of the requested dtype,
+    with the vertices already sorted by region. Each vertex gets an integer region code rather than a region name.
+
+    Returns:
+    • values (np.ndarray): n_vertices X n_features array of dtype, sorted by region code. Vertices that don't map to a region are dropped.
+    • codes (np.ndarray): int32 region code of each vertex, in ascending order. These index into vertex_regions.
+    • vertex_regions (np.ndarray): names of all regions that have vertices, including unknown / medial wall regions.
+    • combined_regions (np.ndarray): region names excluding the unknown regions, as returned by get_vertex_df.
+    • used_features (list): feature names, as returned by get_vertex_df.
+    '''
+
+    surfer_location = surf_dir + '/'
+
+    if (exists(surfer_location + '/label/lh.' + parcellation + '.annot') == False) or (exists(surfer_location + '/label/rh.' + parcellation + '.annot') == False):
+        raise Exception('Parcellation files not found.')
+
+    lh_feature_locs, rh_feature_locs = get_feature_locs(surf_dir, features)
+    feature_locs = {'lh': lh_feature_locs, 'rh': rh_feature_locs}
+
+    annot_dict, convert_dicts, used_labels, combined_regions = get_parcellation(surf_dir, parcellation, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+
+    #First work out where every vertex goes in the output, so the feature data only needs to be copied once.
+    vertex_regions = []
+    hemi_orders = {}
+    hemi_codes = {}
+
+    for hemi in ['lh','rh']:
+        labels = np.asarray(annot_dict[hemi][0])
+        label_ids = np.array([key for key in convert_dicts[hemi].keys() if key in used_labels[hemi]])
+
+        sorter = np.argsort(label_ids)
+        positions = np.clip(np.searchsorted(label_ids, labels, sorter=sorter), 0, len(label_ids) - 1)
+        keep = label_ids[sorter[positions]] == labels
+        codes = len(vertex_regions) + sorter[positions[keep]]
+
+        order = np.argsort(codes, kind='stable')
+        hemi_orders[hemi] = np.flatnonzero(keep)[order]
+        hemi_codes[hemi] = codes[order]
+
+        vertex_regions += [convert_dicts[hemi][key] for key in label_ids]
+
+    n_vertices = len(hemi_orders['lh']) + len(hemi_orders['rh'])
+    values = np.empty((n_vertices, len(lh_feature_locs)), dtype=dtype)
+    codes = np.empty(n_vertices, dtype=np.int32)
+
+    start = 0
+    for hemi in ['lh','rh']:
+        stop = start + len(hemi_orders[hemi])
+        codes[start:stop] = hemi_codes[hemi]
+
+        for i, feature_loc in enumerate(feature_locs[hemi]):
+            data = map_or_load_feature(feature_loc, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+            check_vertex_counts(hemi, {parcellation: len(annot_dict[hemi][0])}, {feature_loc: len(data)})
+            values[start:stop, i] = data[hemi_orders[hemi]]
+
+        start = stop
+
+    used_features = ['Feature_' + str(i) for i in range(len(lh_feature_locs))]
+    add_profile_count('vertices_loaded', n_vertices)
+
+    return values, codes, np.array(vertex_regions), combined_regions, used_features
+
+def get_surface_vertex_data(surf_dir, features, parcellation, filter_vertices=False, max_duplicate_rate=0.2):
+
+    '''
+    Loads and standardizes the vertex data for analyses that need to know where every vertex lies on the surface (spin nulls, mesh
+    adjacency), keeping every vertex in surface order (lh then rh). Filtering and standardization are the same as in compute_MIND.
+
+    Returns a dict with:
+    • 'values': n_used_vertices X n_features array of standardized values of the used vertices.
+    • 'codes': region code of every vertex (indexing into 'regions'), or -1 for unknown regions and unlabelled vertices.
+    • 'valid': boolean mask over every vertex of the vertices in 'values'.
+    • 'regions': region names (combined_regions from get_parcellation).
+    • 'hemi_sizes': number of vertices in each hemisphere.
+
+    As in compute_MIND, an exception is raised if more than max_duplicate_rate of the used vertices repeat another vertex's values (None skips
+    the check), and if the parcellation and feature files don't have the same number of vertices.
+    '''
+
+    lh_feature_locs, rh_feature_locs = get_feature_locs(surf_dir, features)
+    annot_dict, convert_dicts, used_labels, combined_regions = get_parcellation(surf_dir, parcellation)
+    region_codes = dict(zip(combined_regions, range(len(combined_regions))))
+
+    values = []
+    codes = []
+    used = []
+
+    for hemi, feature_locs in [('lh', lh_feature_locs), ('rh', rh_feature_locs)]:
+        labels = np.asarray(annot_dict[hemi][0])
+
+        #Code of each vertex's region in combined_regions, or -1 for unknown regions and unlabelled vertices.
+        unique_labels, inverse = np.unique(labels, return_inverse=True)
+        unique_codes = np.array([region_codes.get(convert_dicts[hemi].get(x), -1) for x in unique_labels])
+
+        hemi_values = [np.asarray(load_feature(x), dtype=float) for x in feature_locs]
+        check_vertex_counts(hemi, {parcellation: len(labels)}, dict(zip(feature_locs, [len(x) for x in hemi_values])))
+
+        codes.append(unique_codes[inverse])
+        used.append(np.isin(labels, used_labels[hemi]))
+        values.append(np.column_stack(hemi_values))
+
+    hemi_sizes = [len(x) for x in codes]
+    values = np.vstack(values)
+    codes = np.concatenate(codes)
+    used = np.concatenate(used)
+
+    if filter_vertices == True:
+        for i, x in enumerate(features):
+            if x in ['CT','Vol','SA']:
+                used &= values[:,i] != 0
+
+    if max_duplicate_rate is not None:
+        check_repeated_values(values[used], max_duplicate_rate)
+
+    #standardize across the brain for each feature, over the same vertices as compute_MIND.
+    values = (values - values[used].mean(axis=0)) / values[used].std(axis=0, ddof=1)
+
+    return {'values': values[used], 'codes': codes, 'valid': used, 'regions': combined_regions, 'hemi_sizes': hemi_sizes}
+
+def compare_vertex_loading_memory(surf_dir, features, parcellation, dtype=np.float32):
+
+    '''
+    Measures the peak memory (in bytes, as traced by tracemalloc) used to load the same vertex data with get_vertex_df and with get_vertex_array.
+    Memory mapped file pages are not counted, since they are not allocated by Python.
+    Returns a dict with both peaks and the fraction of peak memory saved by get_vertex_array.
+    '''
+
+    peaks = {}
+
+    for name, loader in [('get_vertex_df', lambda: get_vertex_df(surf_dir, features, parcellation)), \
+                        ('get_vertex_array', lambda: get_vertex_array(surf_dir, features, parcellation, dtype=dtype))]:
+        tracemalloc.start()
+        output = loader()
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del output
+
+    peaks['saving'] = 1 - peaks['get_vertex_array'] / peaks['get_vertex_df']
+
+    return peaks
@@ -1,16 +1,62 @@
 import os
-from nipype.interfaces.freesurfer import BBRegister, SampleToSurface, ApplyVolTransform
-from nipype.interfaces import afni
-import nipype.interfaces.freesurfer as fs
+from step_scheduler import make_step, run_steps
 
 #Must have SUBJECTS_DIR set as per standard Freesurfer conventions.
 
-def register_and_vol2surf(mov, subject_id, out_dir, b0 = None, feature_name = 'vol-feature', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True):
-	
+#Both functions below build their commands as steps for step_scheduler.run_steps, which runs the two hemispheres in parallel and skips
+#any step whose outputs are newer than its inputs. To process several subjects or features at once, collect the steps from
+#get_register_and_vol2surf_steps / get_surface_t1t2_ratio_steps for each of them and pass them all to run_steps together.
+#nipype is only imported when a command is built, so importing this module (e.g. to set up steps) stays cheap.
+
+def get_sampling_step(name, subject_id, hemi, source_file, reg_file, out_file, sampling_method, sampling_units, sampling_range):
+
+	#Projection of a volume registered with reg_file to the white surface of one hemisphere.
+	#The nipype interfaces check that their input files exist, so the command is only built when the step runs.
+	def get_command():
+		from nipype.interfaces.freesurfer import SampleToSurface
+		sampler = SampleToSurface(subject_id=subject_id, hemi=hemi, cortex_mask = True, \
+			subjects_dir=os.environ.get("SUBJECTS_DIR"), source_file = source_file, reg_file=reg_file, \
+			sampling_method = sampling_method, sampling_units = sampling_units, sampling_range = sampling_range, \
+			out_file = out_file, out_type = 'mgz')
+		return sampler.cmdline
+
+	return make_step(name, get_command, inputs = [source_file, reg_file], outputs = [out_file])
+
+def get_register_and_vol2surf_steps(mov, subject_id, out_dir, b0 = None, feature_name = 'vol-feature', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True):
+
+	'''
+	Steps of register_and_vol2surf (same inputs), for step_scheduler.run_steps. Step names start with subject_id/feature_name/.
+	'''
+
+	out_reg_file = out_dir + '/' + feature_name + '-T1-reg.dat'
+	name = str(subject_id) + '/' + feature_name + '/'
+
+	if b0 == None:
+		b0 = mov
+
+	#bbregister. The registration file is an intermediate file, deleted at the end, if cleanup is True.
+	def get_bbreg_command():
+		from nipype.interfaces.freesurfer import BBRegister
+		bbreg = BBRegister(subject_id=subject_id, source_file=b0, subjects_dir=os.environ.get("SUBJECTS_DIR"), init='fsl', contrast_type=contrast, out_reg_file = out_reg_file)
+		return bbreg.cmdline
+
+	steps = [make_step(name + 'bbregister', get_bbreg_command, inputs = [b0], outputs = [out_reg_file], \
+				intermediate = [out_reg_file] if cleanup else [], cleanup = [out_reg_file + '*'] if cleanup else [])]
+
+	#resample to surface, save to out_dir
+	for hemi in ['lh','rh']:
+		steps.append(get_sampling_step(name + 'vol2surf_' + hemi, subject_id, hemi, mov, out_reg_file, out_dir + '/' + hemi + '.' + feature_name + '.mgz', \
+						sampling_method, sampling_units, sampling_range))
+
+	return steps
+
+def register_and_vol2surf(mov, subject_id, out_dir, b0 = None, feature_name = 'vol-feature', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True, n_workers=2, executables=None, \
+						raise_on_failure=True):
+
 	'''
 	This commands registers a volumetric image to T1 then projects to the white surface.
-	Note that the SUBJECTS_DIR environmental variable needs to be set correctly, and Freesurfer available on the system. 
-	
+	Note that the SUBJECTS_DIR environmental variable needs to be set correctly, and Freesurfer available on the system.
+
 	Description of inputs:
 
 	mov: the volume to be registered.
@@ -23,35 +69,92 @@ def register_and_vol2surf(mov, subject_id, out_dir, b0 = None, feature_name = 'v
 	sampling method: 'point’ or ‘max’ or ‘average,’ tells the command how to sample.
 	sampling range: a float or a tuple of the form: (a float, a float, a float)) – Sampling range - a point or a tuple of (min, max, step).
 	cleanup: boolean, whether to delete all intermediate files or not.
+	n_workers: number of commands to run at the same time.
+	executables: optional dict of replacements for the FreeSurfer programs, e.g. stand-ins for testing (see step_scheduler.run_steps).
+
+	raise_on_failure: if True (the default), an exception naming the failed steps and their errors is raised if any command fails. If False,
+	failures are only logged as warnings and reported in the returned table.
+
+	Steps whose outputs are newer than their inputs are skipped. Returns a table with the status of each step (see step_scheduler.run_steps).
+	'''
+
+	steps = get_register_and_vol2surf_steps(mov, subject_id, out_dir, b0 = b0, feature_name = feature_name, contrast = contrast, sampling_units = sampling_units, \
+											sampling_range = sampling_range, sampling_method = sampling_method, cleanup = cleanup)
+
+	return run_steps(steps, n_workers = n_workers, executables = executables, raise_on_failure = raise_on_failure)
+
+def get_surface_t1t2_ratio_steps(t2_loc, subject_id, out_dir, t1_loc = None, feature_name = 'T2', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True):
+
+	'''
+	Steps of calculate_surface_t1t2_ratio (same inputs), for step_scheduler.run_steps. Step names start with subject_id/feature_name/.
 	'''
 
 	out_reg_file = out_dir + '/' + feature_name + '-T1-reg.dat'
+	warped_t2 = out_dir + '/T2-warped-to-T1.nii'
+	converted_t1 = out_dir + '/T1.nii.gz'
+	ratio = out_dir + '/T1-over-T2.nii.gz'
+	name = str(subject_id) + '/' + feature_name + '/'
 
-	if b0 == None:
-		b0 == mov
+	if t1_loc == None:
+		t1_loc = os.environ.get('SUBJECTS_DIR') + '/' + subject_id + '/mri/T1.mgz'
+
+	#Intermediate files are deleted at the end if cleanup is True.
+	def as_intermediate(x):
+		return [x] if cleanup else []
 
-	bbreg = BBRegister(subject_id=subject_id, source_file=b0, subjects_dir=os.environ.get("SUBJECTS_DIR"), init='fsl', contrast_type=contrast, out_reg_file = out_reg_file)
-	os.system(bbreg.cmdline)
 	#bbregister
-	#resample to surface, save to the surf folder
+	def get_bbreg_command():
+		from nipype.interfaces.freesurfer import BBRegister
+		bbreg = BBRegister(subject_id=subject_id, source_file=t2_loc, init='fsl', subjects_dir=os.environ.get("SUBJECTS_DIR"), contrast_type=contrast, out_reg_file = out_reg_file)
+		return bbreg.cmdline
 
-	for hemi in ['lh','rh']:
+	#apply volumetric transform to the T1 and T2 images.
+	def get_applyreg_command():
+		import nipype.interfaces.freesurfer as fs
+		applyreg = fs.ApplyVolTransform()
+		applyreg.inputs.source_file = t2_loc
+		applyreg.inputs.reg_file = out_reg_file
+		applyreg.inputs.transformed_file = warped_t2
+		applyreg.inputs.fs_target = True
+		return applyreg.cmdline
+
+	def get_mc_command():
+		import nipype.interfaces.freesurfer as fs
+		mc = fs.MRIConvert()
+		mc.inputs.in_file = t1_loc
+		mc.inputs.out_file = converted_t1
+		mc.inputs.out_type = 'niigz'
+		return mc.cmdline
+
+	def get_calc_command():
+		from nipype.interfaces import afni
+		calc = afni.Calc()
+		calc.inputs.in_file_a = converted_t1
+		calc.inputs.in_file_b = warped_t2
+		calc.inputs.expr='a/b'
+		calc.inputs.out_file = ratio
+		calc.inputs.outputtype = 'NIFTI_GZ'
+		return calc.cmdline + ' -float -fscale'
+
+	#The T1 conversion doesn't depend on the registration, so it runs alongside it.
+	steps = [make_step(name + 'bbregister', get_bbreg_command, inputs = [t2_loc], outputs = [out_reg_file], \
+				intermediate = as_intermediate(out_reg_file), cleanup = [out_reg_file + '*'] if cleanup else []),
+			make_step(name + 'apply_vol_transform', get_applyreg_command, inputs = [t2_loc, out_reg_file], outputs = [warped_t2], intermediate = as_intermediate(warped_t2)),
+			make_step(name + 'mri_convert', get_mc_command, inputs = [t1_loc], outputs = [converted_t1], intermediate = as_intermediate(converted_t1)),
+			make_step(name + '3dcalc', get_calc_command, inputs = [converted_t1, warped_t2], outputs = [ratio], intermediate = as_intermediate(ratio))]
 
-		sampler = SampleToSurface(subject_id=subject_id, hemi=hemi, cortex_mask = True, \
-			subjects_dir=os.environ.get("SUBJECTS_DIR"), source_file = mov, reg_file=out_reg_file, \
-			sampling_method = sampling_method, sampling_units = sampling_units, sampling_range = sampling_range, \
-			out_file = out_dir + '/' + hemi + '.' + feature_name + '.mgz', out_type = 'mgz')
-		sampler.run() 
+	for hemi in ['lh','rh']:
+		steps.append(get_sampling_step(name + 'vol2surf_' + hemi, subject_id, hemi, ratio, out_reg_file, out_dir + '/' + hemi + '.T1-over-T2.mgz', \
+						sampling_method, sampling_units, sampling_range))
 
-	#Remove the generated registration file because nobody wants that lying around!
-	if cleanup==True:
-		os.system('rm ' + out_reg_file + '*')
+	return steps
 
-def calculate_surface_t1t2_ratio(t2_loc, subject_id, out_dir, t1_loc = None, feature_name = 'T2', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True):
+def calculate_surface_t1t2_ratio(t2_loc, subject_id, out_dir, t1_loc = None, feature_name = 'T2', contrast = 't2', sampling_units = 'frac', sampling_range = (0.2,0.8,0.1), sampling_method = 'average', cleanup=True, n_workers=2, executables=None, \
+						raise_on_failure=True):
 
 	'''
 	This commands registers T2 to T1, divides T1 by the registered T2, then projects to the white surface.
-	Note that the SUBJECTS_DIR environmental variable needs to be set correctly, and Freesurfer available on the system. 
+	Note that the SUBJECTS_DIR environmental variable needs to be set correctly, and Freesurfer available on the system.
 	We recommend using the T2.mgz file in the mri/ folder output from freesurfer.
 
 	Description of inputs:
@@ -66,50 +169,16 @@ def calculate_surface_t1t2_ratio(t2_loc, subject_id, out_dir, t1_loc = None, fea
 	sampling method: 'point’ or ‘max’ or ‘average,’ tells the command how to sample.
 	sampling range: a float or a tuple of the form: (a float, a float, a float)) – Sampling range - a point or a tuple of (min, max, step).
 	cleanup: boolean, whether to delete all intermediate files or not.
-	'''
-
-	out_reg_file = out_dir + '/' + feature_name + '-T1-reg.dat'
-	bbreg = BBRegister(subject_id=subject_id, source_file=t2_loc, init='fsl', subjects_dir=os.environ.get("SUBJECTS_DIR"), contrast_type=contrast, out_reg_file = out_reg_file)
-	os.system(bbreg.cmdline)
-	#bbregister
-	#apply volumetric transform to the T1 and T2 images.
+	n_workers: number of commands to run at the same time.
+	executables: optional dict of replacements for the FreeSurfer / AFNI programs, e.g. stand-ins for testing (see step_scheduler.run_steps).
 
-	applyreg = fs.ApplyVolTransform()
-	applyreg.inputs.source_file = t2_loc
-	applyreg.inputs.reg_file = out_reg_file
-	applyreg.inputs.transformed_file = out_dir + '/T2-warped-to-T1.nii'
-	applyreg.inputs.fs_target = True
-	os.system(applyreg.cmdline)
+	raise_on_failure: if True (the default), an exception naming the failed steps and their errors is raised if any command fails. If False,
+	failures are only logged as warnings and reported in the returned table.
 
-	if t1_loc == None:
-		t1_loc = os.environ.get('SUBJECTS_DIR') + '/' + subject_id + '/mri/T1.mgz'
-
-	mc = fs.MRIConvert()
-	mc.inputs.in_file = t1_loc
-	mc.inputs.out_file = out_dir + '/T1.nii.gz'
-	mc.inputs.out_type = 'niigz'
-	os.system(mc.cmdline)
-
-	calc = afni.Calc()
-	calc.inputs.in_file_a = out_dir + '/T1.nii.gz'
-	calc.inputs.in_file_b = out_dir + '/T2-warped-to-T1.nii'
-	calc.inputs.expr='a/b'
-	calc.inputs.out_file = out_dir + '/T1-over-T2.nii.gz'
-	calc.inputs.outputtype = 'NIFTI_GZ'
-	os.system(calc.cmdline + ' -float -fscale')
+	Steps whose outputs are newer than their inputs are skipped. Returns a table with the status of each step (see step_scheduler.run_steps).
+	'''
 
-	for hemi in ['lh','rh']:
+	steps = get_surface_t1t2_ratio_steps(t2_loc, subject_id, out_dir, t1_loc = t1_loc, feature_name = feature_name, contrast = contrast, sampling_units = sampling_units, \
+										sampling_range = sampling_range, sampling_method = sampling_method, cleanup = cleanup)
 
-		sampler = SampleToSurface(subject_id=subject_id, hemi=hemi, subjects_dir=os.environ.get("SUBJECTS_DIR"), \
-			source_file = out_dir + '/T1-over-T2.nii.gz', cortex_mask = True, reg_file=out_reg_file, 
-			sampling_method = sampling_method, sampling_units = sampling_units, \
-			sampling_range = sampling_range, out_file = out_dir + '/' + hemi + '.T1-over-T2.mgz', out_type = 'mgz')
-		res = sampler.run() 
-
-	#Cleanup if desired
-	if cleanup==True:
-		os.system('rm ' + out_reg_file + '*')
-		os.system('rm ' + out_dir + '/T2-warped-to-T1.nii')
-		os.system('rm ' + out_dir + '/T1-over-T2.nii.gz')
-		#get rid of the converted temporary T1 file
-		os.system('rm ' + out_dir + '/T1.nii.gz')
+	return run_steps(steps, n_workers = n_workers, executables = executables, raise_on_failure = raise_on_failure)
@@ -0,0 +1,228 @@
+'''
+A small make-like scheduler for the shell commands in register_and_vol2surf.py.
+
+Each step is a dict (see make_step) with a command and the files it reads and writes. Dependencies between steps are worked out from
+the files: a step that reads a file written by another step runs after it. run_steps then:
+    • skips steps whose outputs all exist and are newer than their inputs, unless a step they depend on has to run.
+    • runs the remaining steps on a bounded pool of worker threads, as soon as the steps they depend on have finished, so independent steps
+    (e.g. the two hemispheres, or different subjects and features) run concurrently.
+    • reports the outcome of every step, and skips the steps that depend on a failed one.
+
+Outputs can be marked as intermediate (e.g. registration files), meaning they may be deleted once everything has finished. A missing
+intermediate file does not make the steps after it out of date: it is only recreated if a step that reads it has to run anyway.
+
+Commands can be given as a string, a list of arguments, or a function returning either, which is only called when the step runs
+(nipype interfaces check that their input files exist, which they may not when the steps are set up). The executables argument of
+run_steps replaces the program a command runs (e.g. {'bbregister': '/path/to/stand-in'}), so a workflow can be tested without FreeSurfer or AFNI.
+'''
+
+import os
+import glob
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from MIND_profiler import log_detail, log_warning
+
+def make_step(name, command, inputs, outputs, intermediate = (), cleanup = ()):
+
+    '''
+    • name (str): unique name of the step, e.g. 'sub-01/FA/bbregister'.
+    • command: shell command string, list of arguments, or function returning either.
+    • inputs (list): files the step reads.
+    • outputs (list): files the step writes.
+    • intermediate (list): the outputs that are only needed by later steps and can be deleted at the end.
+    • cleanup (list): further glob patterns of files to delete at the end (e.g. log files written next to an intermediate output).
+    '''
+
+    return {'name': name, 'command': command, 'inputs': [str(x) for x in inputs], 'outputs': [str(x) for x in outputs], \
+            'intermediate': [str(x) for x in intermediate], 'cleanup': list(cleanup)}
+
+def get_step_order(steps):
+
+    #Returns the steps' dependencies (by name) and an order in which every step comes after the steps it depends on.
+    producers = {}
+    for step in steps:
+        for output in step['outputs']:
+            if output in producers:
+                raise Exception('File ' + output + ' is written by both ' + producers[output] + ' and ' + step['name'] + '.')
+            producers[output] = step['name']
+
+    dependencies = {step['name']: set(producers[x] for x in step['inputs'] if x in producers) for step in steps}
+
+    order = []
+    remaining = dict(dependencies)
+    while len(remaining) > 0:
+        ready = [name for name, deps in remaining.items() if deps.issubset(order)]
+        if len(ready) == 0:
+            raise Exception('The steps have circular dependencies: ' + ', '.join(remaining.keys()))
+        order += ready
+        for name in ready:
+            del remaining[name]
+
+    return dependencies, order, producers
+
+def get_steps_to_run(steps):
+
+    '''
+    Returns the set of names of the steps that need to run: those with an output that is missing (unless it is intermediate) or older than
+    one of their inputs, those depending on a step that runs, and those producing a missing intermediate file that a running step reads.
+    '''
+
+    by_name = {step['name']: step for step in steps}
+    dependencies, order, producers = get_step_order(steps)
+    intermediate = set(x for step in steps for x in step['intermediate'])
+
+    def get_mtime(path):
+
+        #Modification time of a file, or for a missing intermediate file the time of the newest file it is made from.
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+
+        if (path in intermediate) and (path in producers):
+            input_times = [get_mtime(x) for x in by_name[producers[path]]['inputs']]
+            return None if None in input_times else max(input_times, default=0)
+
+        return None
+
+    def is_up_to_date(step):
+        input_times = [get_mtime(x) for x in step['inputs']]
+        if None in input_times:
+            return False
+
+        for output in step['outputs']:
+            if not os.path.exists(output):
+                if output in intermediate:
+                    continue
+                return False
+
+            if os.path.getmtime(output) < max(input_times, default=0):
+                return False
+
+        return True
+
+    to_run = set(name for name in order if not is_up_to_date(by_name[name]))
+
+    #Steps after a running step have to run too, and a running step needs its missing intermediate inputs recreated. Repeat until stable.
+    changed = True
+    while changed:
+        changed = False
+        for name in order:
+            if (name not in to_run) and (len(dependencies[name] & to_run) > 0):
+                to_run.add(name)
+                changed = True
+
+            if name in to_run:
+                for path in by_name[name]['inputs']:
+                    if (not os.path.exists(path)) and (path in producers) and (producers[path] not in to_run):
+                        to_run.add(producers[path])
+                        changed = True
+
+    return to_run
+
+def get_command(step, executables = None):
+
+    #Resolves the step's command, swapping in any stand-in executables.
+    command = step['command']() if callable(step['command']) else step['command']
+
+    if executables is not None:
+        if type(command) is str:
+            program, _, arguments = command.partition(' ')
+            if program in executables:
+                command = executables[program] + ' ' + arguments
+        elif command[0] in executables:
+            command = [executables[command[0]]] + list(command[1:])
+
+    return command
+
+def run_step(step, executables = None):
+
+    #Runs one step, returning (status, error).
+    log_detail('Running ' + step['name'])
+
+    try:
+        command = get_command(step, executables)
+        result = subprocess.run(command, shell=type(command) is str, capture_output=True, text=True)
+    except Exception as e:
+        return 'failed', str(e)
+
+    if result.returncode != 0:
+        return 'failed', 'Exit code ' + str(result.returncode) + ':\n' + result.stderr[-2000:]
+
+    missing = [x for x in step['outputs'] if not os.path.exists(x)]
+    if len(missing) > 0:
+        return 'failed', 'Command finished but did not write: ' + ', '.join(missing)
+
+    return 'ran', None
+
+def run_steps(steps, n_workers = 2, executables = None, cleanup = True, raise_on_failure = False):
+
+    '''
+    Runs a list of steps (from make_step) in dependency order, skipping those that are up to date (see the module description).
+
+    • n_workers (int): maximum number of commands running at the same time.
+    • executables (dict): optional replacements for the programs the commands run, e.g. stand-ins for testing.
+    • cleanup (bool): if True and no step failed, delete the intermediate outputs and cleanup files of all steps at the end.
+    If a step failed, they are kept so that a rerun can pick up where it left off.
+    • raise_on_failure (bool): if True, raise an exception listing the failed and blocked steps and their errors once everything else has
+    finished, instead of only reporting them in the returned table. Failures are always logged as warnings.
+
+    Returns a DataFrame with one row per step (in dependency order) and columns step, status ('ran', 'up to date', 'failed', or 'blocked'
+    if a step it depends on failed), seconds and error.
+    '''
+
+    by_name = {step['name']: step for step in steps}
+    if len(by_name) != len(steps):
+        raise Exception('Step names must be unique.')
+
+    dependencies, order, producers = get_step_order(steps)
+    to_run = get_steps_to_run(steps)
+
+    def timed_run_step(step):
+        start = time.perf_counter()
+        outcome = run_step(step, executables)
+        return outcome, time.perf_counter() - start
+
+    status = {name: 'up to date' for name in order if name not in to_run}
+    errors = {}
+    seconds = {}
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while len(status) < len(order):
+
+            #Start every step whose dependencies have finished, and block those depending on a failure.
+            for name in order:
+                if (name in status) or (name in pending.values()):
+                    continue
+
+                if any(status.get(x) in ['failed', 'blocked'] for x in dependencies[name]):
+                    status[name] = 'blocked'
+                    errors[name] = 'Not run because a step it depends on failed.'
+                elif all(x in status for x in dependencies[name]):
+                    pending[pool.submit(timed_run_step, by_name[name])] = name
+
+            if len(pending) == 0:
+                continue
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                (status[name], errors[name]), seconds[name] = future.result()
+
+                if status[name] == 'failed':
+                    log_warning('Step ' + name + ' failed: ' + errors[name])
+
+    if cleanup and ('failed' not in status.values()):
+        for step in steps:
+            for path in step['intermediate'] + [x for pattern in step['cleanup'] for x in glob.glob(pattern)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    failures = [name for name in order if status[name] in ['failed', 'blocked']]
+    if raise_on_failure and (len(failures) > 0):
+        raise Exception(str(len(failures)) + ' step(s) did not complete:\n' + '\n'.join(name + ' (' + status[name] + '): ' + errors[name] for name in failures))
+
+    import pandas as pd
+
+    return pd.DataFrame({'step': order, 'status': [status[x] for x in order], 'seconds': [seconds.get(x) for x in order], \
+                        'error': [errors.get(x) for x in order]})
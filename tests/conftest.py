@@ -0,0 +1,43 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+#The MIND modules live at the top level of the repository rather than in a package, and the synthetic subjects are written by the benchmarks.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+@pytest.fixture
+def region_data():
+
+    '''
+    Factory for synthetic vertex data: make(n_features, n_regions, n_vertices, seed) returns (values, labels), with integer region labels
+    0..n_regions-1 and a different mean for every region, so the networks are not trivial.
+    '''
+
+    def make(n_features=3, n_regions=8, n_vertices=3000, seed=0):
+        rng = np.random.default_rng(seed)
+        labels = rng.integers(0, n_regions, n_vertices)
+        values = rng.normal(size=(n_vertices, n_features)) + rng.normal(size=(n_regions, n_features))[labels]
+        return values, labels
+
+    return make
+
+@pytest.fixture
+def synthetic_subject(tmp_path):
+
+    '''
+    Factory writing small synthetic FreeSurfer subjects (see benchmarks/synthetic_subject.py) under tmp_path: make(name, **kwargs) returns
+    (surf_dir, features), with the parcellation named 'synthetic'. Skips the test if nibabel is not installed.
+    '''
+
+    pytest.importorskip('nibabel')
+    from synthetic_subject import make_synthetic_subject
+
+    def make(name='sub-01', n_vertices=5000, n_regions=10, n_features=2, random_state=0):
+        surf_dir = str(tmp_path / name)
+        features = make_synthetic_subject(surf_dir, n_vertices=n_vertices, n_regions=n_regions, n_features=n_features, random_state=random_state)
+        return surf_dir, features
+
+    return make
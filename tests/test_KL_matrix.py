@@ -0,0 +1,64 @@
+'''
+The batched (get_KL_matrix) and pairwise engines should give the same MIND networks as the original per-pair KD-tree estimate (get_KL).
+'''
+
+import numpy as np
+import pytest
+from MIND_helpers import get_region_blocks, get_KDTree, get_KL, get_KL_matrix, calculate_mind_from_blocks
+
+def make_blocks(region_data, n_features):
+
+    values, labels = region_data(n_features=n_features)
+    return get_region_blocks(values, labels, np.arange(labels.max() + 1))
+
+def get_reference_KL(values, offsets):
+
+    #Directed KL between every pair of regions with the original per-pair function.
+    n_regions = len(offsets) - 1
+    blocks = [values[offsets[i]:offsets[i+1]] for i in range(n_regions)]
+    trees = [get_KDTree(x) for x in blocks]
+
+    KL = np.zeros((n_regions, n_regions))
+    for i in range(n_regions):
+        for j in range(n_regions):
+            if i != j:
+                KL[i,j] = get_KL(blocks[i], blocks[j], trees[i], trees[j])
+
+    return KL
+
+def test_batched_matches_pairwise_tree(region_data):
+
+    values, offsets = make_blocks(region_data, n_features=3)
+
+    np.testing.assert_allclose(get_KL_matrix(values, offsets), get_reference_KL(values, offsets), rtol=1e-12, atol=1e-12)
+
+    batched = calculate_mind_from_blocks(values, offsets, query_mode='batched', n_jobs=2)
+    pairwise = calculate_mind_from_blocks(values, offsets, query_mode='pairwise')
+    np.testing.assert_allclose(batched, pairwise, rtol=1e-12, atol=1e-12)
+
+def test_univariate_engine_matches_tree(region_data):
+
+    #The univariate engine finds the exact nearest neighbours, while the trees use eps=.01 approximate queries, so the two only agree closely.
+    values, offsets = make_blocks(region_data, n_features=1)
+
+    np.testing.assert_allclose(get_KL_matrix(values, offsets), get_reference_KL(values, offsets), rtol=1e-6, atol=1e-8)
+
+    MIND = calculate_mind_from_blocks(values, offsets)
+    reference = 1/(1 + get_reference_KL(values, offsets) + get_reference_KL(values, offsets).T)
+    np.fill_diagonal(reference, 0)
+    np.testing.assert_allclose(MIND, reference, rtol=1e-6, atol=1e-8)
+
+def test_empty_regions_are_zero(region_data):
+
+    values, offsets = make_blocks(region_data, n_features=2)
+    offsets = np.concatenate((offsets[:3], [offsets[2]], offsets[3:]))
+
+    for query_mode in ['batched', 'pairwise']:
+        MIND = calculate_mind_from_blocks(values, offsets, query_mode=query_mode)
+        assert MIND.shape == (len(offsets) - 1,) * 2
+        assert np.all(MIND[2] == 0) and np.all(MIND[:,2] == 0)
+
+def test_no_regions():
+
+    with pytest.raises(Exception, match='No regions'):
+        get_region_blocks(np.zeros((10, 2)), np.zeros(10, dtype=int), [])
@@ -0,0 +1,63 @@
+'''
+Online aggregation of MIND networks (MIND_aggregate.py): aggregates built separately and merged should match the statistics of the
+stacked networks.
+'''
+
+import numpy as np
+from MIND_aggregate import create_MIND_aggregate, update_MIND_aggregate, merge_MIND_aggregates, get_MIND_aggregate_summary
+
+def make_networks(n_subjects=400, n_regions=6, seed=0):
+
+    rng = np.random.default_rng(seed)
+    networks = rng.beta(2, 5, size=(n_subjects, n_regions, n_regions))
+    networks = (networks + networks.transpose(0, 2, 1)) / 2
+
+    #Some regions missing from some subjects.
+    networks[rng.random(n_subjects) < 0.1, 2, :] = np.nan
+    networks[:, :, 2] = networks[:, 2, :]
+
+    return networks
+
+def test_merged_aggregates_match_stacked_networks():
+
+    networks = make_networks()
+    regions = ['r' + str(i) for i in range(networks.shape[1])]
+    groups = np.arange(len(networks)) % 2
+
+    #Split the cohort unevenly across two aggregates, as if computed on two nodes.
+    parts = [create_MIND_aggregate(regions), create_MIND_aggregate(regions)]
+    for i, MIND in enumerate(networks):
+        update_MIND_aggregate(parts[int(i >= 150)], MIND, group=groups[i])
+
+    merged = merge_MIND_aggregates(parts)
+    bin_width = 1 / merged['n_bins']
+    off_diagonal = ~np.eye(len(regions), dtype=bool)
+
+    for group, subset in [(None, networks), (0, networks[groups == 0]), (1, networks[groups == 1])]:
+        summary = get_MIND_aggregate_summary(merged, group=group, quantiles=(0.05, 0.5, 0.95))
+
+        assert np.array_equal(summary['n'].values[off_diagonal], np.isfinite(subset).sum(axis=0)[off_diagonal])
+        np.testing.assert_allclose(summary['mean'].values[off_diagonal], np.nanmean(subset, axis=0)[off_diagonal], rtol=1e-12)
+        np.testing.assert_allclose(summary['variance'].values[off_diagonal], np.nanvar(subset, axis=0, ddof=1)[off_diagonal], rtol=1e-10)
+
+        #Quantiles come from the histograms, so they are only accurate to about a bin (plus the gap between neighbouring values, as the
+        #histogram and np.quantile place the q-th value at slightly different ranks).
+        for q in [0.05, 0.5, 0.95]:
+            np.testing.assert_allclose(summary[q].values[off_diagonal], np.nanquantile(subset, q, axis=0)[off_diagonal], atol=2 * bin_width)
+
+def test_merge_matches_single_aggregate():
+
+    networks = make_networks(n_subjects=50, seed=1)
+    regions = ['r' + str(i) for i in range(networks.shape[1])]
+
+    single = create_MIND_aggregate(regions)
+    parts = [create_MIND_aggregate(regions) for _ in range(3)]
+    for i, MIND in enumerate(networks):
+        update_MIND_aggregate(single, MIND)
+        update_MIND_aggregate(parts[i % 3], MIND)
+
+    merged = merge_MIND_aggregates(parts)
+
+    assert np.array_equal(merged['groups'][None]['histogram'], single['groups'][None]['histogram'])
+    np.testing.assert_allclose(merged['groups'][None]['mean'], single['groups'][None]['mean'], rtol=1e-12)
+    np.testing.assert_allclose(merged['groups'][None]['M2'], single['groups'][None]['M2'], rtol=1e-10)
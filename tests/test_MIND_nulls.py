@@ -0,0 +1,65 @@
+'''
+Input checks of the surface-ordered loaders used by MIND_nulls.py and MIND_sparse.py.
+'''
+
+import numpy as np
+import pytest
+from MIND_nulls import compute_MIND_nulls, load_null_data
+from get_vertex_df import get_surface_vertex_data
+
+def write_spheres(surf_dir, sizes, seed=0):
+
+    from nibabel.freesurfer.io import write_geometry
+
+    rng = np.random.default_rng(seed)
+    for hemi, size in zip(['lh','rh'], sizes):
+        coords = rng.normal(size=(size, 3))
+        coords = 100 * coords / np.linalg.norm(coords, axis=1, keepdims=True)
+        write_geometry(surf_dir + '/surf/' + hemi + '.sphere', coords, np.array([[0, 1, 2]]))
+
+def test_spin_checks_sphere_size(synthetic_subject):
+
+    surf_dir, features = synthetic_subject(n_vertices=2000)
+
+    write_spheres(surf_dir, [2000, 2000])
+    data = load_null_data(surf_dir, features, 'synthetic', method='spin')
+    assert [len(x) for x in data['sphere_coords']] == data['hemi_sizes'] == [2000, 2000]
+
+    results = compute_MIND_nulls(surf_dir, features, 'synthetic', n_surrogates=4, method='spin', n_workers=1, random_state=0)
+    assert results['n_surrogates'] == 4
+
+    #A sphere from another surface would otherwise split the codes between the hemispheres in the wrong place.
+    write_spheres(surf_dir, [2000, 1990])
+    with pytest.raises(Exception, match='rh.sphere surface has 1990 vertices'):
+        load_null_data(surf_dir, features, 'synthetic', method='spin')
+
+def test_repeated_values_are_refused(synthetic_subject):
+
+    from nibabel.freesurfer.io import read_morph_data, write_morph_data
+
+    surf_dir, features = synthetic_subject(n_vertices=2000, n_features=1)
+    get_surface_vertex_data(surf_dir, features, 'synthetic')
+
+    #Half of the vertices of each hemisphere copy another vertex.
+    for hemi in ['lh','rh']:
+        values = read_morph_data(surf_dir + '/surf/' + hemi + '.thickness')
+        values[1000:] = values[:1000]
+        write_morph_data(surf_dir + '/surf/' + hemi + '.thickness', values)
+
+    with pytest.raises(Exception, match='many repeated values'):
+        get_surface_vertex_data(surf_dir, features, 'synthetic')
+    with pytest.raises(Exception, match='many repeated values'):
+        load_null_data(surf_dir, features, 'synthetic')
+
+    data = get_surface_vertex_data(surf_dir, features, 'synthetic', max_duplicate_rate=None)
+    assert len(data['values']) == np.count_nonzero(data['valid'])
+
+def test_feature_vertex_counts_are_checked(synthetic_subject):
+
+    from nibabel.freesurfer.io import read_morph_data, write_morph_data
+
+    surf_dir, features = synthetic_subject(n_vertices=2000)
+    write_morph_data(surf_dir + '/surf/lh.volume', read_morph_data(surf_dir + '/surf/lh.volume')[:1500])
+
+    with pytest.raises(Exception, match='has 1500 vertices'):
+        get_surface_vertex_data(surf_dir, features, 'synthetic')
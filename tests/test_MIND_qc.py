@@ -0,0 +1,77 @@
+'''
+Vertex QC (MIND_qc.py): the vectorized MAD rules should match is_outlier, never flag features that can't be judged, and the report's
+counts should add up.
+'''
+
+import numpy as np
+import pytest
+from MIND_helpers import is_outlier
+from MIND_qc import get_mad_outliers, run_vertex_qc
+
+def make_values(n_vertices=5000, n_features=3, seed=0):
+
+    #Heavy tailed values, so there are outliers at the usual thresholds.
+    rng = np.random.default_rng(seed)
+    return rng.standard_t(2, size=(n_vertices, n_features)) * rng.uniform(0.5, 5, n_features) + rng.normal(size=n_features)
+
+@pytest.mark.parametrize('threshold', [3.5, 7])
+def test_per_feature_matches_is_outlier(threshold):
+
+    values = make_values()
+    expected = np.any([is_outlier(values[:, i], threshold) for i in range(values.shape[1])], axis=0)
+
+    assert expected.sum() > 0
+    assert np.array_equal(get_mad_outliers(values, threshold, mode='per_feature'), expected)
+    assert np.array_equal(get_mad_outliers(values.astype(np.float32), threshold, mode='per_feature'), \
+                            np.any([is_outlier(values[:, i].astype(np.float32), threshold) for i in range(values.shape[1])], axis=0))
+
+def test_multivariate_matches_is_outlier():
+
+    values = make_values()
+    standardized = values / values.std(axis=0, ddof=1)
+
+    assert np.array_equal(get_mad_outliers(values, 7, mode='multivariate'), is_outlier(standardized, 7))
+
+def test_zero_mad_flags_nothing():
+
+    #More than half the vertices at the median (e.g. quantised or zero-filled features) gives a median absolute deviation of zero.
+    values = make_values()
+    values[:3000, 1] = 0
+    values[3000:3010, 1] = 100
+
+    per_feature = get_mad_outliers(values, 7, mode='per_feature')
+    assert np.array_equal(per_feature, np.any([is_outlier(values[:, i], 7) for i in [0, 2]], axis=0))
+
+    #All features at the median for most vertices, and a constant feature.
+    values[:3000] = np.median(values, axis=0)
+    values[:, 2] = 1.0
+    assert not np.any(get_mad_outliers(values, 7, mode='multivariate'))
+    assert not np.any(get_mad_outliers(values[:, [2]], 7, mode='per_feature'))
+
+def test_removed_per_region_adds_up():
+
+    values = make_values()
+    values[::97, 0] = 0
+    values[::89, 2] = 0
+
+    rng = np.random.default_rng(1)
+    codes = rng.integers(-1, 12, len(values))
+    regions = ['r' + str(i) for i in range(12)]
+
+    keep, report = run_vertex_qc(values, codes=codes, regions=regions, zero_columns=[0, 2], column_names=['CT', 'Vol', 'SA'], mad_threshold=7)
+
+    removed = report['removed']
+    assert removed['total'] == np.count_nonzero(~keep) == report['n_vertices'] - report['n_kept']
+    assert removed['zero_CT'] > 0 and removed['zero_SA'] > 0 and removed['mad_outlier'] > 0
+
+    #Per region counts add up to the removed vertices in regions, and to the totals per rule.
+    in_regions = codes >= 0
+    for rule, counts in report['removed_per_region'].items():
+        assert len(counts) == len(regions)
+    assert report['removed_per_region']['total'].sum() == np.count_nonzero(~keep & in_regions)
+    assert np.array_equal(report['removed_per_region']['total'], np.bincount(codes[~keep & in_regions], minlength=len(regions)))
+
+    #Without vertices outside regions, the per-region totals add up to removed['total'].
+    keep, report = run_vertex_qc(values, codes=np.abs(codes), regions=regions + ['r12'], zero_columns=[0, 2], mad_threshold=7)
+    assert report['removed_per_region']['total'].sum() == report['removed']['total']
+    assert report['removed_per_region']['mad_outlier'].sum() == report['removed']['mad_outlier']
@@ -0,0 +1,87 @@
+'''
+The cohort store (MIND_store.py) and its use by compute_MIND_batch: interrupted appends, resuming, and reading back.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+from MIND_store import create_MIND_store, append_to_MIND_store, get_stored_subjects, read_MIND_store
+
+def make_network(n_regions, seed):
+    rng = np.random.default_rng(seed)
+    MIND = rng.uniform(size=(n_regions, n_regions))
+    MIND = (MIND + MIND.T) / 2
+    np.fill_diagonal(MIND, 0)
+    return MIND
+
+def test_interrupted_append_is_truncated(tmp_path):
+
+    store = str(tmp_path / 'store')
+    regions = ['a', 'b', 'c', 'd']
+    create_MIND_store(store, regions, chunk_size=2, dtype='float64')
+    append_to_MIND_store(store, 'sub-01', make_network(4, 1))
+
+    #An append interrupted after writing the row but before finishing the id: the partial id is not a stored subject.
+    with open(os.path.join(store, 'subjects.txt'), 'a', encoding='utf-8') as f:
+        f.write('sub-0')
+    assert get_stored_subjects(store) == ['sub-01']
+
+    append_to_MIND_store(store, 'sub-02', make_network(4, 2))
+    append_to_MIND_store(store, 'sub-03', make_network(4, 3))
+
+    with open(os.path.join(store, 'subjects.txt'), encoding='utf-8') as f:
+        assert f.read() == 'sub-01\nsub-02\nsub-03\n'
+
+    #sub-03 is in the second chunk.
+    matrices, stored_regions = read_MIND_store(store, as_matrices=True)
+    assert list(stored_regions) == regions
+    for i in range(3):
+        assert np.array_equal(matrices[i], make_network(4, i + 1))
+
+    edges = read_MIND_store(store, subjects=['sub-03'], edges=[('b', 'a'), ('c', 'd')])
+    assert np.array_equal(edges.values, make_network(4, 3)[[1, 2], [0, 3]][None])
+
+def test_dataframe_is_reordered(tmp_path):
+
+    store = str(tmp_path / 'store')
+    create_MIND_store(store, ['a', 'b', 'c'], dtype='float64')
+
+    MIND = pd.DataFrame(make_network(2, 0), index=['c', 'a'], columns=['c', 'a'])
+    append_to_MIND_store(store, 'sub-01', MIND)
+
+    matrices, _ = read_MIND_store(store, as_matrices=True)
+    assert matrices[0, 0, 2] == MIND.loc['a', 'c']
+    assert np.isnan(matrices[0, 0, 1])
+
+def test_batch_resumes_and_matches_compute_MIND(tmp_path, synthetic_subject):
+
+    from MIND import compute_MIND, compute_MIND_batch
+
+    subjects = [synthetic_subject('sub-0' + str(i), random_state=i) for i in range(1, 4)]
+    surf_dirs = [x[0] for x in subjects]
+    features = subjects[0][1]
+    store = str(tmp_path / 'store')
+
+    #An interrupted batch that only got through the first two subjects, the second with its id partially written.
+    _, _, status = compute_MIND_batch(surf_dirs[:2], features, 'synthetic', n_workers=1, out_store=store)
+    assert list(status.status) == ['ok', 'ok']
+
+    with open(os.path.join(store, 'subjects.txt'), encoding='utf-8') as f:
+        ids = f.read()
+    with open(os.path.join(store, 'subjects.txt'), 'w', encoding='utf-8') as f:
+        f.write(ids[:-3])
+    assert get_stored_subjects(store) == ['sub-01']
+
+    #Rerunning skips the finished subject and recomputes the rest.
+    _, regions, status = compute_MIND_batch(surf_dirs, features, 'synthetic', n_workers=1, out_store=store)
+    assert list(status.status) == ['skipped', 'ok', 'ok']
+    assert get_stored_subjects(store) == ['sub-01', 'sub-02', 'sub-03']
+
+    _, _, status = compute_MIND_batch(surf_dirs, features, 'synthetic', n_workers=1, out_store=store)
+    assert list(status.status) == ['skipped'] * 3
+
+    #The store holds float32 copies of the networks compute_MIND returns.
+    matrices, stored_regions = read_MIND_store(store, as_matrices=True)
+    for i, surf_dir in enumerate(surf_dirs):
+        MIND = compute_MIND(surf_dir, features, 'synthetic').reindex(index=stored_regions, columns=stored_regions)
+        np.testing.assert_allclose(matrices[i], MIND.values, rtol=1e-6, atol=1e-7)
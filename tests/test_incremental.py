@@ -0,0 +1,49 @@
+'''
+calculate_mind_incremental should give exactly the same network as recomputing everything with calculate_mind_from_blocks.
+'''
+
+import numpy as np
+from MIND_helpers import get_region_blocks, calculate_mind_from_blocks, calculate_mind_incremental, calculate_mind_array
+
+def make_data(region_data):
+
+    values, labels = region_data(n_regions=10, n_vertices=4000)
+    return values, labels, [str(x) for x in range(10)]
+
+def test_changed_region_matches_full_recomputation(region_data):
+
+    values, labels, regions = make_data(region_data)
+    blocks, offsets = get_region_blocks(values, labels.astype(str), regions)
+
+    MIND, state = calculate_mind_incremental(blocks, offsets, regions)
+    assert np.array_equal(MIND, calculate_mind_from_blocks(blocks, offsets))
+
+    #Change one region's block of vertices, as after a FreeSurfer edit.
+    changed = blocks.copy()
+    changed[offsets[3]:offsets[4]] += np.random.default_rng(1).normal(scale=0.5, size=(offsets[4] - offsets[3], blocks.shape[1]))
+
+    MIND, state = calculate_mind_incremental(changed, offsets, regions, previous=state)
+    assert np.array_equal(MIND, calculate_mind_from_blocks(changed, offsets))
+
+def test_reordered_and_new_regions(region_data):
+
+    #Regions are matched by name, so a changed region order or a new region also gives the full result.
+    values, labels, regions = make_data(region_data)
+    blocks, offsets = get_region_blocks(values, labels.astype(str), regions[:-1])
+    _, state = calculate_mind_incremental(blocks, offsets, regions[:-1])
+
+    reordered = regions[::-1]
+    blocks, offsets = get_region_blocks(values, labels.astype(str), reordered)
+    MIND, _ = calculate_mind_incremental(blocks, offsets, reordered, previous=state)
+
+    assert np.array_equal(MIND, calculate_mind_from_blocks(blocks, offsets))
+
+def test_calculate_mind_array_state(region_data):
+
+    values, labels, regions = make_data(region_data)
+    _, state = calculate_mind_array(values, labels.astype(str), regions, return_state=True)
+
+    values[labels == 5] *= 1.1
+    MIND, _ = calculate_mind_array(values, labels.astype(str), regions, previous=state)
+
+    assert np.array_equal(MIND, calculate_mind_array(values, labels.astype(str), regions))
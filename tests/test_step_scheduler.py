@@ -0,0 +1,130 @@
+'''
+Runs the preprocessing steps with stand-in executables (see step_scheduler.run_steps) in a temporary directory, checking that reruns
+skip every step that is up to date.
+'''
+
+import os
+import sys
+import time
+import pytest
+from step_scheduler import make_step, run_steps
+
+#Stand-in for the FreeSurfer / AFNI programs: writes the file given after the program's output flag and logs the call.
+STAND_IN = '''
+import os, sys
+tool, args = sys.argv[1], sys.argv[2:]
+flag = {'bbregister': '--reg', 'mri_vol2vol': '--o', 'mri_convert': '--output_volume', '3dcalc': '-prefix', 'mri_vol2surf': '--o'}[tool]
+if os.environ.get('FAIL_TOOL') == tool:
+    sys.exit('stand-in ' + tool + ' failed')
+open(args[args.index(flag) + 1], 'w').write(tool)
+with open(os.environ['STAND_IN_LOG'], 'a') as f:
+    f.write(tool + '\\n')
+'''
+
+TOOLS = ['bbregister', 'mri_vol2vol', 'mri_convert', '3dcalc', 'mri_vol2surf']
+
+@pytest.fixture
+def stand_ins(tmp_path, monkeypatch):
+
+    script = tmp_path / 'stand_in.py'
+    script.write_text(STAND_IN)
+    log = tmp_path / 'calls.log'
+    monkeypatch.setenv('STAND_IN_LOG', str(log))
+
+    def get_calls():
+        calls = log.read_text().split() if log.exists() else []
+        if log.exists():
+            log.unlink()
+        return calls
+
+    return {x: sys.executable + ' ' + str(script) + ' ' + x for x in TOOLS}, get_calls
+
+def touch_later(path):
+
+    #Makes sure the new modification time is later than that of the files written just before.
+    time.sleep(0.05)
+    os.utime(path)
+
+def test_t1t2_ratio_steps_skip_up_to_date(tmp_path, monkeypatch, stand_ins):
+
+    pytest.importorskip('nipype')
+    from register_and_vol2surf import calculate_surface_t1t2_ratio
+
+    executables, get_calls = stand_ins
+    subjects_dir = tmp_path / 'subjects'
+    (subjects_dir / 'sub-01' / 'mri').mkdir(parents=True)
+    (subjects_dir / 'sub-01' / 'mri' / 'T1.mgz').write_text('')
+    monkeypatch.setenv('SUBJECTS_DIR', str(subjects_dir))
+
+    t2 = tmp_path / 'T2.mgz'
+    t2.write_text('')
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    status = calculate_surface_t1t2_ratio(str(t2), 'sub-01', str(out_dir), executables=executables)
+    assert list(status.status) == ['ran'] * 6
+    assert sorted(get_calls()) == sorted(TOOLS + ['mri_vol2surf'])
+
+    #Intermediate files are deleted, but only the surface outputs are needed to be up to date.
+    assert sorted(os.listdir(out_dir)) == ['lh.T1-over-T2.mgz', 'rh.T1-over-T2.mgz']
+
+    status = calculate_surface_t1t2_ratio(str(t2), 'sub-01', str(out_dir), executables=executables)
+    assert list(status.status) == ['up to date'] * 6
+    assert get_calls() == []
+
+    #A newer T1 reruns the steps after it, plus the ones recreating the deleted intermediate files they read.
+    touch_later(subjects_dir / 'sub-01' / 'mri' / 'T1.mgz')
+    status = calculate_surface_t1t2_ratio(str(t2), 'sub-01', str(out_dir), executables=executables)
+    assert list(status.status) == ['ran'] * 6
+
+    #Keeping the intermediate files, only the steps after the T1 conversion rerun.
+    status = calculate_surface_t1t2_ratio(str(t2), 'sub-01', str(out_dir), executables=executables, cleanup=False)
+    assert list(status.status) == ['ran'] * 6
+    get_calls()
+
+    touch_later(subjects_dir / 'sub-01' / 'mri' / 'T1.mgz')
+    status = calculate_surface_t1t2_ratio(str(t2), 'sub-01', str(out_dir), executables=executables, cleanup=False)
+    assert set(status.step[status.status == 'ran']) == {'sub-01/T2/' + x for x in ['mri_convert', '3dcalc', 'vol2surf_lh', 'vol2surf_rh']}
+    assert sorted(get_calls()) == ['3dcalc', 'mri_convert', 'mri_vol2surf', 'mri_vol2surf']
+
+def test_run_steps_skip_and_failure(tmp_path):
+
+    #A chain a -> b -> c of copy commands, independent of FreeSurfer.
+    source = tmp_path / 'source.txt'
+    source.write_text('x')
+    a, b, c = [str(tmp_path / (x + '.txt')) for x in 'abc']
+    copy = sys.executable + ' -c "import shutil, sys; shutil.copy(sys.argv[1], sys.argv[2])" '
+
+    steps = [make_step('a', copy + str(source) + ' ' + a, [source], [a]),
+            make_step('b', copy + a + ' ' + b, [a], [b]),
+            make_step('c', copy + b + ' ' + c, [b], [c])]
+
+    assert list(run_steps(steps).status) == ['ran'] * 3
+    assert list(run_steps(steps).status) == ['up to date'] * 3
+
+    touch_later(a)
+    assert list(run_steps(steps).status) == ['up to date', 'ran', 'ran']
+
+    #A failing step blocks the steps after it.
+    os.remove(c)
+    steps[1]['command'] = sys.executable + ' -c "import sys; sys.exit(1)"'
+    touch_later(a)
+    assert list(run_steps(steps).status) == ['up to date', 'failed', 'blocked']
+
+def test_failed_command_raises(tmp_path, monkeypatch, stand_ins):
+
+    pytest.importorskip('nipype')
+    from register_and_vol2surf import calculate_surface_t1t2_ratio
+
+    executables, get_calls = stand_ins
+    (tmp_path / 'T1.mgz').write_text('')
+    (tmp_path / 'T2.mgz').write_text('')
+    monkeypatch.setenv('SUBJECTS_DIR', str(tmp_path))
+    monkeypatch.setenv('FAIL_TOOL', 'mri_convert')
+
+    with pytest.raises(Exception, match='sub-01/T2/mri_convert \\(failed\\)'):
+        calculate_surface_t1t2_ratio(str(tmp_path / 'T2.mgz'), 'sub-01', str(tmp_path), t1_loc=str(tmp_path / 'T1.mgz'), executables=executables)
+
+    status = calculate_surface_t1t2_ratio(str(tmp_path / 'T2.mgz'), 'sub-01', str(tmp_path), t1_loc=str(tmp_path / 'T1.mgz'), executables=executables, \
+                                            raise_on_failure=False)
+    assert list(status.status[status.step.str.endswith(('mri_convert', '3dcalc'))]) == ['failed', 'blocked']
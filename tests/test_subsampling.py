@@ -0,0 +1,30 @@
+'''
+max_vertices_per_region subsampling should be reproducible, with or without a random_state.
+'''
+
+import numpy as np
+from MIND_helpers import calculate_mind_array
+
+def test_subsampling_is_deterministic(region_data):
+
+    values, labels = region_data(n_vertices=6000)
+
+    MIND, diagnostics = calculate_mind_array(values, labels, np.arange(8), max_vertices_per_region=200)
+    MIND_again, diagnostics_again = calculate_mind_array(values, labels, np.arange(8), max_vertices_per_region=200)
+
+    assert np.array_equal(MIND, MIND_again)
+    assert diagnostics['pairs'] == diagnostics_again['pairs']
+
+    seeded = calculate_mind_array(values, labels, np.arange(8), max_vertices_per_region=200, random_state=5)[0]
+    assert np.array_equal(seeded, calculate_mind_array(values, labels, np.arange(8), max_vertices_per_region=200, random_state=5)[0])
+    assert not np.array_equal(seeded, MIND)
+
+def test_compute_MIND_subsampling_is_deterministic(synthetic_subject):
+
+    #Same check end to end, on a small synthetic FreeSurfer subject.
+    from MIND import compute_MIND
+
+    surf_dir, features = synthetic_subject()
+
+    MIND = compute_MIND(surf_dir, features, 'synthetic', max_vertices_per_region=100)[0]
+    assert np.array_equal(MIND.values, compute_MIND(surf_dir, features, 'synthetic', max_vertices_per_region=100)[0].values)
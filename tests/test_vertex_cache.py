@@ -0,0 +1,132 @@
+'''
+On-disk vertex cache (vertex_cache.py): invalidation, LRU eviction, and only ever deleting its own entries.
+'''
+
+import os
+import time
+import threading
+import numpy as np
+import pytest
+
+nibabel = pytest.importorskip('nibabel')
+from nibabel.freesurfer.io import write_morph_data
+from vertex_cache import load_feature, evict_cache, get_file_fingerprint
+
+def write_feature(path, values):
+    write_morph_data(str(path), np.asarray(values, dtype='>f4'))
+    return str(path)
+
+def get_entries(cache_dir):
+    return sorted(x for x in os.listdir(cache_dir) if x.startswith('feature-'))
+
+def test_changed_file_invalidates_entry(tmp_path):
+
+    cache_dir = str(tmp_path / 'cache')
+    path = write_feature(tmp_path / 'lh.thickness', np.arange(100))
+
+    assert np.array_equal(load_feature(path, cache_dir=cache_dir), np.arange(100))
+    assert np.array_equal(load_feature(path, cache_dir=cache_dir), np.arange(100))
+    assert len(get_entries(cache_dir)) == 1
+
+    #Same size, newer modification time.
+    fingerprint = get_file_fingerprint(path)
+    write_feature(path, np.arange(100) + 1)
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns + 10**9))
+    assert get_file_fingerprint(path) != fingerprint
+    assert np.array_equal(load_feature(path, cache_dir=cache_dir), np.arange(100) + 1)
+
+    #Different size, same modification time.
+    mtime = os.stat(path).st_mtime_ns
+    write_feature(path, np.arange(50))
+    os.utime(path, ns=(mtime, mtime))
+    assert np.array_equal(load_feature(path, cache_dir=cache_dir), np.arange(50))
+
+    assert len(get_entries(cache_dir)) == 3
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+
+    cache_dir = str(tmp_path / 'cache')
+    paths = [write_feature(tmp_path / ('lh.feature_' + str(i)), np.full(1000, i)) for i in range(3)]
+    for path in paths:
+        load_feature(path, cache_dir=cache_dir)
+
+    #Make the entries look used in the order 0, 1, 2, then use entry 0 again.
+    entries = {path: os.path.join(cache_dir, 'feature-' + get_file_fingerprint(path)) for path in paths}
+    for i, path in enumerate(paths):
+        os.utime(entries[path], (1000 + i, 1000 + i))
+    load_feature(paths[0], cache_dir=cache_dir)
+
+    entry_size = sum(os.path.getsize(os.path.join(entries[paths[0]], x)) for x in os.listdir(entries[paths[0]]))
+    evict_cache(cache_dir, 2 * entry_size)
+
+    assert [os.path.isdir(entries[path]) for path in paths] == [True, False, True]
+    assert np.array_equal(load_feature(paths[1], cache_dir=cache_dir), np.full(1000, 1))
+
+def test_eviction_only_deletes_cache_entries(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+    load_feature(write_feature(tmp_path / 'lh.thickness', np.arange(100)), cache_dir=str(cache_dir))
+
+    #A project directory, an entry-like directory that isn't a cache entry, an unmarked (incomplete) entry and a stray file.
+    (cache_dir / 'important_project' / 'data').mkdir(parents=True)
+    (cache_dir / 'important_project' / 'data' / 'results.csv').write_text('a,b')
+    (cache_dir / 'feature-notmine').mkdir()
+    (cache_dir / ('annot-' + '0' * 40)).mkdir()
+    (cache_dir / 'notes.txt').write_text('x')
+
+    evict_cache(str(cache_dir), 0)
+
+    assert sorted(os.listdir(cache_dir)) == ['annot-' + '0' * 40, 'feature-notmine', 'important_project', 'notes.txt']
+    assert (cache_dir / 'important_project' / 'data' / 'results.csv').read_text() == 'a,b'
+
+def test_concurrent_writes_of_the_same_entry(tmp_path):
+
+    #Threads of one process caching the same file at the same time (as in compute_MIND_sweep or the server) must not collide.
+    cache_dir = str(tmp_path / 'cache')
+
+    for round in range(10):
+        path = write_feature(tmp_path / ('lh.feature_' + str(round)), np.arange(200000) + round)
+        barrier = threading.Barrier(8)
+        results = [None] * 8
+        errors = []
+
+        def load(i):
+            barrier.wait()
+            try:
+                results[i] = load_feature(path, cache_dir=cache_dir)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load, args=(i,)) for i in range(8)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+
+        assert errors == []
+        assert all(np.array_equal(x, np.arange(200000) + round) for x in results)
+        assert np.array_equal(load_feature(path, cache_dir=cache_dir), np.arange(200000) + round)
+
+    assert len(get_entries(cache_dir)) == len(os.listdir(cache_dir)) == 10
+
+def test_vertex_array_uses_memory_cache(synthetic_subject):
+
+    from get_vertex_df import get_vertex_array
+    from vertex_cache import set_memory_cache, get_memory_cache_stats
+
+    surf_dir, features = synthetic_subject(n_vertices=2000)
+    expected = get_vertex_array(surf_dir, features, 'synthetic', dtype=np.float32)
+
+    set_memory_cache(2**26)
+    try:
+        first = get_vertex_array(surf_dir, features, 'synthetic', dtype=np.float32)
+        stats = get_memory_cache_stats()
+        second = get_vertex_array(surf_dir, features, 'synthetic', dtype=np.float32)
+        hits = get_memory_cache_stats()['hits'] - stats['hits']
+    finally:
+        set_memory_cache(0)
+
+    #The parcellation and every feature file of both hemispheres are served from memory the second time.
+    assert hits == 1 + 2 * len(features)
+    for x, y in zip(first, expected):
+        assert np.array_equal(x, y)
+    for x, y in zip(second, expected):
+        assert np.array_equal(x, y)
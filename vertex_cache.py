@@ -0,0 +1,276 @@
+'''
+Optional on-disk cache for the vertex-level files read by get_vertex_df.
+
+Every source file (an .annot parcellation or a surface feature) gets its own cache entry: a directory of .npy files named after a
+fingerprint of the file's absolute path, size and modification time, and holding a marker file once it is complete. Editing or replacing a source file therefore automatically
+invalidates its entry. Because each feature file is cached separately, any subset of previously loaded features can be served from
+the cache. Entries are loaded through memory mapping, and the least recently used entries are evicted once the cache grows beyond
+max_cache_bytes. Eviction only ever deletes complete entries written by this module, so cache_dir can be shared with other files,
+although a dedicated directory is recommended.
+
+Long-running processes (see MIND_server.py) can also keep parsed files in memory with set_memory_cache, in front of both the source files
+and the on-disk cache.
+'''
+
+import os
+import re
+import shutil
+import tempfile
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from nibabel.freesurfer.io import read_morph_data, read_annot
+from nibabel.freesurfer.mghformat import load
+
+#In-memory cache of parsed files, keyed like the on-disk entries. Off (max_bytes = 0) unless switched on with set_memory_cache.
+_memory_cache = {'max_bytes': 0, 'entries': OrderedDict(), 'sizes': {}, 'size': 0, 'hits': 0, 'misses': 0}
+_memory_lock = threading.Lock()
+
+#Entries are named <kind>-<sha1 fingerprint>, and hold this (empty) file once all their arrays are written.
+_ENTRY_NAME = re.compile(r'^(annot|feature)-[0-9a-f]{40}$')
+_ENTRY_MARKER = 'complete'
+
+def get_file_fingerprint(path):
+
+    #Key identifying the current version of a source file. Symbolic links (e.g. to a shared template's label files) resolve to the same key.
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = path + '|' + str(stat.st_size) + '|' + str(stat.st_mtime_ns)
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def read_feature_file(path):
+
+    #check for mgh/mgz format vs regular curv files. MGH data has no scaling, so the stored values are returned as is (without casting to float64).
+    if path.endswith('mgh') or path.endswith('mgz'):
+        return np.asarray(load(path).dataobj).flatten()
+    else:
+        return read_morph_data(path)
+
+def map_feature_file(path):
+
+    '''
+    Like read_feature_file, but avoids reading the values into memory where possible: uncompressed .mgh files and FreeSurfer (new format)
+    morph data files are memory mapped, in the dtype stored on disk. Compressed .mgz files have to be decompressed into memory.
+    '''
+
+    if path.endswith('mgh') or path.endswith('mgz'):
+        return np.asanyarray(load(path, mmap=True).dataobj).reshape(-1)
+
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+        header = np.fromfile(f, '>i4', 3)
+
+    #New style curv files start with the magic number 0xFFFFFF, followed by the number of vertices, faces and values per vertex.
+    if (magic != b'\xff\xff\xff') or (header[2] != 1):
+        return read_morph_data(path)
+
+    return np.memmap(path, dtype='>f4', mode='r', offset=15, shape=(header[0],))
+
+def _get_entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, x)) for x in os.listdir(entry_dir))
+
+def _is_entry(entry_dir):
+    return os.path.isfile(os.path.join(entry_dir, _ENTRY_MARKER))
+
+def evict_cache(cache_dir, max_cache_bytes):
+
+    '''
+    Deletes the least recently used entries in cache_dir until their total size is at most max_cache_bytes. Only complete cache entries
+    (named annot-<fingerprint> or feature-<fingerprint>, with their marker file) are counted and deleted: anything else in cache_dir is left alone.
+    '''
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if (_ENTRY_NAME.match(name) is None) or not _is_entry(entry_dir):
+            continue
+
+        #Another process may evict the same entry in the meantime.
+        try:
+            entries.append((os.path.getmtime(entry_dir), _get_entry_size(entry_dir), entry_dir))
+        except OSError:
+            continue
+
+    total_size = sum(x[1] for x in entries)
+
+    for last_used, size, entry_dir in sorted(entries):
+        if total_size <= max_cache_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+def _load_entry(entry_dir, names):
+
+    '''
+    Loads the arrays of a cache entry, or returns None if it is missing or incomplete (e.g. evicted by another process since it was looked up),
+    in which case the source file is read again.
+    '''
+
+    if not _is_entry(entry_dir):
+        return None
+
+    try:
+        #Mark the entry as recently used, for LRU eviction.
+        os.utime(entry_dir)
+        return [np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r') for name in names]
+    except (OSError, ValueError):
+        return None
+
+def _write_entry(entry_dir, arrays):
+
+    #Write to a temporary directory first and rename it into place, so a half written entry is never read. The temporary directory is
+    #unique, so several processes or threads (e.g. server workers or compute_MIND_sweep) can write the same entry at the same time.
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(entry_dir) + '.tmp', dir=os.path.dirname(entry_dir))
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    open(os.path.join(tmp_dir, _ENTRY_MARKER), 'w').close()
+
+    #An incomplete entry left behind (e.g. by an eviction that was interrupted) is replaced.
+    if os.path.isdir(entry_dir) and not _is_entry(entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        #Another process cached the same file in the meantime.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def set_memory_cache(max_bytes):
+
+    '''
+    Keeps up to max_bytes of parsed annotations, parcellation region lists and feature files in memory, so loading the same unchanged files
+    again in this process skips reading them (and the on-disk cache) altogether. The least recently used entries are dropped beyond max_bytes,
+    and 0 switches the memory cache off and empties it. Cached arrays are shared between calls, so they must not be modified in place.
+    '''
+
+    with _memory_lock:
+        _memory_cache['max_bytes'] = max_bytes
+        _shrink_memory_cache()
+
+def get_memory_cache_stats():
+
+    #Number of entries, bytes held, hits and misses of the memory cache.
+    with _memory_lock:
+        return {'entries': len(_memory_cache['entries']), 'bytes': _memory_cache['size'], 'hits': _memory_cache['hits'], 'misses': _memory_cache['misses']}
+
+def _get_nbytes(x):
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, dict):
+        return sum(_get_nbytes(value) for value in x.values())
+    if isinstance(x, (list, tuple)):
+        return sum(_get_nbytes(value) for value in x)
+    return 0
+
+def _shrink_memory_cache():
+
+    #Drop the least recently used entries until the cache fits. Called with _memory_lock held.
+    while _memory_cache['size'] > _memory_cache['max_bytes']:
+        key, _ = _memory_cache['entries'].popitem(last=False)
+        _memory_cache['size'] -= _memory_cache['sizes'].pop(key)
+
+def memory_cached(kind, paths, function):
+
+    '''
+    Returns function(), which loads something from the files in paths, keeping the result in the memory cache if it is switched on.
+    The key includes the fingerprint of every file, so editing or replacing one of them is picked up.
+    '''
+
+    if _memory_cache['max_bytes'] <= 0:
+        return function()
+
+    key = kind + '-' + '-'.join(get_file_fingerprint(x) for x in paths)
+
+    with _memory_lock:
+        if key in _memory_cache['entries']:
+            _memory_cache['entries'].move_to_end(key)
+            _memory_cache['hits'] += 1
+            return _memory_cache['entries'][key]
+        _memory_cache['misses'] += 1
+
+    value = function()
+    size = _get_nbytes(value)
+
+    with _memory_lock:
+        if (key not in _memory_cache['entries']) and (size <= _memory_cache['max_bytes']):
+            _memory_cache['entries'][key] = value
+            _memory_cache['sizes'][key] = size
+            _memory_cache['size'] += size
+            _shrink_memory_cache()
+
+    return value
+
+def load_annot(path, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    Equivalent to read_annot(path, orig_ids = True), returning (labels, ctab, names), but served from the cache if cache_dir is given
+    (or from memory, see set_memory_cache).
+    '''
+
+    return memory_cached('annot', [path], lambda: _load_annot(path, cache_dir, max_cache_bytes))
+
+def _load_annot(path, cache_dir, max_cache_bytes):
+
+    if cache_dir is None:
+        return read_annot(path, orig_ids = True)
+
+    entry_dir = os.path.join(cache_dir, 'annot-' + get_file_fingerprint(path))
+    entry = _load_entry(entry_dir, ['labels', 'ctab', 'names'])
+
+    if entry is None:
+        labels, ctab, names = read_annot(path, orig_ids = True)
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_entry(entry_dir, {'labels': labels, 'ctab': ctab, 'names': np.array(names)})
+
+        if max_cache_bytes is not None:
+            evict_cache(cache_dir, max_cache_bytes)
+
+        return labels, ctab, names
+
+    labels, ctab, names = entry
+
+    return labels, ctab, [bytes(x) for x in names]
+
+def load_feature(path, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    Loads a vertex-level surface feature file (FreeSurfer morph data, .mgh or .mgz) as a flat array, served from the cache if cache_dir is given
+    (or from memory, see set_memory_cache).
+    '''
+
+    return memory_cached('feature', [path], lambda: _load_feature(path, cache_dir, max_cache_bytes))
+
+def map_or_load_feature(path, cache_dir=None, max_cache_bytes=None):
+
+    '''
+    Like load_feature, but memory maps the file (see map_feature_file) when neither the on-disk nor the memory cache is in use. With either
+    cache on, the parsed values are shared with load_feature, so e.g. dtype jobs in MIND_server.py are served from a warm cache as well.
+    '''
+
+    if (cache_dir is None) and (_memory_cache['max_bytes'] <= 0):
+        return map_feature_file(path)
+
+    return load_feature(path, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+
+def _load_feature(path, cache_dir, max_cache_bytes):
+
+    if cache_dir is None:
+        return read_feature_file(path)
+
+    entry_dir = os.path.join(cache_dir, 'feature-' + get_file_fingerprint(path))
+    entry = _load_entry(entry_dir, ['data'])
+
+    if entry is None:
+        data = read_feature_file(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_entry(entry_dir, {'data': data})
+
+        if max_cache_bytes is not None:
+            evict_cache(cache_dir, max_cache_bytes)
+
+        return data
+
+    return entry[0]